@@ -0,0 +1,175 @@
+'''
+  Copyright (C) 2013 by Christopher Cooper, Lorena Barba
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy
+  of this software and associated documentation files (the "Software"), to deal
+  in the Software without restriction, including without limitation the rights
+  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+  copies of the Software, and to permit persons to whom the Software is
+  furnished to do so, subject to the following conditions:
+
+  The above copyright notice and this permission notice shall be included in
+  all copies or substantial portions of the Software.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+'''
+
+# On-disk cache of setup data (fill_surface and generateList)
+# Every setup is stored in its own directory, one .npy file per array,
+# named after a hash of the meshes, the regions and the parameters that
+# change the setup. Arrays are memory-mapped when loaded.
+
+from numpy import *
+import os
+import json
+import time
+import shutil
+import hashlib
+
+import sys
+sys.path.append('tree')
+from FMMutils import Octree
+
+cache_version = 2
+
+# Surface arrays computed in fill_surface
+surf_fields = ['xi', 'yi', 'zi', 'normal', 'Area', 'xj', 'yj', 'zj', 'twig',
+               'xk', 'wk', 'Xsk', 'Wsk', 'Precond', 'sglInt_int', 'sglInt_ext',
+               'sortTarget', 'unsort', 'sortSource', 'offsetSource', 'offsetTarget', 'sizeTarget',
+               'xiSort', 'yiSort', 'ziSort', 'xjSort', 'yjSort', 'zjSort',
+               'AreaSort', 'sglInt_intSort', 'sglInt_extSort', 'triangleSort']
+
+# Octree arrays (multipoles are not stored)
+tree_fields = ['xc', 'yc', 'zc', 'r', 'level', 'parent', 'child', 'nchild', 'octant',
+               'ntarget', 'offTarget', 'target', 'twig', 'twig_array', 'source', 'offSource']
+
+# Surface arrays computed in generateList
+list_fields = ['offsetTwigs', 'offsetMlt', 'P2P_list', 'M2P_list', 'P2P_ptr', 'M2P_ptr',
+               'xcSort', 'ycSort', 'zcSort']
+
+
+def setupKey(surf_array, field_array, param):
+    # Hash of everything the setup depends on: meshes (after reading and
+    # removing zero areas), surface types, regions and parameters
+
+    h = hashlib.sha1()
+    h.update(('pygbe setup %i'%cache_version).encode())
+    h.update(('%s %i %i %i %i %i %r %r'%(dtype(param.REAL).name, param.K, param.Nk, param.K_fine,
+                                    param.P, param.NCRIT, float(param.theta), float(param.share_tol))).encode())
+    for s in surf_array:
+        h.update(ascontiguousarray(s.vertex, dtype=float64).tobytes())
+        h.update(ascontiguousarray(s.triangle, dtype=int64).tobytes())
+        h.update(('%s %r %r %r %r %i %i'%(s.surf_type, float(s.kappa_in), float(s.kappa_out),
+                                        float(s.Ein), float(s.Eout), s.LorY_in, s.LorY_out)).encode())
+    for f in field_array:
+        h.update(('%i %r %r %r %r'%(f.LorY, float(f.kappa), float(f.E),
+                                    [int(i) for i in f.parent], [int(i) for i in f.child])).encode())
+
+    return h.hexdigest()
+
+def cacheSize(cache_dir):
+    # Size in MB of every stored setup, with time of last use
+
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+
+    for key in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, key)
+        if not os.path.isfile(os.path.join(path, 'info.json')):
+            continue
+        size = 0.
+        for name in os.listdir(path):
+            size += os.path.getsize(os.path.join(path, name))
+        entries.append((os.path.getmtime(os.path.join(path, 'info.json')), size/1e6, path))
+
+    return entries
+
+def evictCache(cache_dir, max_size):
+    # Removes least recently used setups until the cache fits in max_size (MB)
+
+    entries = sorted(cacheSize(cache_dir))
+    total = sum([e[1] for e in entries])
+    while total>max_size and len(entries)>1:
+        t, size, path = entries.pop(0)
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        print('Setup cache: removed %s (%.1f MB)'%(os.path.basename(path), size))
+
+def clearCache(cache_dir):
+
+    for t, size, path in cacheSize(cache_dir):
+        shutil.rmtree(path, ignore_errors=True)
+    print('Setup cache cleared: %s'%cache_dir)
+
+def saveSetup(cache_dir, key, surf_array, param):
+
+    path = os.path.join(cache_dir, key)
+    if os.path.isdir(path):
+        return
+
+    tmp = path + '.tmp%i'%os.getpid()
+    try:
+        os.makedirs(tmp)
+        for i in range(len(surf_array)):
+            s = surf_array[i]
+            for name in surf_fields + list_fields:
+                save(os.path.join(tmp, 's%i_%s.npy'%(i,name)), getattr(s,name))
+            for name in tree_fields:
+                save(os.path.join(tmp, 's%i_tree_%s.npy'%(i,name)), getattr(s.tree,name))
+
+        info = {'version': cache_version, 'Nsurf': len(surf_array),
+                'Ncell': [int(s.tree.Ncell) for s in surf_array], 'created': time.time(),
+                'copy_of': [-1 if s.copy_of is None else int(s.copy_of[0]) for s in surf_array]}
+        json.dump(info, open(os.path.join(tmp, 'info.json'), 'w'))
+        os.rename(tmp, path)
+    except OSError as e:
+        print('Setup cache: could not write %s (%s)'%(path, e))
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+
+    evictCache(cache_dir, param.cache_size)
+
+def loadSetup(cache_dir, key, surf_array, param):
+    # Fills surf_array with stored setup. Returns False if this setup is not in the cache
+
+    path = os.path.join(cache_dir, key)
+    try:
+        info = json.load(open(os.path.join(path, 'info.json')))
+    except (IOError, OSError, ValueError):
+        return False
+    if info['version']!=cache_version or info['Nsurf']!=len(surf_array):
+        return False
+
+    try:
+        for i in range(len(surf_array)):
+            s = surf_array[i]
+            for name in surf_fields + list_fields:
+                setattr(s, name, load(os.path.join(path, 's%i_%s.npy'%(i,name)), mmap_mode='c'))
+
+            s.tree = Octree()
+            for name in tree_fields:
+                setattr(s.tree, name, load(os.path.join(path, 's%i_tree_%s.npy'%(i,name)), mmap_mode='c'))
+            s.tree.Ncell = info['Ncell'][i]
+            s.tree.M  = zeros((s.tree.Ncell,int(param.Nm)))
+            s.tree.Md = zeros((s.tree.Ncell,int(param.Nm)))
+    except (IOError, OSError, ValueError):
+        print('Setup cache: %s is incomplete, computing setup'%key)
+        return False
+
+#   Rigid copies (shareSurface) share stored near field and ILU with their original again
+    for i in range(len(surf_array)):
+        j = info['copy_of'][i]
+        if j>=0:
+            surf_array[i].copy_of = (j, surf_array[j])
+            print('Surface %i: rigid copy of surface %i (from setup cache)'%(i, j))
+
+    os.utime(os.path.join(path, 'info.json'), None)  # Mark as recently used
+
+    return True
@@ -0,0 +1,171 @@
+'''
+  Copyright (C) 2013 by Christopher Cooper, Lorena Barba
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy
+  of this software and associated documentation files (the "Software"), to deal
+  in the Software without restriction, including without limitation the rights
+  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+  copies of the Software, and to permit persons to whom the Software is
+  furnished to do so, subject to the following conditions:
+
+  The above copyright notice and this permission notice shall be included in
+  all copies or substantial portions of the Software.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+'''
+
+# Potential of point charges (sum of q/r) and its gradient at a set of points.
+# Small problems are summed directly in blocks of charges, large ones with a
+# treecode where the charges are the sources: P2M on charges, M2P and P2P
+# on the points (sorted by their own tree).
+
+from numpy import *
+import sys
+sys.path.append('tree')
+from FMMutils import *
+from direct import coulomb_sort
+from classes import index_constant
+
+def pointTree(x, y, z, NCRIT, Nm):
+    # Tree on points (charges), with each point as the only source of its own
+    # target, so tree.source sorts the points by twig
+
+    N = len(x)
+    x_center = array([average(x), average(y), average(z)])
+    dist = sqrt((x-x_center[0])**2 + (y-x_center[1])**2 + (z-x_center[2])**2)
+
+    tree = generateTree(x, y, z, NCRIT, Nm, N, max(dist), x_center)
+    findTwigs(tree, NCRIT)
+    addSources3(tree, tree.twig, 1)
+
+    return tree
+
+def pointTargets(tree):
+    # Offset and number of sorted points in each twig of a pointTree
+
+    return tree.offSource[:-1], int32(diff(tree.offSource))
+
+def chargeIndex(P):
+    # Taylor expansion indices for charge multipoles
+
+    ind = index_constant()
+    computeIndices(P, ind)
+    precomputeTerms(P, ind)
+
+    return ind
+
+def chargePoints(field, param):
+    # Tree of the charges in a region, without multipoles. It is built on
+    # first use and kept in field, field.tree=[] when the charges change
+
+    if field.tree==[]:
+        xq = field.xq
+        field.tree = pointTree(xq[:,0], xq[:,1], xq[:,2], param.NCRIT, 1)
+
+    return field.tree
+
+def chargeTree(field, ind, param):
+    # Tree of the charges with multipoles of order param.charge_P
+
+    tree = chargePoints(field, param)
+    if shape(tree.M)!=(tree.Ncell,len(ind.II)):
+        xq = field.xq
+        zero = zeros(len(field.q))
+        getMultipole(tree, xq[:,0], xq[:,1], xq[:,2], field.q, zero, zero, zero, ind, param.charge_P, param.NCRIT)
+        upwardSweepTree(tree, ind)
+
+    return tree
+
+def chargeDirectField(xq, q, xt, yt, zt, grad):
+    # Direct sums, broadcasting over blocks of charges so the temporary
+    # arrays have no more than ~4M elements
+
+    N  = len(xt)
+    Nq = len(q)
+    phi  = zeros(N)
+    dphi = []
+    if grad==1:
+        dphi = zeros((3,N))
+
+    chunk = max(1, int(4e6)//max(N,1))
+    for i in range(0, Nq, chunk):
+        dx = xt[:,newaxis] - xq[newaxis,i:i+chunk,0]
+        dy = yt[:,newaxis] - xq[newaxis,i:i+chunk,1]
+        dz = zt[:,newaxis] - xq[newaxis,i:i+chunk,2]
+        invR = 1/sqrt(dx*dx + dy*dy + dz*dz)
+        phi += dot(invR, q[i:i+chunk])
+        if grad==1:
+            invR3 = invR*invR*invR*q[i:i+chunk]
+            dphi[0] -= sum(invR3*dx, axis=1)
+            dphi[1] -= sum(invR3*dy, axis=1)
+            dphi[2] -= sum(invR3*dz, axis=1)
+
+    return phi, dphi
+
+def chargeTreeField(field, tarTree, xt, yt, zt, offTar, sizeTar, grad, param):
+    # Treecode sums at targets xt, yt, zt, sorted by tarTree: targets of
+    # twig tw are [offTar[tw], offTar[tw]+sizeTar[tw]). Results are sorted too
+
+    ind = chargeIndex(param.charge_P)
+    src = chargeTree(field, ind, param)
+    Nm  = len(ind.II)
+    P2P_list, offTwg, M2P_list, offMlt = dualTreeList(src, tarTree, param.charge_theta, param.NCRIT)
+
+    N = len(xt)
+    phi  = zeros(N)
+    dphi = zeros((3,N))
+    aux  = zeros(N)     # Md part of multipole_sort, not used for charges
+
+    multipole_sort(aux, phi, offTar, sizeTar, offMlt, M2P_list, src.M.ravel(), src.Md.ravel(),
+                    xt, yt, zt, src.xc, src.yc, src.zc, ind.index_large, param.charge_P, 0., Nm, 1)
+    if grad==1:
+        multipoleKt_sort(dphi[0], dphi[1], dphi[2], offTar, sizeTar, offMlt, M2P_list, src.M.ravel(),
+                    xt, yt, zt, src.xc, src.yc, src.zc, ind.index_large, param.charge_P, 0., Nm, 1)
+
+    s = src.source
+    coulomb_sort(phi, dphi[0], dphi[1], dphi[2], xt, yt, zt,
+                    field.xq[s,0], field.xq[s,1], field.xq[s,2], field.q[s],
+                    P2P_list, offTar, sizeTar, src.offSource, offTwg, int(grad))
+
+    if grad==0:
+        dphi = []
+
+    return phi, dphi
+
+def surfaceChargeField(surf, field, grad, param):
+    # Potential of the charges in field at the collocation points of surf,
+    # and its gradient if grad==1 (dphi is a (3,N) array)
+
+    N  = len(surf.xi)
+    Nq = len(field.q)
+
+    if float(N)*Nq<=param.charge_direct:
+        return chargeDirectField(field.xq, field.q, surf.xi, surf.yi, surf.zi, grad)
+
+    phi, dphi = chargeTreeField(field, surf.tree, surf.xiSort, surf.yiSort, surf.ziSort,
+                                surf.offsetTarget, surf.sizeTarget, grad, param)
+    if grad==1:
+        dphi = dphi[:,surf.unsort]
+
+    return phi[surf.unsort], dphi
+
+def chargeSelfField(field, param):
+    # Potential at every charge of field due to all other charges in field
+    # (treecode, charges are sources and targets; coulomb_sort skips self pairs)
+
+    ind  = chargeIndex(param.charge_P)
+    tree = chargeTree(field, ind, param)
+    s = tree.source
+    offTar, sizeTar = pointTargets(tree)
+    phi_sort, dphi = chargeTreeField(field, tree, field.xq[s,0], field.xq[s,1], field.xq[s,2],
+                                     offTar, sizeTar, 0, param)
+    phi = zeros(len(field.q))
+    phi[s] = phi_sort
+
+    return phi
@@ -22,18 +22,18 @@
 
 from numpy import *
 import sys
+import hashlib
 sys.path.append('tree')
 from FMMutils import *
 from direct   import computeDiagonal
+from scipy.spatial import cKDTree
 sys.path.append('../util')
 from semi_analytical    import *
 from triangulation      import *
 from readData           import readVertex, readTriangle, readpqr, readcrd, readFields, readSurf
 
-# PyCUDA libraries
-import pycuda.autoinit
-import pycuda.gpuarray as gpuarray
-import pycuda.driver as cuda
+# PyCUDA libraries, loaded on first use by the GPU backend
+from backend import cuda, gpuarray
 
 class surfaces():
     def __init__(self):
@@ -57,7 +57,7 @@ class surfaces():
         self.wk       = []  # weight of gauss points on edges
         self.Xsk      = []  # position of gauss points for near singular integrals
         self.Wsk      = []  # weight of gauss points for near singular integrals
-        self.tree     = []  # tree structure
+        self.tree     = []  # tree structure (Octree)
         self.twig     = []  # tree twigs
         self.xiSort   = []  # sorted x component of center
         self.yiSort   = []  # sorted y component of center
@@ -80,9 +80,16 @@ class surfaces():
         self.sizeTarget   = []  # array with number of targets pero twig
         self.offsetTwigs  = []  # offset to twig in P2P list array
         self.P2P_list     = []  # pointers to twigs for P2P interaction list
+        self.P2P_ptr      = []  # pointer to P2P list of each source surface
         self.offsetMlt    = []  # offset to multipoles in M2P list array
         self.M2P_list     = []  # pointers to boxes for M2P interaction list
+        self.M2P_ptr      = []  # pointer to M2P list of each source surface
         self.Precond      = []  # Sparse representation of preconditioner for self interaction block
+        self.P2P_block    = {}  # Stored near-field operator, per source surface and kernel
+        self.P2P_near     = []  # Near-field self interaction on triangles, for the near-field preconditioner
+        self.P2P_nearMem  = 0   # MB of P2P_near counted in P2P_mem and not in P2P_block
+        self.PrecondILU   = None  # Incomplete LU of the near-field preconditioner (None: not used)
+        self.copy_of      = None  # (index, surface) this one is a rigid copy of, with the same regions
         self.Ein          = 0   # Permitivitty inside surface
         self.Eout         = 0   # Permitivitty outside surface
         self.E_hat        = 0   # ratio of Ein/Eout
@@ -132,6 +139,7 @@ class fields():
         self.q      = []    # value of charges
         self.coul   = []    # 1: perform Coulomb interaction calculation
                             # 0: don't do Coulomb calculation
+        self.tree   = []    # tree of charges with their multipoles (built when needed)
 
         # Device data
         self.xq_gpu = []    # x position of charges on gpu
@@ -150,6 +158,37 @@ class timings():
         self.time_sort  = 0.
         self.time_mass  = 0.
         self.AI_int     = 0
+        self.Nmatvec    = 0     # GMRES matrix-vector products (gmres_dot calls)
+        self.iterations = 0     # GMRES iterations of the last solve
+
+
+class recycleSpace():
+    def __init__(self, k):
+        self.k      = k     # number of recycled Krylov vectors (GCRO-DR)
+        self.U      = []    # recycled subspace, (k,N) array
+        self.Nsolve = 0     # number of solves that used this space
+
+
+class andersonHistory():
+    def __init__(self, depth, beta):
+        self.depth  = depth # number of previous steps kept (0: plain Picard)
+        self.beta   = beta  # damping of the residual in the update
+        self.dX     = []    # differences of the last iterates
+        self.dF     = []    # differences of the last residuals G(x)-x
+        self.x_old  = []    # previous iterate
+        self.f_old  = []    # previous residual
+        self.f_norm = 0.    # norm of previous residual
+
+
+class accuracyLevels():
+    def __init__(self):
+        self.theta   = []   # MAC criterion of each level (level 0: param.theta)
+        self.P       = []   # order of Taylor expansion of each level
+        self.error   = []   # estimate of treecode error of each level, theta**(P+1)
+        self.ind     = []   # index_constant of each level
+        self.lists   = []   # interaction lists and stored near field of each level, per surface
+        self.current = 0    # level of the lists in the surfaces
+        self.Nmatvec = []   # matrix-vector products done at each level in the last solve
 
 
 class parameters():
@@ -178,6 +217,26 @@ class parameters():
         self.REAL          = 0               # Data type
         self.E_field       = []              # Regions where energy will be calculated
         self.GPU           = -1              # =1: with GPU, =0: no GPU
+        self.P2P_cache     = 0               # =1: store near-field operator after first use (CPU only)
+        self.P2P_budget    = 2000.           # Memory budget for stored near-field operator (MB)
+        self.P2P_mem       = 0.              # Memory used by stored near-field operator (MB)
+        self.cache         = 0               # =1: read and write the on-disk setup cache
+        self.cache_dir     = '~/.pygbe_cache' # Directory of on-disk setup cache
+        self.cache_size    = 2000.           # Max size of on-disk setup cache (MB)
+        self.threads       = 1               # CPU threads for treecode kernels (0: all cores)
+        self.charge_direct = 2e8             # Max charge-point pairs summed directly (above: treecode)
+        self.charge_P      = 8               # Order of Taylor expansion for charge treecode
+        self.charge_theta  = 0.4             # MAC criterion for charge treecode
+        self.precond       = 'diagonal'      # GMRES preconditioner: 'diagonal' or 'near' (near-field ILU)
+        self.precond_drop  = 1e-4            # Drop tolerance of the near-field ILU
+        self.precond_fill  = 10.             # Fill factor of the near-field ILU
+        self.relax_levels  = 0               # Relaxed treecode accuracy levels in GMRES (0: fixed accuracy)
+        self.relax_dtheta  = 0.1             # Increase of theta per relaxed level
+        self.relax_safety  = 1.              # Safety factor of the inexact matvec bound
+        self.gmres_dump    = 0               # =1: save the first GMRES basis vectors to Vip1*.txt (debugging)
+        self.gmres_basis   = 'double'        # Storage of GMRES basis: 'double', 'single' or 'mmap' (single, on disk)
+        self.share_tol     = 0.              # Max vertex deviation (Angs) of rigid copies that share setup (0: no sharing)
+        self.charge_cache  = 0               # =1: keep charges read from .pqr/.crd in a sidecar .npz
 
 
 class index_constant():
@@ -778,14 +837,9 @@ def fill_surface(surf,param):
 
     # Generate tree, compute indices and precompute terms for M2M
     surf.tree = generateTree(surf.xi,surf.yi,surf.zi,param.NCRIT,param.Nm,N,R_C0,x_center)
-    C = 0
-    surf.twig = findTwigs(surf.tree, C, surf.twig, param.NCRIT)
+    surf.twig = findTwigs(surf.tree, param.NCRIT)
 
     addSources3(surf.tree, surf.twig, param.K)
-#    addSources(surf.xj,surf.yj,surf.zj,surf.tree,surf.twig)
-#    for j in range(Nj):
-#        C = 0
-#        addSources2(surf.xj,surf.yj,surf.zj,j,surf.tree,C,param.NCRIT)
 
     surf.xk,surf.wk = GQ_1D(param.Nk)
     surf.Xsk,surf.Wsk = quadratureRule_fine(param.K_fine) 
@@ -801,6 +855,108 @@ def fill_surface(surf,param):
     return time_sort
 
 
+def rigidFit(X, Y):
+    # Rotation R and translation d that best map points X onto Y (Kabsch), and
+    # the largest distance between R*X+d and Y
+
+    cX = average(X, axis=0)
+    cY = average(Y, axis=0)
+    U, S, Vt = linalg.svd(dot(transpose(X-cX), Y-cY))
+    D = eye(3)
+    D[2,2] = sign(linalg.det(dot(transpose(Vt), transpose(U))))   # no reflections
+    R = dot(transpose(Vt), dot(D, transpose(U)))
+    d = cY - dot(R, cX)
+    res = max(sqrt(sum((dot(X, transpose(R)) + d - Y)**2, axis=1)))
+
+    return R, d, res
+
+def shareSurface(surf, ref, s_ref, R, d, param):
+    # Setup of surf from the filled surface ref (index s_ref), of which it is a
+    # rigid copy x = R*x_ref + d. Tree structure, sorting, areas and quadrature
+    # are shared, coordinates are transformed (multipoles have their own arrays).
+    # Preconditioner and singular integrals are shared too if the regions on
+    # both sides are the same, and then so are stored near-field self blocks
+    # (copy_of, see copyBlock in FMMutils)
+
+    surf.vertex = dot(ref.vertex, transpose(R)) + d
+    surf.normal = dot(ref.normal, transpose(R))
+    surf.Area   = ref.Area
+    xi = dot(transpose([ref.xi, ref.yi, ref.zi]), transpose(R)) + d
+    xj = dot(transpose([ref.xj, ref.yj, ref.zj]), transpose(R)) + d
+    xc = dot(transpose([ref.tree.xc, ref.tree.yc, ref.tree.zc]), transpose(R)) + d
+    surf.xi, surf.yi, surf.zi = xi[:,0].copy(), xi[:,1].copy(), xi[:,2].copy()
+    surf.xj, surf.yj, surf.zj = xj[:,0].copy(), xj[:,1].copy(), xj[:,2].copy()
+
+    surf.tree = Octree()
+    surf.tree.__dict__.update(ref.tree.__dict__)
+    surf.tree.xc, surf.tree.yc, surf.tree.zc = xc[:,0].copy(), xc[:,1].copy(), xc[:,2].copy()
+    surf.tree.M  = zeros(shape(ref.tree.M))
+    surf.tree.Md = zeros(shape(ref.tree.Md))
+    surf.twig = ref.twig
+
+    for name in ['xk', 'wk', 'Xsk', 'Wsk', 'sortTarget', 'unsort', 'sortSource', 'offsetSource', 
+                 'offsetTarget', 'sizeTarget', 'AreaSort', 'triangleSort']:
+        setattr(surf, name, getattr(ref, name))
+    surf.xiSort = surf.xi[surf.sortTarget]
+    surf.yiSort = surf.yi[surf.sortTarget]
+    surf.ziSort = surf.zi[surf.sortTarget]
+    surf.xjSort = surf.xj[surf.sortSource]
+    surf.yjSort = surf.yj[surf.sortSource]
+    surf.zjSort = surf.zj[surf.sortSource]
+
+    if (surf.LorY_in, surf.LorY_out, surf.kappa_in, surf.kappa_out, surf.E_hat) == \
+       (ref.LorY_in, ref.LorY_out, ref.kappa_in, ref.kappa_out, ref.E_hat):
+        for name in ['Precond', 'sglInt_int', 'sglInt_ext', 'sglInt_intSort', 'sglInt_extSort']:
+            setattr(surf, name, getattr(ref, name))
+        surf.copy_of = (s_ref, ref)
+    else:
+        computePrecond(surf)
+        surf.sglInt_intSort = surf.sglInt_int[surf.sortSource//param.K]
+        surf.sglInt_extSort = surf.sglInt_ext[surf.sortSource//param.K]
+
+def fillSurfaces(surf_array, param):
+    # fill_surface on every surface, except on rigid copies of a surface already
+    # filled (same triangles, vertices within param.share_tol of a fitted
+    # rotation and translation of its vertices), which share its setup
+    # (shareSurface). Returns the time spent sorting
+
+    time_sort = 0.
+    filled = {}     # Filled surfaces, by hash of their triangles
+    for i in range(len(surf_array)):
+        s = surf_array[i]
+        key = hashlib.sha1(ascontiguousarray(s.triangle, dtype=int64).tobytes()).hexdigest() \
+              + ' %s %i'%(s.surf_type, len(s.vertex))
+        match = None
+        if param.share_tol>0:
+            for j in filled.get(key, []):
+                R, d, res = rigidFit(surf_array[j].vertex, s.vertex)
+                if res<=param.share_tol:
+                    match = j
+                    break
+
+        if match is None:
+            time_sort += fill_surface(s, param)
+            filled.setdefault(key, []).append(i)
+        else:
+            shareSurface(s, surf_array[match], match, R, d, param)
+            print('Surface %i: rigid copy of surface %i (max vertex deviation %.1e), setup shared'%(i, match, res))
+
+    return time_sort
+
+def readCharges(field, i, qfile, param):
+# Reads charges of region i from a .crd or .pqr file into field.
+# Also used to swap charge sets on a fixed geometry (main.py --charges)
+
+    if qfile[-4:]=='.crd':
+        xq,q,Nq = readcrd(qfile, param.REAL, param.charge_cache==1) # read charges
+        print('\nReading crd for region %i from '%i+qfile)
+    if qfile[-4:]=='.pqr':
+        xq,q,Nq = readpqr(qfile, param.REAL, param.charge_cache==1) # read charges
+        print('\nReading pqr for region %i from '%i+qfile)
+    field.xq = xq                                                   # charges positions
+    field.q = q                                                     # charges values
+    field.tree = []                                                 # charge tree is rebuilt on first use
+
 def initializeField(filename, param):
     
     LorY, pot, E, kappa, charges, coulomb, qfile, Nparent, parent, Nchild, child = readFields(filename)
@@ -828,14 +984,7 @@ def initializeField(filename, param):
 
         field_aux.coulomb = int(coulomb[i])                         # do/don't coulomb interaction
         if int(charges[i])==1:                                      # if there are charges
-            if qfile[i][-4:]=='.crd':
-                xq,q,Nq = readcrd(qfile[i], param.REAL)             # read charges
-                print('\nReading crd for region %i from '%i+qfile[i])
-            if qfile[i][-4:]=='.pqr':
-                xq,q,Nq = readpqr(qfile[i], param.REAL)             # read charges
-                print('\nReading pqr for region %i from '%i+qfile[i])
-            field_aux.xq = xq                                       # charges positions
-            field_aux.q = q                                         # charges values
+            readCharges(field_aux, i, qfile[i], param)
         if int(Nparent[i])==1:                                      # if it is an enclosed region
             field_aux.parent.append(int(parent[i]))                 # pointer to parent surface (enclosing surface)
         if int(Nchild[i])>0:                                        # if there are enclosed regions inside
@@ -925,9 +1074,11 @@ def dataTransfer(surf_array, field_array, ind, param, kernel):
         surf_array[s].sglInt_intDev = gpuarray.to_gpu(surf_array[s].sglInt_intSort.astype(REAL))
         surf_array[s].sglInt_extDev = gpuarray.to_gpu(surf_array[s].sglInt_extSort.astype(REAL))
         surf_array[s].vertexDev  = gpuarray.to_gpu(ravel(surf_array[s].vertex[surf_array[s].triangleSort]).astype(REAL))
-        surf_array[s].xcDev      = gpuarray.to_gpu(ravel(surf_array[s].xcSort.astype(REAL)))
-        surf_array[s].ycDev      = gpuarray.to_gpu(ravel(surf_array[s].ycSort.astype(REAL)))
-        surf_array[s].zcDev      = gpuarray.to_gpu(ravel(surf_array[s].zcSort.astype(REAL)))
+#       M2P kernel reads box centers in blocks of BSZ, pad to avoid reading past the end
+        pad = zeros(param.BSZ)
+        surf_array[s].xcDev      = gpuarray.to_gpu(concatenate((surf_array[s].xcSort,pad)).astype(REAL))
+        surf_array[s].ycDev      = gpuarray.to_gpu(concatenate((surf_array[s].ycSort,pad)).astype(REAL))
+        surf_array[s].zcDev      = gpuarray.to_gpu(concatenate((surf_array[s].zcSort,pad)).astype(REAL))
         
 #       Avoid transferring size 1 arrays to GPU (some systems crash)
         Nbuff = 5
@@ -942,8 +1093,8 @@ def dataTransfer(surf_array, field_array, ind, param, kernel):
         surf_array[s].offSrcDev  = gpuarray.to_gpu(surf_array[s].offsetSource.astype(int32))
         surf_array[s].offTwgDev  = gpuarray.to_gpu(ravel(surf_array[s].offsetTwigs.astype(int32)))
         surf_array[s].offMltDev  = gpuarray.to_gpu(ravel(surf_array[s].offsetMlt.astype(int32)))
-        surf_array[s].M2P_lstDev = gpuarray.to_gpu(ravel(surf_array[s].M2P_list.astype(int32)))
-        surf_array[s].P2P_lstDev = gpuarray.to_gpu(ravel(surf_array[s].P2P_list.astype(int32)))
+        surf_array[s].M2P_lstDev = gpuarray.to_gpu(concatenate((surf_array[s].M2P_list,[0])).astype(int32))
+        surf_array[s].P2P_lstDev = gpuarray.to_gpu(concatenate((surf_array[s].P2P_list,[0])).astype(int32))
         surf_array[s].xkDev      = gpuarray.to_gpu(surf_array[s].xk.astype(REAL))
         surf_array[s].wkDev      = gpuarray.to_gpu(surf_array[s].wk.astype(REAL))
         surf_array[s].XskDev     = gpuarray.to_gpu(surf_array[s].Xsk.astype(REAL))
@@ -962,6 +1113,40 @@ def dataTransfer(surf_array, field_array, ind, param, kernel):
 
 
 
+def coarseToFine(phi_c, surf_coarse, surf_array):
+# Maps the solution vector phi_c on the coarse meshes surf_coarse to the fine
+# meshes of the same surfaces: each fine panel takes the unknowns of the 
+# coarse panel with the nearest center
+
+    Neq = 0
+    for s in surf_array:
+        if s.surf_type=='dirichlet_surface' or s.surf_type=='neumann_surface' or s.surf_type=='asc_surface':
+            Neq += len(s.triangle)
+        else:
+            Neq += 2*len(s.triangle)
+    phi = zeros(Neq)
+
+    c_start = 0
+    f_start = 0
+    for i in range(len(surf_array)):
+        sc = surf_coarse[i]
+        sf = surf_array[i]
+        Nc = len(sc.triangle)
+        Nf = len(sf.triangle)
+        if sf.surf_type=='dirichlet_surface' or sf.surf_type=='neumann_surface' or sf.surf_type=='asc_surface':
+            Nblock = 1
+        else:
+            Nblock = 2
+
+        dist, near = cKDTree(transpose([sc.xi,sc.yi,sc.zi])).query(transpose([sf.xi,sf.yi,sf.zi]))
+        for b in range(Nblock):
+            phi[f_start+b*Nf:f_start+(b+1)*Nf] = phi_c[c_start+b*Nc+near]
+
+        c_start += Nblock*Nc
+        f_start += Nblock*Nf
+
+    return phi
+
 def fill_phi(phi, surf_array):
 # Places the result vector on surf structure 
 
@@ -21,12 +21,19 @@
 '''
 
 from numpy  import zeros, array, dot, arange, exp, sqrt, random, transpose, sum, savetxt, shape
-from numpy.linalg           import norm
-from scipy.linalg           import lu_solve, solve
-from scipy.sparse.linalg    import gmres 
+from numpy  import concatenate, argsort, where, isfinite, inf, real, imag, diag, eye, newaxis, ones, pi
+from numpy  import float32, float64, memmap
+from numpy.linalg           import norm, lstsq
+from scipy.linalg           import lu_solve, solve, qr, eig, solve_triangular
+from scipy.sparse           import csr_matrix, bmat, diags
+from scipy.sparse.linalg    import gmres, spilu
 import time
+import resource
+import tempfile
 from matrixfree import gmres_dot as gmres_dot
-from projection import project
+from projection import project, getWeights
+from FMMutils   import P2P_assemble, copyBlock, blockMemory, generateList, computeIndices, precomputeTerms
+from classes    import index_constant, accuracyLevels
 
 def GeneratePlaneRotation(dx, dy, cs, sn):
 
@@ -61,31 +68,266 @@ def PlaneRotation (H, cs, sn, s, i, R):
 
     return H, cs, sn, s
 
-def gmres_solver (surf_array, field_array, X, b_clean, param, ind0, timing, kernel):
+def precondRHS(surf_array, b_clean):
+    # Applies the block diagonal preconditioner of every surface on the RHS
+    # (or on each row of b_clean, for several right-hand sides)
 
-    N = len(b_clean)
-    b = zeros(N)
-    V = zeros((param.restart+1, N))
-    H = zeros((param.restart+1,param.restart))
-
-#   Apply Preconditioner on RHS
+    b = zeros(shape(b_clean))
     Naux = 0
     for i in range(len(surf_array)):
         Nt = len(surf_array[i].triangle)
         if surf_array[i].surf_type=='dirichlet_surface':
-            b[Naux:Naux+Nt]     = b_clean[Naux:Naux+Nt]*surf_array[i].Precond[0,:] 
+            b[...,Naux:Naux+Nt]     = b_clean[...,Naux:Naux+Nt]*surf_array[i].Precond[0,:] 
             Naux += Nt
         elif surf_array[i].surf_type=='neumann_surface':
-            b[Naux:Naux+Nt]     = b_clean[Naux:Naux+Nt]*surf_array[i].Precond[0,:] 
+            b[...,Naux:Naux+Nt]     = b_clean[...,Naux:Naux+Nt]*surf_array[i].Precond[0,:] 
             Naux += Nt
         elif surf_array[i].surf_type=='asc_surface':
-            b[Naux:Naux+Nt]     = b_clean[Naux:Naux+Nt]*surf_array[i].Precond[0,:] 
+            b[...,Naux:Naux+Nt]     = b_clean[...,Naux:Naux+Nt]*surf_array[i].Precond[0,:] 
             Naux += Nt
         else:
-            b[Naux:Naux+Nt]     = b_clean[Naux:Naux+Nt]*surf_array[i].Precond[0,:] + b_clean[Naux+Nt:Naux+2*Nt]*surf_array[i].Precond[1,:] 
-            b[Naux+Nt:Naux+2*Nt]     = b_clean[Naux:Naux+Nt]*surf_array[i].Precond[2,:] + b_clean[Naux+Nt:Naux+2*Nt]*surf_array[i].Precond[3,:] 
+            b[...,Naux:Naux+Nt]     = b_clean[...,Naux:Naux+Nt]*surf_array[i].Precond[0,:] + b_clean[...,Naux+Nt:Naux+2*Nt]*surf_array[i].Precond[1,:] 
+            b[...,Naux+Nt:Naux+2*Nt]     = b_clean[...,Naux:Naux+Nt]*surf_array[i].Precond[2,:] + b_clean[...,Naux+Nt:Naux+2*Nt]*surf_array[i].Precond[3,:] 
             Naux += 2*Nt 
 
+    return b
+
+def nearSelf(surf, s, LorY, kappa, IorE, K_diag, param):
+    # Near-field (P2P) self interaction of surface s as sparse (N,N) matrices
+    # K and V on triangles, from the stored near-field operator if there is one.
+    # Returns None, None if it does not fit in the P2P memory budget
+
+    kappa_aux = param.kappa
+    param.kappa = kappa
+    key = (s, LorY, param.kappa, IorE, K_diag)
+    block = surf.P2P_block.get(key)
+    if block is None:
+        block = copyBlock(surf, surf, key)
+    if block is None:
+        block, time_an = P2P_assemble(surf, surf, s, LorY, K_diag, IorE, getWeights(param.K), param)
+        if param.P2P_cache==1 and param.GPU==0:
+            surf.P2P_block[key] = block
+        elif block is not None:
+            surf.P2P_nearMem += blockMemory(block)    # Stays counted in P2P_mem while P2P_near holds it
+    param.kappa = kappa_aux
+
+    if block is None:
+        return None, None
+
+#   Rows are sorted targets and columns sorted Gauss points: map both to triangles
+    K_mat, V_mat, AI_int = block
+    NsK = len(surf.sortSource)
+    P = csr_matrix((ones(NsK), (arange(NsK), surf.sortSource//param.K)), shape=(NsK, len(surf.triangle)))
+    K_tri = (K_mat[surf.unsort]*P).tocsr()
+    V_tri = (V_mat[surf.unsort]*P).tocsr()
+
+    return K_tri, V_tri
+
+def computeNearPrecond(surf_array, param):
+    # Preconditioner from the near-field self interaction of every surface: 
+    # incomplete LU of Precond times the near-field block of the operator, 
+    # applied on the right in gmres_solver, block_gmres_solver and gcrodr_solver.
+    # The near-field blocks are assembled
+    # once, the ILU is recomputed in every call (Precond and E_hat may change)
+
+    for s in range(len(surf_array)):
+        surf = surf_array[s]
+        surf.PrecondILU = None
+        N = len(surf.triangle)
+
+        if surf.surf_type=='asc_surface':    # Kt operator, stays with the diagonal preconditioner
+            continue
+
+        if surf.copy_of is not None and surf.copy_of[1].PrecondILU is not None:
+            surf.P2P_near   = surf.copy_of[1].P2P_near    # Rigid copy: same near field and ILU
+            surf.PrecondILU = surf.copy_of[1].PrecondILU
+            print('Surface %i: near-field ILU of surface %i'%(s, surf.copy_of[0]))
+            continue
+
+        if surf.P2P_near==[]:
+            K_out, V_out = nearSelf(surf, s, surf.LorY_out, surf.kappa_out, 2, -2*pi, param)
+            K_in, V_in = None, None
+            if surf.surf_type!='dirichlet_surface' and surf.surf_type!='neumann_surface':
+                K_in, V_in = nearSelf(surf, s, surf.LorY_in, surf.kappa_in, 1, 2*pi, param)
+            surf.P2P_near = [K_in, V_in, K_out, V_out]
+
+        K_in, V_in, K_out, V_out = surf.P2P_near
+        if K_out is None or (K_in is None and surf.surf_type!='dirichlet_surface' and surf.surf_type!='neumann_surface'):
+            print('Surface %i: near-field operator over P2P_budget, using the diagonal preconditioner'%s)
+            continue
+
+        E_hat = diags(surf.E_hat*ones(N))
+        if surf.surf_type=='dirichlet_surface':
+            A = V_out*E_hat
+            D = diags(surf.Precond[0,:])
+        elif surf.surf_type=='neumann_surface':
+            A = -K_out
+            D = diags(surf.Precond[0,:])
+        else:
+            A = bmat([[K_in, -V_in], [-K_out, V_out*E_hat]])
+            D = bmat([[diags(surf.Precond[0,:]), diags(surf.Precond[1,:])], 
+                      [diags(surf.Precond[2,:]), diags(surf.Precond[3,:])]])
+
+        M = (D*A).tocsc()
+        surf.PrecondILU = spilu(M, drop_tol=param.precond_drop, fill_factor=param.precond_fill)
+        print('Surface %i: near-field ILU with %i nonzeros (operator %i)'%(s, surf.PrecondILU.nnz, M.nnz))
+
+def precondNear(surf_array, X):
+    # Applies the near-field preconditioner of every surface on X, a vector or
+    # one vector per row (identity on surfaces without one)
+
+    Y = X.copy()
+    Naux = 0
+    for i in range(len(surf_array)):
+        Nt = len(surf_array[i].triangle)
+        if surf_array[i].surf_type=='dirichlet_surface' or surf_array[i].surf_type=='neumann_surface' or surf_array[i].surf_type=='asc_surface':
+            Neq = Nt
+        else:
+            Neq = 2*Nt
+        if surf_array[i].PrecondILU is not None:
+            Y[...,Naux:Naux+Neq] = surf_array[i].PrecondILU.solve(X[...,Naux:Naux+Neq].T).T
+        Naux += Neq
+
+    return Y
+
+workspace = {}  # Krylov basis V and Hessenberg H of the last gmres_solver size
+
+def gmresWorkspace(N, restart, basis='double'):
+    # V and H for a restart length and system size, kept between restarts and 
+    # solves. Entries are always written before they are read.
+    # basis: storage of V, 'double', 'single' (float32) or 'mmap' (float32 in a
+    # temporary file, for bases larger than memory). H is always double
+
+    key = (N, restart, basis)
+    if key not in workspace:
+        workspace.clear()
+        H = zeros((restart+1,restart))
+        if basis=='single':
+            V = zeros((restart+1,N), dtype=float32)
+        elif basis=='mmap':
+            f = tempfile.TemporaryFile(prefix='pygbe_basis')
+            V = memmap(f, dtype=float32, mode='w+', shape=(restart+1,N))
+        else:
+            V = zeros((restart+1,N))
+        workspace[key] = (V, H)
+        print('Krylov basis: %.1f MB (%s)'%(V.nbytes/1e6, basis))
+    return workspace[key]
+
+basis_block = 16    # Basis vectors converted to double at a time, for single precision bases
+
+def basisProject(V, n, w):
+    # dot(V[0:n], w) in double precision
+
+    if V.dtype==float64:
+        return dot(V[0:n], w)
+    h = zeros(n)
+    for k in range(0, n, basis_block):
+        h[k:k+basis_block] = dot(V[k:min(k+basis_block,n)].astype(float64), w)
+    return h
+
+def basisCombine(V, n, y):
+    # dot(y, V[0:n]) in double precision
+
+    if V.dtype==float64:
+        return dot(y, V[0:n])
+    x = zeros(V.shape[1])
+    for k in range(0, n, basis_block):
+        x += dot(y[k:k+basis_block], V[k:min(k+basis_block,n)].astype(float64))
+    return x
+
+def arnoldiStep(V, H, w, i):
+    # Orthogonalizes w against V[0:i+1] with classical Gram-Schmidt and one
+    # reorthogonalization (two matrix-vector products each), and stores the
+    # new basis vector in V[i+1] and the coefficients in H[0:i+2,i]
+
+    h = basisProject(V, i+1, w)
+    w -= basisCombine(V, i+1, h)
+    h2 = basisProject(V, i+1, w)
+    w -= basisCombine(V, i+1, h2)
+    H[0:i+1,i] = h + h2
+    H[i+1,i] = norm(w)
+    V[i+1] = w/H[i+1,i]
+
+list_fields = ['offsetTwigs', 'offsetMlt', 'P2P_list', 'M2P_list', 'P2P_ptr', 'M2P_ptr',
+               'xcSort', 'ycSort', 'zcSort', 'P2P_block']
+
+def relaxLevels(surf_array, field_array, param, ind0):
+    # Treecode accuracy levels for relaxed matvecs (CPU only). Level 0 is the 
+    # accuracy of param, level l uses theta+l*relax_dtheta (up to 0.9) and order
+    # max(P-l,1). Interaction lists (and stored near field) of each level are 
+    # generated here once, setLevel swaps them in
+
+    relax = accuracyLevels()
+    theta, P = param.theta, param.P
+    for l in range(param.relax_levels+1):
+        relax.theta.append(min(theta+l*param.relax_dtheta, 0.9))
+        relax.P.append(max(P-l, 1))
+        relax.error.append(relax.theta[-1]**(relax.P[-1]+1))
+        if l==0:
+            relax.ind.append(ind0)
+        else:
+            ind = index_constant()
+            computeIndices(relax.P[-1], ind)
+            precomputeTerms(relax.P[-1], ind)
+            relax.ind.append(ind)
+            param.theta = relax.theta[-1]
+            for surf in surf_array:
+                surf.P2P_block = {}
+            generateList(surf_array, field_array, param)
+        relax.lists.append([dict((name, getattr(surf, name)) for name in list_fields) for surf in surf_array])
+
+        print('Accuracy level %i: theta %.2f, P %i, error estimate %.2e'%(l, relax.theta[-1], relax.P[-1], relax.error[-1]))
+
+    param.theta = theta
+    relax.current = param.relax_levels
+    setLevel(surf_array, param, relax, 0)
+
+    return relax
+
+def setLevel(surf_array, param, relax, l):
+    # Makes accuracy level l of relax the one used by gmres_dot
+
+    if l==relax.current:
+        return
+    for s in range(len(surf_array)):
+        for name in list_fields:
+            setattr(surf_array[s], name, relax.lists[l][s][name])
+    param.theta = relax.theta[l]
+    param.P     = relax.P[l]
+    param.Nm    = (param.P+1)*(param.P+2)*(param.P+3)//6
+    relax.current = l
+
+def relaxedLevel(relax, rel_resid, param):
+    # Cheapest accuracy level for the next matvec. Inexact Krylov methods allow
+    # a matvec error that grows as 1/residual, so the error estimate of the level, 
+    # relative to level 0, can be up to relax_safety/rel_resid. Bounded by 
+    # relax_safety/param.tol, the error allowed when the solve converges
+
+    allowed = relax.error[0]*param.relax_safety/max(rel_resid, param.tol)
+    level = 0
+    for l in range(len(relax.error)):
+        if relax.error[l]<=allowed:
+            level = l
+    return level
+
+def gmres_solver (surf_array, field_array, X, b_clean, param, ind0, timing, kernel, tol=None, relax=None):
+    # tol: relative tolerance of this solve (default param.tol)
+    # relax: accuracyLevels from relaxLevels, to relax the treecode accuracy as the
+    # residual falls. Restarts and the final residual use full accuracy
+    # With param.precond=='near', the near-field preconditioner (computeNearPrecond)
+    # is applied on the right, so the residual is the same as without it
+
+    N = len(b_clean)
+    near = (param.precond=='near')
+    V, H = gmresWorkspace(N, param.restart, param.gmres_basis)
+
+#   Apply Preconditioner on RHS
+    b = precondRHS(surf_array, b_clean)
+
+    if tol is None:
+        tol = param.tol
+    matvec_0 = timing.Nmatvec
+
     time_Vi = 0.
     time_Vk = 0.
     time_rotation = 0.
@@ -94,19 +336,31 @@ def gmres_solver (surf_array, field_array, X, b_clean, param, ind0, timing, kern
 
     # Initializing varibles
     rel_resid = 1.
-    cs, sn = zeros(N), zeros(N)
+    cs, sn = zeros(param.restart), zeros(param.restart)
 
     iteration = 0
 
     b_norm = norm(b)
+    if relax is not None:
+        relax.Nmatvec = zeros(len(relax.error), dtype=int)
 
-    while (iteration < param.max_iter and rel_resid>=param.tol): # Outer iteration
+    while (iteration < param.max_iter and (rel_resid>=tol or relax is not None)): # Outer iteration
         
+        if relax is not None:
+            setLevel(surf_array, param, relax, 0)
+            ind0 = relax.ind[0]
         aux = gmres_dot(X, surf_array, field_array, ind0, param, timing, kernel)
         
         r = b - aux
         beta = norm(r)
 
+        if relax is not None and iteration>0:
+            # True residual after relaxed iterations
+            rel_resid = beta/b_norm
+            print('Full accuracy residual: %s'%rel_resid)
+            if rel_resid<tol:
+                break
+
         if iteration==0: 
             print('Analytical integrals: %i of %i, %i'%(timing.AI_int/param.N, param.N, 100*timing.AI_int/param.N**2)+'%')
 
@@ -125,29 +379,26 @@ def gmres_solver (surf_array, field_array, X, b_clean, param, ind0, timing, kern
             # Compute Vip1
             tic = time.time()
        
-            Vip1 = gmres_dot(V[i,:], surf_array, field_array, ind0, param, timing, kernel)
+            if relax is not None:
+                level = relaxedLevel(relax, rel_resid, param)
+                setLevel(surf_array, param, relax, level)
+                ind0 = relax.ind[level]
+                relax.Nmatvec[level] += 1
+            if near:
+                Vip1 = gmres_dot(precondNear(surf_array, V[i,:]), surf_array, field_array, ind0, param, timing, kernel)
+            else:
+                Vip1 = gmres_dot(V[i,:], surf_array, field_array, ind0, param, timing, kernel)
             toc = time.time()
             time_Vi+=toc-tic
     
-            if iteration<6:
+            if param.gmres_dump==1 and iteration<6:
                 savetxt('Vip1%i.txt'%iteration, Vip1)
 
             tic = time.time()
-            Vk = V[0:i+1,:]
-            H[0:i+1,i] = dot(Vip1,transpose(Vk))
-
-            # This ends up being slower than looping           
-#            HVk = H[0:i+1,i]*transpose(Vk)
-#            Vip1 -= HVk.sum(axis=1)
-
-            for k in range(i+1):
-                Vip1 -= H[k,i]*Vk[k] 
+            arnoldiStep(V, H, Vip1, i)
             toc = time.time()
             time_Vk+=toc-tic
 
-            H[i+1,i] = norm(Vip1)
-            V[i+1,:] = Vip1[:]/H[i+1,i]
-
             tic = time.time()
             H,cs,sn,s =  PlaneRotation(H, cs, sn, s, i, param.restart)
             toc = time.time()
@@ -161,23 +412,21 @@ def gmres_solver (surf_array, field_array, X, b_clean, param, ind0, timing, kern
 
             if (i+1==param.restart):
                 print('Residual: %f. Restart...'%rel_resid)
-            if rel_resid<=param.tol:
+            if rel_resid<=tol:
                 break
 
         # Solve the triangular system
         tic = time.time()
-        piv = arange(i+1)
-        y = lu_solve((H[0:i+1,0:i+1], piv), s[0:i+1], trans=0)
+        y = solve_triangular(H[0:i+1,0:i+1], s[0:i+1])
         toc = time.time()
         time_lu+=toc-tic
 
         # Update solution
         tic = time.time()
-        Vj = zeros(N)
-        for j in range(i+1):
-            # Compute Vj
-            Vj[:] = V[j,:]
-            X += y[j]*Vj
+        Vj = basisCombine(V, i+1, y)
+        if near:
+            Vj = precondNear(surf_array, Vj)
+        X += Vj
         toc = time.time()
         time_update+=toc-tic
 
@@ -187,8 +436,15 @@ def gmres_solver (surf_array, field_array, X, b_clean, param, ind0, timing, kern
 #    print('Time rotation: %fs'%time_rotation)
 #    print('Time lu      : %fs'%time_lu)
 #    print('Time update  : %fs'%time_update)
+    if relax is not None:
+        setLevel(surf_array, param, relax, 0)
+    timing.iterations = iteration
     print('GMRES solve')
     print('Converged after %i iterations to a residual of %s'%(iteration,rel_resid))
+    print('Matrix-vector products: %i'%(timing.Nmatvec-matvec_0))
+    if relax is not None:
+        print('Matrix-vector products per accuracy level: '+' '.join(['%i'%n for n in relax.Nmatvec]))
+    print('Peak memory       : %.1f MB'%(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3))
     print('Time weight vector: %f'%timing.time_mass)
     print('Time sort         : %f'%timing.time_sort)
     print('Time data transfer: %f'%timing.time_trans)
@@ -201,6 +457,305 @@ def gmres_solver (surf_array, field_array, X, b_clean, param, ind0, timing, kern
 
     return X
 
+def block_gmres_solver (surf_array, field_array, X, b_clean, param, ind0, timing, kernel, tol=None):
+    # Block GMRES for several right-hand sides with the same operator
+    # X, b_clean: (Nrhs,N) arrays, one right-hand side per row. Every product
+    # of the operator with a block of vectors goes through the treecode once.
+    # Restart length param.restart counts vectors, so blocks are restart/Nrhs.
+    # Right-hand sides that reach tol are removed from the block at restart.
+    # tol: relative tolerance of this solve (default param.tol)
+    # With param.precond=='near', the near-field preconditioner is applied on
+    # the right, as in gmres_solver
+
+    Nrhs, N = shape(b_clean)
+    near = (param.precond=='near')
+    b = precondRHS(surf_array, b_clean)
+    if tol is None:
+        tol = param.tol
+    matvec_0 = timing.Nmatvec
+
+    b_norm = norm(b, axis=1)
+    b_norm[b_norm==0] = 1.
+    rel_resid = zeros(Nrhs)
+    iteration = 0
+    active = arange(Nrhs)
+
+    while (iteration < param.max_iter and len(active)>0): # Outer iteration
+
+        R = b[active] - gmres_dot(X[active], surf_array, field_array, ind0, param, timing, kernel)
+        rel_resid[active] = norm(R, axis=1)/b_norm[active]
+
+        if iteration==0:
+            print('Analytical integrals: %i of %i, %i'%(timing.AI_int/param.N, param.N, 100*timing.AI_int/param.N**2)+'%')
+
+        unconverged = rel_resid[active]>=tol
+        active = active[unconverged]
+        R = R[unconverged]
+        if len(active)==0:
+            break
+        if iteration>0:
+            print('Residual: %f. Restart with %i right-hand sides...'%(rel_resid.max(), len(active)))
+
+        p = len(active)
+        m = max(1, param.restart//p)
+        V = zeros(((m+1)*p, N))
+        H = zeros(((m+1)*p, m*p))
+
+        # First block: R^T = Q*S
+        Q, S = qr(R.T, mode='economic')
+        V[0:p] = Q.T
+        E = zeros(((m+1)*p, p))
+        E[0:p] = S
+
+        i = -1
+        while (i+1<m and iteration+1<=param.max_iter): # Inner iteration
+            i += 1
+            iteration += 1
+
+            # Block Arnoldi step, block modified Gram-Schmidt
+            if near:
+                W = gmres_dot(precondNear(surf_array, V[i*p:(i+1)*p]), surf_array, field_array, ind0, param, timing, kernel)
+            else:
+                W = gmres_dot(V[i*p:(i+1)*p], surf_array, field_array, ind0, param, timing, kernel)
+            for k in range(i+1):
+                Hk = dot(V[k*p:(k+1)*p], W.T)
+                H[k*p:(k+1)*p, i*p:(i+1)*p] = Hk
+                W -= dot(Hk.T, V[k*p:(k+1)*p])
+            Q, Hn = qr(W.T, mode='economic')
+            V[(i+1)*p:(i+2)*p] = Q.T
+            H[(i+1)*p:(i+2)*p, i*p:(i+1)*p] = Hn
+
+            # Small least squares problem, residual of each right-hand side
+            j = (i+1)*p
+            Y = lstsq(H[0:j+p,0:j], E[0:j+p], rcond=None)[0]
+            rel_resid[active] = norm(E[0:j+p] - dot(H[0:j+p,0:j], Y), axis=0)/b_norm[active]
+            print('iteration: %i, rel resid: %s'%(iteration,rel_resid[active].max()))
+
+            if rel_resid[active].max()<=tol or abs(diag(Hn)).min()<1e-14*abs(S).max():
+                break
+
+        Vj = dot(Y.T, V[0:j])
+        if near:
+            Vj = precondNear(surf_array, Vj)
+        X[active] += Vj
+
+    print('Block GMRES solve, %i right-hand sides'%Nrhs)
+    print('Converged after %i iterations to a residual of %s'%(iteration,rel_resid.max()))
+    print('Block matrix-vector products: %i'%(timing.Nmatvec-matvec_0))
+    print('Time weight vector: %f'%timing.time_mass)
+    print('Time sort         : %f'%timing.time_sort)
+    print('Time data transfer: %f'%timing.time_trans)
+    print('Time P2M          : %f'%timing.time_P2M)
+    print('Time M2M          : %f'%timing.time_M2M)
+    print('Time M2P          : %f'%timing.time_M2P)
+    print('Time P2P          : %f'%timing.time_P2P)
+    print('\tTime analy: %f'%timing.time_an)
+
+    return X
+
+def harmonicRitz(G, WV, k):
+    # k harmonic Ritz vectors of smallest harmonic Ritz value, from the
+    # generalized eigenproblem G^T G z = theta G^T W^T V z (Parks et al. 2006)
+    # Complex conjugate pairs give their real and imaginary parts
+
+    theta, Z = eig(dot(G.T,G), dot(G.T,WV))
+    theta = where(isfinite(theta), abs(theta), inf)
+    order = argsort(theta)
+
+    P = []
+    for j in order:
+        if len(P)>=k or not isfinite(theta[j]):
+            break
+        P.append(real(Z[:,j]))
+        if abs(imag(Z[:,j])).max()>0 and len(P)<k:
+            P.append(imag(Z[:,j]))
+
+    P, R = qr(array(P).T, mode='economic')
+
+    return P
+
+def gcrodr_solver (surf_array, field_array, X, b_clean, param, ind0, timing, kernel, recycle, tol=None):
+    # GMRES with deflated restarting and Krylov subspace recycling (GCRO-DR)
+    # recycle: recycleSpace, keeps the subspace U between solves with the
+    #          same surf_array. The operator may change between solves (E_hat and
+    #          Precond in the Picard loop), so C=A*U is recomputed at the start.
+    # tol    : relative tolerance of this solve (default param.tol)
+    # With param.precond=='near', the near-field preconditioner M is applied on
+    # the right: the Krylov and recycled subspaces are those of A*M^-1, and the
+    # corrections of X are multiplied by M^-1
+
+    N = len(b_clean)
+    near = (param.precond=='near')
+    b = precondRHS(surf_array, b_clean)
+    if tol is None:
+        tol = param.tol
+
+    k = recycle.k
+    m = max(param.restart, k+1)
+    b_norm = norm(b)
+    iteration = 0
+    matvec_0 = timing.Nmatvec
+
+    r = b - gmres_dot(X, surf_array, field_array, ind0, param, timing, kernel)
+
+    print('Analytical integrals: %i of %i, %i'%(timing.AI_int/param.N, param.N, 100*timing.AI_int/param.N**2)+'%')
+
+    U = zeros((0,N))
+    C = zeros((0,N))
+    rel_resid = norm(r)/b_norm
+    if rel_resid<tol:   # Initial guess is good enough, keep subspace for next solve
+        U = recycle.U
+    elif len(recycle.U)>0 and shape(recycle.U)[1]==N:
+        # Recycled subspace: C = A*U, with orthonormal C
+        U = recycle.U
+        C = zeros(shape(U))
+        for j in range(len(U)):
+            if near:
+                C[j] = gmres_dot(precondNear(surf_array, U[j]), surf_array, field_array, ind0, param, timing, kernel)
+            else:
+                C[j] = gmres_dot(U[j], surf_array, field_array, ind0, param, timing, kernel)
+        Q, R = qr(C.T, mode='economic')
+        C = Q.T
+        U = solve_triangular(R, U, trans=1)
+
+        y = dot(C, r)
+        if near:
+            X += precondNear(surf_array, dot(y, U))
+        else:
+            X += dot(y, U)
+        r -= dot(y, C)
+        rel_resid = norm(r)/b_norm
+
+    print('Recycled subspace: %i vectors, rel resid: %s'%(len(U), rel_resid))
+
+    while (iteration < param.max_iter and rel_resid>=tol): # Outer iteration
+
+        kk = len(C)
+        mk = m - kk
+        V = zeros((mk+1, N))
+        H = zeros((mk+1, mk))
+        Hr = zeros((mk+1, mk))
+        B = zeros((kk, mk))
+        cs, sn = zeros(mk), zeros(mk)
+
+        beta = norm(r)
+        V[0,:] = r/beta
+        s = zeros(mk+1)
+        s[0] = beta
+        i = -1
+
+        while (i+1<mk and iteration+1<=param.max_iter): # Inner iteration
+            i += 1
+            iteration += 1
+
+            # Arnoldi with (I-C*C^T)*A
+            if near:
+                Vip1 = gmres_dot(precondNear(surf_array, V[i,:]), surf_array, field_array, ind0, param, timing, kernel)
+            else:
+                Vip1 = gmres_dot(V[i,:], surf_array, field_array, ind0, param, timing, kernel)
+            B[:,i] = dot(C, Vip1)
+            Vip1 -= dot(B[:,i], C)
+            H[0:i+1,i] = dot(V[0:i+1,:], Vip1)
+            Vip1 -= dot(H[0:i+1,i], V[0:i+1,:])
+            H[i+1,i] = norm(Vip1)
+            V[i+1,:] = Vip1/H[i+1,i]
+
+            # Givens rotations on a copy of H, which is kept for the harmonic Ritz problem
+            Hr[0:i+2,i] = H[0:i+2,i]
+            Hr, cs, sn, s = PlaneRotation(Hr, cs, sn, s, i, mk)
+
+            rel_resid = abs(s[i+1])/b_norm
+            print('iteration: %i, rel resid: %s'%(iteration,rel_resid))
+
+            if rel_resid<=tol:
+                break
+
+        # Minimize ||beta*e1 - H*y||. The recycled part cancels B*y: x += V*y - U*B*y
+        j = i+1
+        y = solve_triangular(Hr[0:j,0:j], s[0:j])
+        Vj = dot(y, V[0:j,:])
+        if kk>0:
+            Vj -= dot(dot(B[:,0:j], y), U)
+        if near:
+            Vj = precondNear(surf_array, Vj)
+        X += Vj
+        r -= dot(dot(H[0:j+1,0:j], y), V[0:j+1,:])
+
+        # New recycled subspace from the harmonic Ritz vectors of this cycle
+        if k>0:
+            D  = 1/norm(U, axis=1)
+            Ut = U*D[:,newaxis]         # Scaled U, so A*Ut = C*diag(D)
+            G = zeros((kk+j+1, kk+j))
+            G[0:kk,0:kk] = diag(D)
+            G[0:kk,kk:]  = B[:,0:j]
+            G[kk:,kk:]   = H[0:j+1,0:j]
+            WV = zeros((kk+j+1, kk+j))  # [C;V]*[Ut;V]^T
+            WV[0:kk,0:kk] = dot(C, Ut.T)
+            WV[kk:,0:kk]  = dot(V[0:j+1,:], Ut.T)
+            WV[kk:,kk:]   = eye(j+1, j)
+
+            P = harmonicRitz(G, WV, min(k, kk+j))
+            Q, R = qr(dot(G, P), mode='economic')
+            W = concatenate((C, V[0:j+1,:]))
+            Vh = concatenate((Ut, V[0:j,:]))
+            C = dot(Q.T, W)
+            U = solve_triangular(R, dot(P.T, Vh), trans=1)
+
+        if rel_resid>=tol and iteration<param.max_iter:
+            print('Residual: %f. Restart...'%rel_resid)
+
+    recycle.U = U
+    recycle.Nsolve += 1
+
+    print('GCRO-DR solve')
+    print('Converged after %i iterations to a residual of %s'%(iteration,rel_resid))
+    print('Matrix-vector products: %i'%(timing.Nmatvec-matvec_0))
+    print('Time weight vector: %f'%timing.time_mass)
+    print('Time sort         : %f'%timing.time_sort)
+    print('Time data transfer: %f'%timing.time_trans)
+    print('Time P2M          : %f'%timing.time_P2M)
+    print('Time M2M          : %f'%timing.time_M2M)
+    print('Time M2P          : %f'%timing.time_M2P)
+    print('Time P2P          : %f'%timing.time_P2P)
+    print('\tTime analy: %f'%timing.time_an)
+
+    return X
+
+def andersonMix(x, g, hist):
+    # Anderson acceleration of the fixed point iteration x = G(x), with g = G(x)
+    # hist: andersonHistory, keeps the differences of the last hist.depth steps
+    # Safeguard: if the residual grows, the history is cleared and the step is
+    # a (damped) Picard step.
+
+    f = g - x
+    f_norm = norm(f)
+
+    if len(hist.x_old)>0:
+        if f_norm>hist.f_norm:
+            print('Anderson: residual increased, history cleared')
+            hist.dX = []
+            hist.dF = []
+        else:
+            hist.dX.append(x - hist.x_old)
+            hist.dF.append(f - hist.f_old)
+            if len(hist.dX)>hist.depth:
+                hist.dX.pop(0)
+                hist.dF.pop(0)
+
+    hist.x_old  = x.copy()
+    hist.f_old  = f.copy()
+    hist.f_norm = f_norm
+
+    if len(hist.dF)==0:
+        return x + hist.beta*f
+
+    dX = array(hist.dX)
+    dF = array(hist.dF)
+    gamma = lstsq(dF.T, f, rcond=1e-10)[0]
+    print('Anderson: %i previous steps, coefficients %s'%(len(gamma), gamma))
+
+    return x - dot(gamma, dX) + hist.beta*(f - dot(gamma, dF))
+
 def gmres_sigma (surf, ss, X, b, param, ind0, timing, kernel):
 
     N = len(b)
@@ -215,7 +770,7 @@ def gmres_sigma (surf, ss, X, b, param, ind0, timing, kernel):
 
     # Initializing varibles
     rel_resid = 1.
-    cs, sn = zeros(N), zeros(N)
+    cs, sn = zeros(param.restart), zeros(param.restart)
 
     iteration = 0
 
@@ -253,25 +808,14 @@ def gmres_sigma (surf, ss, X, b, param, ind0, timing, kernel):
             toc = time.time()
             time_Vi+=toc-tic
     
-            if iteration<6:
+            if param.gmres_dump==1 and iteration<6:
                 savetxt('Vip1%i.txt'%iteration, Vip1)
 
             tic = time.time()
-            Vk = V[0:i+1,:]
-            H[0:i+1,i] = dot(Vip1,transpose(Vk))
-
-            # This ends up being slower than looping           
-#            HVk = H[0:i+1,i]*transpose(Vk)
-#            Vip1 -= HVk.sum(axis=1)
-
-            for k in range(i+1):
-                Vip1 -= H[k,i]*Vk[k] 
+            arnoldiStep(V, H, Vip1, i)
             toc = time.time()
             time_Vk+=toc-tic
 
-            H[i+1,i] = norm(Vip1)
-            V[i+1,:] = Vip1[:]/H[i+1,i]
-
             tic = time.time()
             H,cs,sn,s =  PlaneRotation(H, cs, sn, s, i, param.restart)
             toc = time.time()
@@ -290,18 +834,13 @@ def gmres_sigma (surf, ss, X, b, param, ind0, timing, kernel):
 
         # Solve the triangular system
         tic = time.time()
-        piv = arange(i+1)
-        y = lu_solve((H[0:i+1,0:i+1], piv), s[0:i+1], trans=0)
+        y = solve_triangular(H[0:i+1,0:i+1], s[0:i+1])
         toc = time.time()
         time_lu+=toc-tic
 
         # Update solution
         tic = time.time()
-        Vj = zeros(N)
-        for j in range(i+1):
-            # Compute Vj
-            Vj[:] = V[j,:]
-            X += y[j]*Vj
+        X += dot(y, V[0:i+1])
         toc = time.time()
         time_update+=toc-tic
 
@@ -21,30 +21,25 @@
   THE SOFTWARE.
 '''
 
+import time
+from session            import Session     # first, so startup time counts from its import
+
 from numpy 			import *
 from math  			import pi
 from scipy.misc     import factorial
 import argparse
-import time
+import os
 
 # Import self made modules
 import sys 
-from gmres			    import gmres_solver    
 from projection         import get_phir
-from classes            import surfaces, timings, parameters, index_constant, fill_surface, initializeSurf, initializeField, dataTransfer, fill_phi
-from output             import printSummary
-from matrixfree         import generateRHS, generateRHS_gpu, calculateEsolv, coulombEnergy, calculateEsurf
+from matrixfree         import calculateEsolv, coulombEnergy, calculateEsurf
 
 sys.path.append('../util')
-from readData        import readVertex, readTriangle, readpqr, readParameters
 from triangulation 	 import *
 from an_solution     import an_P, two_sphere
 from semi_analytical import *
 
-sys.path.append('tree')
-from FMMutils       import *
-from cuda_kernels   import kernels
-
 # import modules for testing
 #from mpl_toolkits.mplot3d import Axes3D
 #import matplotlib.pyplot as plt
@@ -55,6 +50,12 @@ parser = argparse.ArgumentParser(description='To run: ./main.py parameter_file c
 parser.add_argument('parameter_file', help='Parameter file, see input_files/file.param for format details')
 parser.add_argument('config_file', help='Configuration file, see input_files/file.config for format details')
 parser.add_argument('--asymmetric', help='Activates nonlinear BCs and Picard iteration to consider asymmetric charging energy', action='store_true')
+parser.add_argument('--cache', help='Read and write the on-disk setup cache (as cache 1 in the parameter file)', action='store_true')
+parser.add_argument('--no-cache', help='Do not read or write the on-disk setup cache, even with cache 1 in the parameter file', action='store_true')
+parser.add_argument('--clear-cache', help='Empty the on-disk setup cache before running', action='store_true')
+parser.add_argument('--coarse', help='Config file with coarser meshes of the same surfaces. Its solution is the initial guess of the fine solve', default=None)
+parser.add_argument('--coarse-tol', help='GMRES tolerance of the coarse solve', type=float, default=1e-3)
+parser.add_argument('--charges', help='Solve for each of these charge files (.pqr or .crd) on the same geometry with block GMRES. They replace the charges of the charged region in the config file', nargs='+', default=[])
 
 args = parser.parse_args()
 
@@ -67,110 +68,55 @@ print('\tDate: %i/%i/%i'%(timestamp.tm_year,timestamp.tm_mon,timestamp.tm_mday))
 print('\tTime: %i:%i:%i'%(timestamp.tm_hour,timestamp.tm_min,timestamp.tm_sec))
 
 TIC = time.time()
-### Read parameters
-param = parameters()
-precision = readParameters(param, args.parameter_file)
-configFile = args.config_file
-
-param.Nm            = (param.P+1)*(param.P+2)*(param.P+3)/6     # Number of terms in Taylor expansion
-param.BlocksPerTwig = int(ceil(param.NCRIT/float(param.BSZ)))   # CUDA blocks that fit per twig
-
-### Generate array of fields
-field_array = initializeField(configFile, param)
-
-### Generate array of surfaces and read in elements
-surf_array = initializeSurf(field_array, configFile, param)
-
-### Fill surface class
-time_sort = 0.
-for i in range(len(surf_array)):
-    time_sort += fill_surface(surf_array[i], param)
-
-'''
-fig = plt.figure()
-ax = Axes3D(fig)
-#ss=surf_array[0]
-for i in range(1):
-    ss = surf_array[i]
-    ax.scatter(ss.xi,ss.yi,ss.zi,c='b',marker='o')
-    ax.scatter(ss.xi+ss.normal[:,0], ss.yi+ss.normal[:,1], ss.zi+ss.normal[:,2],c='r', marker='o')
-plt.show()
-quit()
-'''
-
-### Output setup summary
-param.N   = 0
-param.Neq = 0
-for s in surf_array:
-    N_aux = len(s.triangle)
-    param.N += N_aux
-    if s.surf_type == 'dirichlet_surface' or s.surf_type == 'neumann_surface' or s.surf_type == 'asc_surface':
-        param.Neq += N_aux
-    else:
-        param.Neq += 2*N_aux
-print('\nTotal elements : %i'%param.N)
-print('Total equations: %i'%param.Neq)
-
-printSummary(surf_array, field_array, param)
-
-### Precomputation
-ind0 = index_constant()
-computeIndices(param.P, ind0)
-precomputeTerms(param.P, ind0)
-
-### Load CUDA code
-kernel = kernels(param.BSZ, param.Nm, param.K_fine, param.P, precision)
-
-### Generate interaction list
-print('Generate interaction list')
-tic = time.time()
-generateList(surf_array, field_array, param)
-toc = time.time()
-list_time = toc-tic
-
-### Transfer data to GPU
-print('Transfer data to GPU')
-tic = time.time()
-if param.GPU==1:
-    dataTransfer(surf_array, field_array, ind0, param, kernel)
-toc = time.time()
-transfer_time = toc-tic
-
-timing = timings()
-
-### Generate RHS
-print('Generate RHS')
-tic = time.time()
-if param.GPU==0:
-    F = generateRHS(field_array, surf_array, param, kernel, timing, ind0)
-elif param.GPU==1:
-    F = generateRHS_gpu(field_array, surf_array, param, kernel, timing, ind0)
-toc = time.time()
-rhs_time = toc-tic
-
-savetxt('RHS.txt',F)
-
-setup_time = toc-TIC
-print('List time          : %fs'%list_time)
-print('Data transfer time : %fs'%transfer_time)
-print('RHS generation time: %fs'%rhs_time)
-print('------------------------------')
-print('Total setup time   : %fs\n'%setup_time)
-
-tic = time.time()
+cache = None                                # cache option of the parameter file
+if args.cache:
+    cache = True
+if args.no_cache:
+    cache = False
+
+### Setup: read input files, fill surfaces (or load them from the setup cache),
+### interaction lists, CUDA kernels and preconditioners
+run = Session(args.parameter_file, args.config_file, cache=cache, clear_cache=args.clear_cache,
+              relax=len(args.charges)==0)    # block GMRES does not relax the treecode
+param       = run.param
+field_array = run.field_array
+surf_array  = run.surf_array
+kernel      = run.kernel
+
+### Coarse-mesh solve for the initial guess
+if args.coarse is not None and len(args.charges)>0:
+    print('--coarse is not used with --charges, starting from zero')
+elif args.coarse is not None:
+    run.coarseGuess(args.coarse, args.coarse_tol)
 
 ### Solve
 print('Solve')
-phi = zeros(param.Neq)
-phi = gmres_solver(surf_array, field_array, phi, F, param, ind0, timing, kernel) 
+tic = time.time()
+if len(args.charges)>0:
+#   One RHS per charge set, solved together. Geometry, trees and lists are shared
+    try:
+        run.chargedRegion()
+    except ValueError as e:
+        print('--'+str(e))
+        sys.exit(1)
+    phi, E_sets = run.solveCharges(args.charges)
+else:
+    phi = run.solve()
 toc = time.time()
 solve_time = toc-tic
 print('Solve time        : %fs'%solve_time)
+savetxt('RHS.txt',run.F)
 savetxt('phi.txt',phi)
 #phi = loadtxt('phi.txt')
 
-# Put result phi in corresponding surfaces
-fill_phi(phi, surf_array)
+if len(args.charges)>0:
+#   Esolv and Ecoul of every charge set, then done
+    print('\n--------------------------------')
+    print('Totals per charge set:')
+    for c in range(len(args.charges)):
+        print('%s: Esolv = %f kcal/mol, Ecoul = %f kcal/mol'%(args.charges[c], sum(E_sets[c]['Esolv']), sum(E_sets[c]['Ecoul'])))
+    print('\nTime = %f s'%(time.time()-TIC))
+    sys.exit(0)
 
 ### Calculate solvation energy
 print('\nCalculate Esolv')
@@ -21,30 +21,27 @@
   THE SOFTWARE.
 '''
 
+import time
+from session            import Session     # first, so startup time counts from its import
+
 from numpy 			import *
 from math  			import pi
 from scipy.special import factorial
 import argparse
-import time
+import os
 
 # Import self made modules
 import sys 
-from gmres			    import gmres_solver, gmres_sigma
+from gmres			    import gmres_solver, gmres_sigma, gcrodr_solver, andersonMix, computeNearPrecond
 from projection         import get_phir
-from classes            import surfaces, timings, parameters, index_constant, fill_surface, initializeSurf, initializeField, dataTransfer, fill_phi, computePrecond
-from output             import printSummary
-from matrixfree         import generateRHS, generateRHS_gpu, calculateEsolv, coulombEnergy, calculateEsurf, selfExterior, selfInterior, computeNormalElectricField
+from classes            import recycleSpace, andersonHistory, fill_phi, computePrecond
+from matrixfree         import calculateEsolv, coulombEnergy, calculateEsurf, selfExterior, selfInterior, computeNormalElectricField
 
 sys.path.append('../util')
-from readData        import readVertex, readTriangle, readpqr, readParameters
 from triangulation 	 import *
 from an_solution     import an_P, two_sphere
 from semi_analytical import *
 
-sys.path.append('tree')
-from FMMutils       import *
-from cuda_kernels   import kernels
-
 # import modules for testing
 #from mpl_toolkits.mplot3d import Axes3D
 #import matplotlib.pyplot as plt
@@ -54,7 +51,14 @@ parser = argparse.ArgumentParser(description='PyGBe: Python GPU code for boundar
 parser.add_argument('parameter_file', help='Parameter file, see input_files/file.param for format details')
 parser.add_argument('config_file', help='Configuration file, see input_files/file.config for format details')
 parser.add_argument('--asymmetric', help='Activates nonlinear BCs and Picard iteration to consider asymmetric charging energy', action='store_true')
+parser.add_argument('--cache', help='Read and write the on-disk setup cache (as cache 1 in the parameter file)', action='store_true')
+parser.add_argument('--no-cache', help='Do not read or write the on-disk setup cache, even with cache 1 in the parameter file', action='store_true')
+parser.add_argument('--clear-cache', help='Empty the on-disk setup cache before running', action='store_true')
 parser.add_argument('--chargeForm', help='Use apparent surface charge to compute the normal electric field', action='store_true')
+parser.add_argument('--recycle', help='Solve with GCRO-DR, recycling this many Krylov vectors between Picard iterations', type=int, default=0)
+parser.add_argument('--warm-start', help='Relax the GMRES tolerance in early Picard iterations (start is the previous phi)', action='store_true')
+parser.add_argument('--anderson', help='Anderson acceleration of the Picard iteration, keeping this many previous steps', type=int, default=0)
+parser.add_argument('--anderson-damping', help='Damping of the Anderson update (1: undamped)', type=float, default=1.)
 
 args = parser.parse_args()
 
@@ -65,97 +69,35 @@ print('\tDate: %i/%i/%i'%(timestamp.tm_year,timestamp.tm_mon,timestamp.tm_mday))
 print('\tTime: %i:%i:%i'%(timestamp.tm_hour,timestamp.tm_min,timestamp.tm_sec))
 
 TIC = time.time()
-### Read parameters
-param = parameters()
-precision = readParameters(param, args.parameter_file)
-configFile = args.config_file
-
-param.Nm            = (param.P+1)*(param.P+2)*(param.P+3)//6     # Number of terms in Taylor expansion
-param.BlocksPerTwig = int(ceil(param.NCRIT/float(param.BSZ)))   # CUDA blocks that fit per twig
-
-### Generate array of fields
-field_array = initializeField(configFile, param)
-
-### Generate array of surfaces and read in elements
-surf_array = initializeSurf(field_array, configFile, param)
-
-### Fill surface class
-time_sort = 0.
-for i in range(len(surf_array)):
-    time_sort += fill_surface(surf_array[i], param)
-
-'''
-fig = plt.figure()
-ax = Axes3D(fig)
-#ss=surf_array[0]
-for i in range(1):
-    ss = surf_array[i]
-    ax.scatter(ss.xi,ss.yi,ss.zi,c='b',marker='o')
-    ax.scatter(ss.xi+ss.normal[:,0], ss.yi+ss.normal[:,1], ss.zi+ss.normal[:,2],c='r', marker='o')
-plt.show()
-quit()
-'''
-
-### Output setup summary
-param.N   = 0
-param.Neq = 0
-for s in surf_array:
-    N_aux = len(s.triangle)
-    param.N += N_aux
-    if s.surf_type == 'dirichlet_surface' or s.surf_type == 'neumann_surface' or s.surf_type == 'asc_surface':
-        param.Neq += N_aux
-    else:
-        param.Neq += 2*N_aux
-print('\nTotal elements : %i'%param.N)
-print('Total equations: %i'%param.Neq)
-
-printSummary(surf_array, field_array, param)
-
-### Precomputation
-ind0 = index_constant()
-computeIndices(param.P, ind0)
-precomputeTerms(param.P, ind0)
-
-### Load CUDA code
-kernel = kernels(param.BSZ, param.Nm, param.K_fine, param.P, precision)
-
-### Generate interaction list
-print('Generate interaction list')
-tic = time.time()
-generateList(surf_array, field_array, param)
-toc = time.time()
-list_time = toc-tic
-
-### Transfer data to GPU
-print('Transfer data to GPU')
-tic = time.time()
-if param.GPU==1:
-    dataTransfer(surf_array, field_array, ind0, param, kernel)
-toc = time.time()
-transfer_time = toc-tic
-
-timing = timings()
+cache = None                                # cache option of the parameter file
+if args.cache:
+    cache = True
+if args.no_cache:
+    cache = False
+
+### Setup: read input files, fill surfaces (or load them from the setup cache),
+### interaction lists and CUDA kernels. The near-field preconditioner is 
+### computed in each Picard iteration
+run = Session(args.parameter_file, args.config_file, cache=cache, clear_cache=args.clear_cache, near=False,
+              relax=args.recycle==0)        # GCRO-DR does not relax the treecode
+param       = run.param
+field_array = run.field_array
+surf_array  = run.surf_array
+kernel      = run.kernel
+ind0        = run.ind0
+relax       = run.relax
+timing      = run.timing
 
 ### Generate RHS
 print('Generate RHS')
 tic = time.time()
-if param.GPU==0:
-    F = generateRHS(field_array, surf_array, param, kernel, timing, ind0)
-elif param.GPU==1:
-    F = generateRHS_gpu(field_array, surf_array, param, kernel, timing, ind0)
+F = run.rhs()
 toc = time.time()
-rhs_time = toc-tic
-
+print('RHS generation time: %fs'%(toc-tic))
 savetxt('RHS.txt',F)
 
-setup_time = toc-TIC
-print('List time          : %fs'%list_time)
-print('Data transfer time : %fs'%transfer_time)
-print('RHS generation time: %fs'%rhs_time)
-print('------------------------------')
-print('Total setup time   : %fs\n'%setup_time)
-
 tic = time.time()
+run.startup()
 
 ### Solve
 print('Solve')
@@ -182,6 +124,15 @@ if args.asymmetric == True:
     print('Asymmetric parameters:')
     print('alpha: %f, beta: %f, gamma: %f'%(alpha, beta, gamma))
     print('Picard: \n\tmax iter: %i\ntolerance: %f'%(Npicard, tol_picard))
+    if args.recycle>0:
+        print('GCRO-DR recycling %i vectors'%args.recycle)
+    if args.warm_start:
+        print('Warm start with relaxed GMRES tolerance')
+    if args.anderson>0:
+        print('Anderson acceleration: depth %i, damping %f'%(args.anderson, args.anderson_damping))
+
+recycle  = recycleSpace(args.recycle)
+anderson = andersonHistory(args.anderson, args.anderson_damping)
 
 picardIter = 0
 phi_L2error = 1.
@@ -277,11 +228,31 @@ while phi_L2error>tol_picard and picardIter<Npicard:
             computePrecond(s)
 
 
+    # Solution of previous Picard iteration is the initial guess. With --warm-start,
+    # early iterations are solved loosely, down to param.tol as Picard converges
+    tol = param.tol
+    if args.asymmetric == True and args.warm_start:
+        tol = max(param.tol, 1e-2*phi_L2error)
+
+#   Near-field preconditioner follows Precond and E_hat of this iteration
+    if param.precond=='near':
+        computeNearPrecond(surf_array, param)
+
     print('Solve for phi...')
     phi_old = phi.copy()    
-    phi = gmres_solver(surf_array, field_array, phi, F, param, ind0, timing, kernel) 
+    if args.recycle>0:
+        phi = gcrodr_solver(surf_array, field_array, phi, F, param, ind0, timing, kernel, recycle, tol) 
+    else:
+        phi = gmres_solver(surf_array, field_array, phi, F, param, ind0, timing, kernel, tol, relax) 
     
     phi_L2error = sqrt(sum((phi_old-phi)**2)/sum(phi**2))
+    if args.asymmetric == True:
+        print('Picard iteration %i: residual %s, matrix-vector products %i'%(picardIter, phi_L2error, timing.Nmatvec))
+
+#   Next iterate: phi from this solve, or the Anderson update from the previous ones.
+#   The converged solution is always the output of a solve.
+    if args.asymmetric == True and args.anderson>0 and phi_L2error>tol_picard and picardIter+1<Npicard:
+        phi = andersonMix(phi_old, phi, anderson)
 
 #   Put result phi in corresponding surfaces
     fill_phi(phi, surf_array)
@@ -290,8 +261,10 @@ while phi_L2error>tol_picard and picardIter<Npicard:
     picardIter += 1
 
 if picardIter<Npicard:
-    print('Reached Picard tolerance of %1.4f' % picardIter)
+    print('Reached Picard tolerance of %1.4f after %i iterations'%(tol_picard, picardIter))
     print('Error: '+str(phi_L2error))
+if args.asymmetric == True:
+    print('Picard iterations: %i, total matrix-vector products: %i'%(picardIter, timing.Nmatvec))
     
 
 toc = time.time()
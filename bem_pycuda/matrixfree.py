@@ -25,15 +25,15 @@ import sys
 sys.path.append('tree')
 from FMMutils import *
 from projection import project, project_Kt, get_phir, get_phir_gpu
-from classes import parameters, index_constant
+from classes import parameters, index_constant, timings
 import time
 sys.path.append('../util')
 from semi_analytical import GQ_1D
 from direct import coulomb_direct
+from charges import surfaceChargeField, chargeSelfField
 
-# PyCUDA libraries
-import pycuda.autoinit
-import pycuda.gpuarray as gpuarray
+# PyCUDA libraries, loaded on first use by the GPU backend
+from backend import gpuarray
 
 ## Note: 
 ##  Remember ordering of equations:
@@ -85,36 +85,42 @@ def selfASC(surf, src, tar, LorY, param, ind0, timing, kernel):
     Kt_diag = -2*pi * (surf.Eout+surf.Ein)/(surf.Eout-surf.Ein)
     V_diag = 0
     
-    Kt_lyr = project_Kt(surf.XinK, LorY, surf, surf, 
-                            Kt_diag, src, param, ind0, timing, kernel)
+    if ndim(surf.XinK)==2:   # Several right-hand sides, one at a time
+        Kt_lyr = array([project_Kt(XK, LorY, surf, surf, Kt_diag, src, param, ind0, timing, kernel)
+                        for XK in surf.XinK])
+    else:
+        Kt_lyr = project_Kt(surf.XinK, LorY, surf, surf, 
+                                Kt_diag, src, param, ind0, timing, kernel)
     
     v = -Kt_lyr
     return v
 
 def gmres_dot (X, surf_array, field_array, ind0, param, timing, kernel):
     
+    timing.Nmatvec += 1
     Nfield = len(field_array)
     Nsurf = len(surf_array)
 
 #   Place weights on corresponding surfaces and allocate memory
+#   X may hold several right-hand sides as rows, (Nrhs,Neq)
     Naux = 0
     for i in range(Nsurf):
         N = len(surf_array[i].triangle)
         if surf_array[i].surf_type=='dirichlet_surface':
-            surf_array[i].XinK = zeros(N) 
-            surf_array[i].XinV = X[Naux:Naux+N] 
+            surf_array[i].XinK = zeros(shape(X)[:-1]+(N,)) 
+            surf_array[i].XinV = X[...,Naux:Naux+N] 
             Naux += N
         elif surf_array[i].surf_type=='neumann_surface' or surf_array[i].surf_type=='asc_surface':
-            surf_array[i].XinK = X[Naux:Naux+N] 
-            surf_array[i].XinV = zeros(N)
+            surf_array[i].XinK = X[...,Naux:Naux+N] 
+            surf_array[i].XinV = zeros(shape(X)[:-1]+(N,))
             Naux += N
         else:
-            surf_array[i].XinK     = X[Naux:Naux+N]
-            surf_array[i].XinV     = X[Naux+N:Naux+2*N]
+            surf_array[i].XinK     = X[...,Naux:Naux+N]
+            surf_array[i].XinV     = X[...,Naux+N:Naux+2*N]
             Naux += 2*N 
 
-        surf_array[i].Xout_int = zeros(N) 
-        surf_array[i].Xout_ext = zeros(N)
+        surf_array[i].Xout_int = zeros(shape(X)[:-1]+(N,)) 
+        surf_array[i].Xout_ext = zeros(shape(X)[:-1]+(N,))
 
 #   Loop over fields
     for F in range(Nfield):
@@ -167,22 +173,22 @@ def gmres_dot (X, surf_array, field_array, ind0, param, timing, kernel):
                     surf_array[c].Xout_ext += v
      
 #   Gather results into the result vector
-    MV = zeros(len(X))
+    MV = zeros(shape(X))
     Naux = 0
     for i in range(Nsurf):
         N = len(surf_array[i].triangle)
         if surf_array[i].surf_type=='dirichlet_surface':
-            MV[Naux:Naux+N]     = surf_array[i].Xout_ext*surf_array[i].Precond[0,:] 
+            MV[...,Naux:Naux+N]     = surf_array[i].Xout_ext*surf_array[i].Precond[0,:] 
             Naux += N
         elif surf_array[i].surf_type=='neumann_surface':
-            MV[Naux:Naux+N]     = surf_array[i].Xout_ext*surf_array[i].Precond[0,:] 
+            MV[...,Naux:Naux+N]     = surf_array[i].Xout_ext*surf_array[i].Precond[0,:] 
             Naux += N
         elif surf_array[i].surf_type=='asc_surface':
-            MV[Naux:Naux+N]     = surf_array[i].Xout_int*surf_array[i].Precond[0,:] 
+            MV[...,Naux:Naux+N]     = surf_array[i].Xout_int*surf_array[i].Precond[0,:] 
             Naux += N
         else:
-            MV[Naux:Naux+N]     = surf_array[i].Xout_int*surf_array[i].Precond[0,:] + surf_array[i].Xout_ext*surf_array[i].Precond[1,:] 
-            MV[Naux+N:Naux+2*N] = surf_array[i].Xout_int*surf_array[i].Precond[2,:] + surf_array[i].Xout_ext*surf_array[i].Precond[3,:] 
+            MV[...,Naux:Naux+N]     = surf_array[i].Xout_int*surf_array[i].Precond[0,:] + surf_array[i].Xout_ext*surf_array[i].Precond[1,:] 
+            MV[...,Naux+N:Naux+2*N] = surf_array[i].Xout_int*surf_array[i].Precond[2,:] + surf_array[i].Xout_ext*surf_array[i].Precond[3,:] 
             Naux += 2*N
 
     return MV
@@ -206,19 +212,14 @@ def generateRHS(field_array, surf_array, param, kernel, timing, ind0):
 
                 s_size = len(surf_array[s].xi)
 
-                aux = zeros(len(surf_array[s].xi))
-                for i in range(Nq):
-                    dx_pq = surf_array[s].xi - field_array[j].xq[i,0] 
-                    dy_pq = surf_array[s].yi - field_array[j].xq[i,1]
-                    dz_pq = surf_array[s].zi - field_array[j].xq[i,2]
-                    R_pq = sqrt(dx_pq*dx_pq + dy_pq*dy_pq + dz_pq*dz_pq)
-
-                    if surf_array[s].surf_type=='asc_surface':
-                        aux -= field_array[j].q[i]/(R_pq*R_pq*R_pq) * (dx_pq*surf_array[s].normal[:,0] \
-                                                                    + dy_pq*surf_array[s].normal[:,1] \
-                                                                    + dz_pq*surf_array[s].normal[:,2])
-                    else:
-                        aux += field_array[j].q[i]/(field_array[j].E*R_pq)
+                if surf_array[s].surf_type=='asc_surface':
+                    phi_q, dphi_q = surfaceChargeField(surf_array[s], field_array[j], 1, param)
+                    aux = dphi_q[0]*surf_array[s].normal[:,0] \
+                        + dphi_q[1]*surf_array[s].normal[:,1] \
+                        + dphi_q[2]*surf_array[s].normal[:,2]
+                else:
+                    phi_q, dphi_q = surfaceChargeField(surf_array[s], field_array[j], 0, param)
+                    aux = phi_q/field_array[j].E
 
 #               For CHILD surfaces, q contributes to RHS in 
 #               EXTERIOR equation (hence Precond[1,:] and [3,:])
@@ -254,19 +255,14 @@ def generateRHS(field_array, surf_array, param, kernel, timing, ind0):
 
                 s_size = len(surf_array[s].xi)
 
-                aux = zeros(len(surf_array[s].xi))
-                for i in range(Nq):
-                    dx_pq = surf_array[s].xi - field_array[j].xq[i,0] 
-                    dy_pq = surf_array[s].yi - field_array[j].xq[i,1]
-                    dz_pq = surf_array[s].zi - field_array[j].xq[i,2]
-                    R_pq = sqrt(dx_pq*dx_pq + dy_pq*dy_pq + dz_pq*dz_pq)
-
-                    if surf_array[s].surf_type=='asc_surface':
-                        aux -= field_array[j].q[i]/(R_pq*R_pq*R_pq) * (dx_pq*surf_array[s].normal[:,0] \
-                                                                    + dy_pq*surf_array[s].normal[:,1] \
-                                                                    + dz_pq*surf_array[s].normal[:,2])
-                    else:
-                        aux += field_array[j].q[i]/(field_array[j].E*R_pq)
+                if surf_array[s].surf_type=='asc_surface':
+                    phi_q, dphi_q = surfaceChargeField(surf_array[s], field_array[j], 1, param)
+                    aux = dphi_q[0]*surf_array[s].normal[:,0] \
+                        + dphi_q[1]*surf_array[s].normal[:,1] \
+                        + dphi_q[2]*surf_array[s].normal[:,2]
+                else:
+                    phi_q, dphi_q = surfaceChargeField(surf_array[s], field_array[j], 0, param)
+                    aux = phi_q/field_array[j].E
 
 #               No preconditioner
 #                F[s_start:s_start+s_size] += aux
@@ -743,6 +739,7 @@ def calculateEsolv(surf_array, field_array, param, kernel):
     cal2J = 4.184
     C0 = param.qe**2*param.Na*1e-3*1e10/(cal2J*param.E_0)
     E_solv = []
+    timing = timings()
 
     ff = -1
     for f in param.E_field:
@@ -766,10 +763,6 @@ def calculateEsolv(surf_array, field_array, param, kernel):
                 s.xk,s.wk = GQ_1D(par_reac.Nk)
                 s.xk = REAL(s.xk)
                 s.wk = REAL(s.wk)
-                for C in range(len(s.tree)):
-                    s.tree[C].M  = zeros(par_reac.Nm)
-                    s.tree[C].Md = zeros(par_reac.Nm)
-
                 Naux += len(s.triangle)
 
 #               Coefficient to account for dphi_dn defined in
@@ -777,7 +770,7 @@ def calculateEsolv(surf_array, field_array, param, kernel):
                 C1 = s.E_hat
 
                 if param.GPU==0:
-                    phi_aux, AI = get_phir(s.phi, C1*s.dphi, s, field_array[f].xq, s.tree, par_reac, ind_reac)
+                    phi_aux, AI = get_phir(s.phi, C1*s.dphi, s, field_array[f], par_reac, ind_reac, timing)
                 elif param.GPU==1:
                     phi_aux, AI = get_phir_gpu(s.phi, C1*s.dphi, s, field_array[f], par_reac, kernel)
                 
@@ -791,14 +784,10 @@ def calculateEsolv(surf_array, field_array, param, kernel):
                 s.xk,s.wk = GQ_1D(par_reac.Nk)
                 s.xk = REAL(s.xk)
                 s.wk = REAL(s.wk)
-                for C in range(len(s.tree)):
-                    s.tree[C].M  = zeros(int(par_reac.Nm))
-                    s.tree[C].Md = zeros(int(par_reac.Nm))
-
                 Naux += len(s.triangle)
 
                 if param.GPU==0:
-                    phi_aux, AI = get_phir(s.phi, s.dphi, s, field_array[f].xq, s.tree, par_reac, ind_reac)
+                    phi_aux, AI = get_phir(s.phi, s.dphi, s, field_array[f], par_reac, ind_reac, timing)
                 elif param.GPU==1:
                     phi_aux, AI = get_phir_gpu(s.phi, s.dphi, s, field_array[f], par_reac, kernel)
                 
@@ -811,13 +800,23 @@ def calculateEsolv(surf_array, field_array, param, kernel):
 
             print('%i of %i analytical integrals for phi_reac calculation in region %i'%(AI_int/len(field_array[f].xq),Naux, f))
 
+    if param.GPU==0:
+        print('Time P2M          : %f'%timing.time_P2M)
+        print('Time M2M          : %f'%timing.time_M2M)
+        print('Time M2P          : %f'%timing.time_M2P)
+        print('Time P2P          : %f'%timing.time_P2P)
+
     return E_solv      
 
 
 def coulombEnergy(f, param):
 
-    point_energy = zeros(len(f.q), param.REAL)
-    coulomb_direct(f.xq[:,0], f.xq[:,1], f.xq[:,2], f.q, point_energy)
+    Nq = len(f.q)
+    if float(Nq)*Nq<=param.charge_direct:
+        point_energy = zeros(Nq, param.REAL)
+        coulomb_direct(f.xq[:,0], f.xq[:,1], f.xq[:,2], f.q, point_energy)
+    else:
+        point_energy = f.q*chargeSelfField(f, param)
 
     cal2J = 4.184
     C0 = param.qe**2*param.Na*1e-3*1e10/(cal2J*param.E_0)
@@ -893,16 +892,10 @@ def computeNormalElectricField(surf, s, field, param, sigma, ind0, kernel, timin
                     aux_z[surf.unsort]*surf.normal[:,2]
 
     elif param.GPU==0:
-        ElecField = zeros(len(surf.triangle))
-        for i in range(Nq):
-            dx_pq = surf.xi - field.xq[i,0] 
-            dy_pq = surf.yi - field.xq[i,1]
-            dz_pq = surf.zi - field.xq[i,2]
-            R_pq = sqrt(dx_pq*dx_pq + dy_pq*dy_pq + dz_pq*dz_pq)
-
-            ElecField += field.q[i]/(R_pq*R_pq*R_pq) * (dx_pq*surf.normal[:,0] \
-                                                    + dy_pq*surf.normal[:,1] \
-                                                    + dz_pq*surf.normal[:,2])
+        phi_q, dphi_q = surfaceChargeField(surf, field, 1, param)
+        ElecField = -dphi_q[0]*surf.normal[:,0] \
+                    - dphi_q[1]*surf.normal[:,1] \
+                    - dphi_q[2]*surf.normal[:,2]
 
     if sum(abs(sigma))>1e-10:
         ElecField -= project_Kt(sigma, 1, surf, surf, 
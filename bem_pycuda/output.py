@@ -21,6 +21,9 @@
 '''
 
 from numpy import *
+import sys
+sys.path.append('tree')
+from direct import getThreads
 
 def printSummary(surf_array, field_array, param):
     Nsurf = len(surf_array)
@@ -28,19 +31,17 @@ def printSummary(surf_array, field_array, param):
     print('%i surfaces:\n'%Nsurf)
     for i in range(len(surf_array)):
         N_aux = len(surf_array[i].triangle)
-        rr = zeros(len(surf_array[i].tree))
-        for ii in range(len(surf_array[i].tree)):
-            rr[ii] = surf_array[i].tree[ii].r
-        Levels = log(surf_array[i].tree[0].r/min(rr))/log(2) + 1 
+        rr = surf_array[i].tree.r
+        Levels = max(surf_array[i].tree.level) + 1 
 
         print('Surface %i:'%i)
         print('\t%i elements'%(N_aux))
         print('\tSurface type       : '+surf_array[i].surf_type)
-        print('\tCells              : %i'%len(surf_array[i].tree))
+        print('\tCells              : %i'%surf_array[i].tree.Ncell)
         print('\tTwigs              : %i'%len(surf_array[i].twig))
         print('\tLevels             : %i'%Levels)
-        print('\tC0 size            : %f'%surf_array[i].tree[0].r)
-        print('\tC0 box center      : %f, %f, %f'%(surf_array[i].tree[0].xc, surf_array[i].tree[0].yc, surf_array[i].tree[0].zc))
+        print('\tC0 size            : %f'%surf_array[i].tree.r[0])
+        print('\tC0 box center      : %f, %f, %f'%(surf_array[i].tree.xc[0], surf_array[i].tree.yc[0], surf_array[i].tree.zc[0]))
         print('\tTwig cell size     : %f'%(min(rr)))
         print('\tRbox/theta         : %f'%(min(rr)/param.theta))
         print('\tAnalytic distance  : %f'%(average(sqrt(2*surf_array[i].Area))/param.threshold))
@@ -66,6 +67,8 @@ def printSummary(surf_array, field_array, param):
     print('Parameters:')
     print('\tData type               : '+str(param.REAL))
     print('\tUse GPU                 : %i'%param.GPU)
+    if param.GPU==0:
+        print('\tCPU threads             : %i'%getThreads())
     print('\tP                       : %i'%param.P)
     print('\tthreshold               : %.2f'%param.threshold)
     print('\ttheta                   : %.2f'%param.theta)
@@ -23,8 +23,8 @@
 import sys 
 sys.path.append('tree')
 from FMMutils import *
-import pycuda.autoinit
-import pycuda.driver as cuda
+from charges import chargePoints, pointTargets
+from backend import cuda, Event
 import time
 
 
@@ -56,8 +56,14 @@ def getWeights(K):
 def project(XK, XV, LorY, surfSrc, surfTar, K_diag, V_diag, IorE,
             self, param, ind0, timing, kernel):
 
-    tic = cuda.Event()
-    toc = cuda.Event()
+    if ndim(XK)==2 and param.GPU==1:
+        # GPU kernels take one right-hand side at a time
+        KV = [project(XK[c], XV[c], LorY, surfSrc, surfTar, K_diag, V_diag, IorE,
+                        self, param, ind0, timing, kernel) for c in range(len(XK))]
+        return array([kv[0] for kv in KV]), array([kv[1] for kv in KV])
+
+    tic = Event(param.GPU)
+    toc = Event(param.GPU)
 
     REAL = param.REAL
     Ns = len(surfSrc.triangle)
@@ -67,28 +73,29 @@ def project(XK, XV, LorY, surfSrc, surfTar, K_diag, V_diag, IorE,
     tic.record()
     K = param.K
     w    = getWeights(K)
-    X_V  = zeros(Ns*K)
-    X_Kx = zeros(Ns*K)
-    X_Ky = zeros(Ns*K)
-    X_Kz = zeros(Ns*K)
-    X_Kc = zeros(Ns*K)
-    X_Vc = zeros(Ns*K)
 
+    # XK and XV may hold several right-hand sides as rows, (Nrhs,Ns)
     NsK = arange(Ns*K)
-    X_V[:]  =  XV[NsK//K]*w[NsK%K]*surfSrc.Area[NsK//K]
-    X_Kx[:] = XK[NsK//K]*w[NsK%K]*surfSrc.Area[NsK//K]*surfSrc.normal[NsK//K,0]
-    X_Ky[:] = XK[NsK//K]*w[NsK%K]*surfSrc.Area[NsK//K]*surfSrc.normal[NsK//K,1]
-    X_Kz[:] = XK[NsK//K]*w[NsK%K]*surfSrc.Area[NsK//K]*surfSrc.normal[NsK//K,2]
-    X_Kc[:] = XK[NsK//K]
-    X_Vc[:] = XV[NsK//K]
+    wA   = w[NsK%K]*surfSrc.Area[NsK//K]
+    X_V  = XV[...,NsK//K]*wA
+    X_Kx = XK[...,NsK//K]*wA*surfSrc.normal[NsK//K,0]
+    X_Ky = XK[...,NsK//K]*wA*surfSrc.normal[NsK//K,1]
+    X_Kz = XK[...,NsK//K]*wA*surfSrc.normal[NsK//K,2]
+    X_Kc = XK[...,NsK//K]
+    X_Vc = XV[...,NsK//K]
 
     toc.record()
     toc.synchronize()
     timing.time_mass += tic.time_till(toc)*1e-3
 
+    param.Nround = len(surfTar.twig)*param.NCRIT
+    K_aux  = zeros(shape(XK)[:-1]+(param.Nround,))
+    V_aux  = zeros(shape(XK)[:-1]+(param.Nround,))
+    AI_int = 0
+
+    # With several right-hand sides the multipoles are (Nrhs,Ncell,Nm)
     tic.record()
-    C = 0
-    getMultipole(surfSrc.tree, C, surfSrc.xj, surfSrc.yj, surfSrc.zj, 
+    getMultipole(surfSrc.tree, surfSrc.xj, surfSrc.yj, surfSrc.zj, 
                     X_V, X_Kx, X_Ky, X_Kz, ind0, param.P, param.NCRIT)
     toc.record()
     toc.synchronize()
@@ -96,30 +103,22 @@ def project(XK, XV, LorY, surfSrc, surfTar, K_diag, V_diag, IorE,
 
 
     tic.record()
-    for C in reversed(range(1,len(surfSrc.tree))):
-        PC = surfSrc.tree[C].parent
-        upwardSweep(surfSrc.tree, C, PC, param.P, ind0.II, ind0.JJ, ind0.KK, ind0.index, ind0.combII, ind0.combJJ, 
-                    ind0.combKK, ind0.IImii, ind0.JJmjj, ind0.KKmkk, ind0.index_small, ind0.index_ptr)
+    upwardSweepTree(surfSrc.tree, ind0)
     toc.record()
     toc.synchronize()
     timing.time_M2M += tic.time_till(toc)*1e-3
 
     tic.record()
-    X_V = X_V[surfSrc.sortSource]
-    X_Kx = X_Kx[surfSrc.sortSource]
-    X_Ky = X_Ky[surfSrc.sortSource]
-    X_Kz = X_Kz[surfSrc.sortSource]
-    X_Kc = X_Kc[surfSrc.sortSource]
-    X_Vc = X_Vc[surfSrc.sortSource]
+    X_V = X_V[...,surfSrc.sortSource]
+    X_Kx = X_Kx[...,surfSrc.sortSource]
+    X_Ky = X_Ky[...,surfSrc.sortSource]
+    X_Kz = X_Kz[...,surfSrc.sortSource]
+    X_Kc = X_Kc[...,surfSrc.sortSource]
+    X_Vc = X_Vc[...,surfSrc.sortSource]
     toc.record()
     toc.synchronize()
     timing.time_sort += tic.time_till(toc)*1e-3
 
-    param.Nround = len(surfTar.twig)*param.NCRIT
-    K_aux  = zeros(param.Nround)
-    V_aux  = zeros(param.Nround)
-    AI_int = 0
-
     ### CPU code
     if param.GPU==0:
         K_aux, V_aux = M2P_sort(surfSrc, surfTar, K_aux, V_aux, self, 
@@ -148,8 +147,8 @@ def project(XK, XV, LorY, surfSrc, surfTar, K_diag, V_diag, IorE,
         timing.time_trans += tic.time_till(toc)*1e-3
 
     tic.record()
-    K_lyr = K_aux[surfTar.unsort]
-    V_lyr = V_aux[surfTar.unsort]
+    K_lyr = K_aux[...,surfTar.unsort]
+    V_lyr = V_aux[...,surfTar.unsort]
     toc.record()
     toc.synchronize()
     timing.time_sort += tic.time_till(toc)*1e-3
@@ -159,8 +158,8 @@ def project(XK, XV, LorY, surfSrc, surfTar, K_diag, V_diag, IorE,
 def project_Kt(XKt, LorY, surfSrc, surfTar, Kt_diag,
                 self, param, ind0, timing, kernel):
 
-    tic = cuda.Event()
-    toc = cuda.Event()
+    tic = Event(param.GPU)
+    toc = Event(param.GPU)
 
     REAL = param.REAL
     Ns = len(surfSrc.triangle)
@@ -182,9 +181,8 @@ def project_Kt(XKt, LorY, surfSrc, surfTar, Kt_diag,
     timing.time_mass += tic.time_till(toc)*1e-3
 
     tic.record()
-    C = 0
     X_aux = zeros(Ns*K)
-    getMultipole(surfSrc.tree, C, surfSrc.xj, surfSrc.yj, surfSrc.zj, 
+    getMultipole(surfSrc.tree, surfSrc.xj, surfSrc.yj, surfSrc.zj, 
                     X_Kt, X_aux, X_aux, X_aux, ind0, param.P, param.NCRIT)
     toc.record()
     toc.synchronize()
@@ -192,10 +190,7 @@ def project_Kt(XKt, LorY, surfSrc, surfTar, Kt_diag,
 
 
     tic.record()
-    for C in reversed(range(1,len(surfSrc.tree))):
-        PC = surfSrc.tree[C].parent
-        upwardSweep(surfSrc.tree, C, PC, param.P, ind0.II, ind0.JJ, ind0.KK, ind0.index, ind0.combII, ind0.combJJ, 
-                    ind0.combKK, ind0.IImii, ind0.JJmjj, ind0.KKmkk, ind0.index_small, ind0.index_ptr)
+    upwardSweepTree(surfSrc.tree, ind0)
     toc.record()
     toc.synchronize()
     timing.time_M2M += tic.time_till(toc)*1e-3
@@ -259,75 +254,85 @@ def project_Kt(XKt, LorY, surfSrc, surfTar, Kt_diag,
     return Kt_lyr
 
 
-def get_phir (XK, XV, surface, xq, Cells, par_reac, ind_reac):
+def get_phir (XK, XV, surface, field, par_reac, ind_reac, timing):
+    # Reaction potential of surface at all charges of field in one pass:
+    # charges are the targets, sorted by their own tree (charges.py)
 
     REAL = par_reac.REAL
     N = len(XK)
-    MV = zeros(len(XK))
-    L = sqrt(2*surface.Area) # Representative length
     AI_int = 0
+    Cells = surface.tree
 
     # Setup vector
     K = par_reac.K
     tic = time.time()
     w    = getWeights(K)
-    X_V = zeros(N*K)
-    X_Kx = zeros(N*K)
-    X_Ky = zeros(N*K)
-    X_Kz = zeros(N*K)
-    X_Kc = zeros(N*K)
-    X_Vc = zeros(N*K)
-
-    for i in range(N*K):
-        X_V[i]   = XV[i//K]*w[i%K]*surface.Area[i//K]
-        X_Kx[i]  = XK[i//K]*w[i%K]*surface.Area[i//K]*surface.normal[i//K,0]
-        X_Ky[i]  = XK[i//K]*w[i%K]*surface.Area[i//K]*surface.normal[i//K,1]
-        X_Kz[i]  = XK[i//K]*w[i%K]*surface.Area[i//K]*surface.normal[i//K,2]
-        X_Kc[i]  = XK[i//K]
-        X_Vc[i]  = XV[i//K]
+    X_V  = repeat(XV,K)*tile(w,N)*repeat(surface.Area,K)
+    XK_w = repeat(XK,K)*tile(w,N)*repeat(surface.Area,K)
+    X_Kx = XK_w*repeat(surface.normal[:,0],K)
+    X_Ky = XK_w*repeat(surface.normal[:,1],K)
+    X_Kz = XK_w*repeat(surface.normal[:,2],K)
+    X_Kc = repeat(XK,K)
+    X_Vc = repeat(XV,K)
     
     toc = time.time()
-    time_set = toc - tic
-
-    # P2M
+    timing.time_mass += toc - tic
+
+    # Charges sorted by twig of their tree, as targets
+    tarTree = chargePoints(field, par_reac)
+    tar = tarTree.source
+    xt  = field.xq[tar,0]
+    yt  = field.xq[tar,1]
+    zt  = field.xq[tar,2]
+    offTar, sizeTar = pointTargets(tarTree)
+    P2P_list, offTwg, M2P_list, offMlt = dualTreeList(Cells, tarTree, par_reac.theta, par_reac.NCRIT)
+
+    K_aux = zeros(len(xt))
+    V_aux = zeros(len(xt))
+    if len(M2P_list)>0:     # No multipoles needed if everything is near (e.g. theta=0)
+        # P2M
+        tic = time.time()
+        getMultipole(Cells, surface.xj, surface.yj, surface.zj, 
+                    X_V, X_Kx, X_Ky, X_Kz, ind_reac, par_reac.P, par_reac.NCRIT)
+        toc = time.time()
+        timing.time_P2M += toc - tic
+
+        # M2M
+        tic = time.time()
+        upwardSweepTree(Cells, ind_reac)
+        toc = time.time()
+        timing.time_M2M += toc - tic
+
+        # M2P
+        tic = time.time()
+        multipole_sort(K_aux, V_aux, offTar, sizeTar, offMlt, M2P_list, Cells.M.ravel(), Cells.Md.ravel(),
+                        xt, yt, zt, Cells.xc, Cells.yc, Cells.zc, ind_reac.index_large,
+                        par_reac.P, par_reac.kappa, int(par_reac.Nm), 1)
+        toc = time.time()
+        timing.time_M2P += toc - tic
+
+    # P2P, with no self-operator as targets are charges
     tic = time.time()
-    C = 0
-    getMultipole(Cells, C, surface.xj, surface.yj, surface.zj, 
-                X_V, X_Kx, X_Ky, X_Kz, ind_reac, par_reac.P, par_reac.NCRIT)
-    toc = time.time()
-    time_P2M = toc - tic
-
-    # M2M
-    tic = time.time()
-    for C in reversed(range(1,len(Cells))):
-        PC = Cells[C].parent
-        upwardSweep(Cells, C, PC, par_reac.P, ind_reac.II, ind_reac.JJ, ind_reac.KK, ind_reac.index, 
-                    ind_reac.combII, ind_reac.combJJ, ind_reac.combKK, ind_reac.IImii, ind_reac.JJmjj, 
-                    ind_reac.KKmkk, ind_reac.index_small, ind_reac.index_ptr)
+    IorE = 0
+    sort = surface.sortSource
+    tri  = sort//K  # Triangle
+    k    = sort%K   # Gauss point
+    aux  = zeros(2)
+    direct_sort(K_aux, V_aux, 1, 0., 0., int(IorE), ravel(surface.vertex[surface.triangleSort[:]]), 
+            int32(tri), int32(k), surface.xi, surface.yi, surface.zi, 
+            surface.xjSort, surface.yjSort, surface.zjSort, xt, yt, zt,
+            X_V[sort], X_Kx[sort], X_Ky[sort], X_Kz[sort], X_Kc[sort], X_Vc[sort], 
+            P2P_list, offTar, sizeTar, surface.offsetSource, offTwg, tarTree.target,
+            surface.AreaSort, surface.sglInt_intSort, surface.sglInt_extSort,
+            surface.xk, surface.wk, surface.Xsk, surface.Wsk,
+            par_reac.kappa, par_reac.threshold, par_reac.eps, w[0], aux)
+    AI_int += int(aux[0])
+    timing.time_an += aux[1]
     toc = time.time()
-    time_M2M = toc - tic
+    timing.time_P2P += toc - tic
 
-    # Evaluation
-    IorE = 0    # This evaluation is on charge points, no self-operator
-    AI_int = 0
-    phi_reac = zeros(len(xq))
-    time_P2P = 0.
-    time_M2P = 0.
-    for i in range(len(xq)):
-        CJ = 0
-        Kval = 0.
-        Vval = 0.
-        source = []
-        Kval, Vval, source, time_M2P = M2P_nonvec(Cells, CJ, xq[i], Kval, Vval,
-                                                 ind_reac.index_large, par_reac, source, time_M2P)
-        Kval, Vval, AI_int, time_P2P = P2P_nonvec(Cells, surface, X_V, X_Kx, X_Ky, X_Kz, X_Kc, X_Vc,
-                                        xq[i], Kval, Vval, IorE, par_reac, w, source, AI_int, time_P2P)
-        phi_reac[i] = (-Kval + Vval)/(4*pi)
-#    print('\tTime set: %f'%time_P2M)
-#    print('\tTime P2M: %f'%time_P2M)
-#    print('\tTime M2M: %f'%time_M2M)
-#    print('\tTime M2P: %f'%time_M2P)
-#    print('\tTime P2P: %f'%time_P2P)
+    phi_reac = zeros(len(xt))
+    phi_reac[tar] = (-K_aux + V_aux)/(4*pi)
 
     return phi_reac, AI_int
 
@@ -0,0 +1,77 @@
+'''
+  Copyright (C) 2013 by Christopher Cooper, Lorena Barba
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy
+  of this software and associated documentation files (the "Software"), to deal
+  in the Software without restriction, including without limitation the rights
+  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+  copies of the Software, and to permit persons to whom the Software is
+  furnished to do so, subject to the following conditions:
+
+  The above copyright notice and this permission notice shall be included in
+  all copies or substantial portions of the Software.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+'''
+
+# Coulomb energy with the charge treecode against the direct sum (coulomb_direct)
+# Uses copies of the lysozyme charges on a grid to get large charge sets.
+# To run: python regression_tests/coulomb_tree.py [max copies per side]
+
+import sys
+sys.path.append('.')
+sys.path.append('tree')
+sys.path.append('../util')
+import time
+from numpy import *
+from classes import parameters, fields
+from readData import readpqr
+from matrixfree import coulombEnergy
+
+max_copies = 3
+if len(sys.argv)>1:
+    max_copies = int(sys.argv[1])
+
+xq0, q0, Nq0 = readpqr('../geometry/Lysozyme/built_parse.pqr', float64)
+side = max(xq0[:,0].max()-xq0[:,0].min(), xq0[:,1].max()-xq0[:,1].min(), xq0[:,2].max()-xq0[:,2].min()) + 10.
+
+param = parameters()
+param.REAL  = float64
+param.NCRIT = 300       # Same as lysozyme runs
+
+tolerance = 1e-4
+flag = 0
+print('Charges   Ecoul direct   Ecoul tree      Rel. error   Direct (s)  Tree (s)')
+for n in range(1,max_copies+1):
+    shift = array([[i,j,k] for i in range(n) for j in range(n) for k in range(n)])*side
+
+    f = fields()
+    f.xq = (xq0[newaxis,:,:] + shift[:,newaxis,:]).reshape(-1,3)
+    f.q  = tile(q0, len(shift))
+    f.E  = 4.
+
+    param.charge_direct = 1e20
+    tic = time.time()
+    E_direct = coulombEnergy(f, param)
+    time_direct = time.time() - tic
+
+    param.charge_direct = 0
+    tic = time.time()
+    E_tree = coulombEnergy(f, param)
+    time_tree = time.time() - tic
+
+    error = abs(E_tree-E_direct)/abs(E_direct)
+    print('%7i  %13.6f  %13.6f  %12.3e  %10.3f  %8.3f'%(len(f.q), E_direct, E_tree, error, time_direct, time_tree))
+    if error>tolerance:
+        flag = 1
+
+if flag==0:
+    print('\nPassed Coulomb treecode test! Relative error below %g'%tolerance)
+else:
+    print('\nFAILED Coulomb treecode test')
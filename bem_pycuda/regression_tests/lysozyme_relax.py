@@ -0,0 +1,96 @@
+'''
+  Copyright (C) 2013 by Christopher Cooper, Lorena Barba
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy
+  of this software and associated documentation files (the "Software"), to deal
+  in the Software without restriction, including without limitation the rights
+  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+  copies of the Software, and to permit persons to whom the Software is
+  furnished to do so, subject to the following conditions:
+
+  The above copyright notice and this permission notice shall be included in
+  all copies or substantial portions of the Software.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+'''
+
+# Relaxed treecode accuracy in GMRES (relax_levels) on the lysozyme mesh 
+# (single surface, CPU). Runs the fixed-accuracy solve and relaxed solves with
+# an increasing number of levels, and reports the solve time saved and the
+# error in solvation energy against the fixed-accuracy result.
+# To run: python regression_tests/lysozyme_relax.py [mesh] [max levels]
+
+import os
+from numpy import zeros
+import sys
+
+def scanOutput(filename):
+
+    flag = 0
+    for line in open(filename):
+        line = line.split()
+        if len(line)>0:
+            if line[0]=='Converged':
+                iterations = int(line[2])
+            if line[0]=='Solve' and len(line)>3 and line[1]=='time':
+                Time_solve = float(line[3][:-1])
+            if line[0]=='Totals:':
+                flag = 1
+            if line[0]=='Esolv' and flag==1:
+                Esolv = float(line[2])
+
+    return iterations, Esolv, Time_solve
+
+mesh = '1'
+max_levels = 3
+if len(sys.argv)>1:
+    mesh = sys.argv[1]
+if len(sys.argv)>2:
+    max_levels = int(sys.argv[2])
+
+# Same parameters as the lysozyme regression test, on CPU
+param_file = 'regression_tests/input_files/lys_relax.param'
+config = 'regression_tests/input_files/lys_single_' + mesh + '.config'
+out = 'regression_tests/output_aux'
+
+print('Relaxed matvecs on lysozyme with single surface (mesh %s)'%mesh)
+levels = range(max_levels+1)
+iterations = zeros(len(levels))
+Esolv      = zeros(len(levels))
+Time_solve = zeros(len(levels))
+for i in levels:
+    f = open(param_file, 'w')
+    for line in open('regression_tests/input_files/lys.param'):
+        if line.split()[0]=='GPU':
+            line = 'GPU         0\n'
+        f.write(line)
+    f.write('relax_levels %i\n'%i)
+    f.close()
+
+    print('Start run with %i relaxed levels'%i)
+    cmd = './main.py ' + param_file + ' ' + config + ' --no-cache > ' + out
+    os.system(cmd)
+    iterations[i], Esolv[i], Time_solve[i] = scanOutput(out)
+
+os.remove(param_file)
+
+tolerance = 1e-3
+flag = 0
+print('\nLevels  Iterations  Solve time (s)  Time saved  Esolv (kcal/mol)  Rel. error')
+for i in levels:
+    saved = 1 - Time_solve[i]/Time_solve[0]
+    error = abs(Esolv[i]-Esolv[0])/abs(Esolv[0])
+    print('%6i  %10i  %14.2f  %9.1f%%  %16.6f  %10.2e'%(i, iterations[i], Time_solve[i], 100*saved, Esolv[i], error))
+    if error>tolerance:
+        flag = 1
+
+if flag==0:
+    print('\nPassed relaxed matvec test! Esolv within %g of the fixed-accuracy solve'%tolerance)
+else:
+    print('\nFAILED relaxed matvec test')
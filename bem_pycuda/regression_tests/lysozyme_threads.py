@@ -0,0 +1,104 @@
+'''
+  Copyright (C) 2013 by Christopher Cooper, Lorena Barba
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy
+  of this software and associated documentation files (the "Software"), to deal
+  in the Software without restriction, including without limitation the rights
+  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+  copies of the Software, and to permit persons to whom the Software is
+  furnished to do so, subject to the following conditions:
+
+  The above copyright notice and this permission notice shall be included in
+  all copies or substantial portions of the Software.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+'''
+
+# Strong scaling of the CPU treecode on the lysozyme mesh (single surface).
+# Runs the same problem with GPU=0 and an increasing number of threads, and
+# checks that all runs give the same solvation energy and iteration count.
+# To run: python regression_tests/lysozyme_threads.py [mesh] [max threads]
+
+import os
+from numpy import zeros
+import sys
+
+def scanOutput(filename):
+
+    flag = 0
+    for line in open(filename):
+        line = line.split()
+        if len(line)>0:
+            if line[0]=='Converged':
+                iterations = int(line[2])
+            if line[0]=='Solve' and len(line)>3 and line[1]=='time':
+                Time_solve = float(line[3][:-1])
+            if line[0]=='Totals:':
+                flag = 1
+            if line[0]=='Esolv' and flag==1:
+                Esolv = float(line[2])
+            if line[0]=='Time' and flag==1:
+                Time = float(line[2])
+
+    return iterations, Esolv, Time_solve, Time
+
+mesh = '1'
+max_threads = os.cpu_count()
+if len(sys.argv)>1:
+    mesh = sys.argv[1]
+if len(sys.argv)>2:
+    max_threads = int(sys.argv[2])
+
+threads = [1]
+while 2*threads[-1]<=max_threads:
+    threads.append(2*threads[-1])
+if threads[-1]!=max_threads:
+    threads.append(max_threads)
+
+# Same parameters as the lysozyme regression test, on CPU
+param_file = 'regression_tests/input_files/lys_threads.param'
+config = 'regression_tests/input_files/lys_single_' + mesh + '.config'
+out = 'regression_tests/output_aux'
+
+print('Scaling of lysozyme with single surface (mesh %s) against CPU threads'%mesh)
+iterations = zeros(len(threads))
+Esolv      = zeros(len(threads))
+Time_solve = zeros(len(threads))
+Time       = zeros(len(threads))
+for i in range(len(threads)):
+    f = open(param_file, 'w')
+    for line in open('regression_tests/input_files/lys.param'):
+        if line.split()[0]=='GPU':
+            line = 'GPU         0\n'
+        f.write(line)
+    f.write('threads     %i\n'%threads[i])
+    f.close()
+
+    print('Start run with %i threads'%threads[i])
+    cmd = './main.py ' + param_file + ' ' + config + ' --no-cache > ' + out
+    os.system(cmd)
+    iterations[i], Esolv[i], Time_solve[i], Time[i] = scanOutput(out)
+
+os.remove(param_file)
+
+print('\nThreads  Solve time (s)  Speed-up  Efficiency  Total time (s)')
+for i in range(len(threads)):
+    speedup = Time_solve[0]/Time_solve[i]
+    print('%7i  %14.2f  %8.2f  %10.2f  %14.2f'%(threads[i], Time_solve[i], speedup, speedup/threads[i], Time[i]))
+
+flag = 0
+for i in range(1,len(threads)):
+    if Esolv[i]!=Esolv[0] or iterations[i]!=iterations[0]:
+        flag = 1
+        print('Result with %i threads differs from serial run: Esolv %f, %i iterations'%(threads[i],Esolv[i],iterations[i]))
+
+if flag==0:
+    print('\nPassed determinism test! Esolv = %f, %i iterations for all thread counts'%(Esolv[0],iterations[0]))
+else:
+    print('\nFAILED determinism test')
@@ -0,0 +1,123 @@
+'''
+  Copyright (C) 2013 by Christopher Cooper, Lorena Barba
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy
+  of this software and associated documentation files (the "Software"), to deal
+  in the Software without restriction, including without limitation the rights
+  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+  copies of the Software, and to permit persons to whom the Software is
+  furnished to do so, subject to the following conditions:
+
+  The above copyright notice and this permission notice shall be included in
+  all copies or substantial portions of the Software.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+'''
+
+# Time per pose of a rigid-body distance scan between two spheres (CPU).
+# Sphere 1 and its charge are a rigid body, moved away from sphere 0 along
+# the line between their centers in 50 steps. Each pose is set with the rigid
+# mode of Session (only lists and near field between the spheres are redone).
+# The first poses are also run with a full setup of the moved geometry
+# (fill_surface and all interaction lists), to compare time and Esolv.
+# Both start GMRES from zero, so the difference is setup only.
+# To run: python regression_tests/rigid_scan.py [mesh]
+
+import os
+import sys
+import time
+from numpy import zeros, linspace, average, array, sqrt
+sys.path.append('.')
+from session import Session
+from classes import fill_surface
+from FMMutils import generateList
+
+mesh = '2K'
+if len(sys.argv)>1:
+    mesh = sys.argv[1]
+Npose = 50      # poses in the scan
+Nfull = 5       # poses also run with a full setup
+Dscan = 10.     # distance covered by the scan (Angstrom)
+
+# Same parameters as the sphere regression tests, on CPU with stored near field
+param_file = 'regression_tests/input_files/sphere_rigid.param'
+config = 'regression_tests/input_files/twosphere_' + mesh + '.config'
+f = open(param_file, 'w')
+for line in open('regression_tests/input_files/sphere_standard.param'):
+    if line.split()[0]=='GPU':
+        line = 'GPU         0\n'
+    f.write(line)
+f.write('P2P_cache   1\n')
+f.close()
+
+run  = Session(param_file, config, cache=False)
+full = Session(param_file, config, cache=False)
+os.remove(param_file)
+
+s0 = run.surf_array[0]
+s1 = run.surf_array[1]
+c0 = array([average(s0.xi), average(s0.yi), average(s0.zi)])
+c1 = array([average(s1.xi), average(s1.yi), average(s1.zi)])
+D0 = sqrt(sum((c1-c0)**2))
+e  = (c1-c0)/D0
+dist = linspace(D0, D0+Dscan, Npose)
+
+run.setBodies([[1]])
+
+# Full setup moves the mesh and charges of sphere 1 and starts from them
+vertex_ref = full.surf_array[1].vertex.copy()
+charged = [f for f in full.field_array if f.parent==[1]][0]
+xq_ref = charged.xq.copy()
+
+print('Distance scan of sphere 1 (mesh %s), %i poses'%(mesh, Npose))
+Esolv      = zeros(Npose)
+time_setup = zeros(Npose)
+time_pose  = zeros(Npose)
+for i in range(Npose):
+    tic = time.time()
+    time_setup[i] = run.setPose(0, d=(dist[i]-D0)*e)
+    run.phi = None
+    run.solve()
+    Esolv[i] = sum(run.energies()['Esolv'])
+    time_pose[i] = time.time()-tic
+
+print('Full setup for the first %i poses'%Nfull)
+Esolv_full      = zeros(Nfull)
+time_setup_full = zeros(Nfull)
+time_pose_full  = zeros(Nfull)
+for i in range(Nfull):
+    tic = time.time()
+    full.surf_array[1].vertex = vertex_ref + (dist[i]-D0)*e
+    charged.xq = xq_ref + (dist[i]-D0)*e
+    charged.tree = []
+    for s in full.surf_array:
+        fill_surface(s, full.param)
+        s.P2P_block = {}
+        s.P2P_near  = []
+    full.param.P2P_mem = 0.
+    generateList(full.surf_array, full.field_array, full.param)
+    time_setup_full[i] = time.time()-tic
+    full.phi = None
+    full.solve()
+    Esolv_full[i] = sum(full.energies()['Esolv'])
+    time_pose_full[i] = time.time()-tic
+
+print('\nDistance  Esolv (kcal/mol)  Setup (s)  Pose (s)')
+for i in range(Npose):
+    print('%8.3f  %16.6f  %9.3f  %8.3f'%(dist[i], Esolv[i], time_setup[i], time_pose[i]))
+
+print('\nTime per pose, rigid mode : setup %.3fs, total %.3fs (average of %i)'%(sum(time_setup)/Npose, sum(time_pose)/Npose, Npose))
+print('Time per pose, full setup : setup %.3fs, total %.3fs (average of %i)'%(sum(time_setup_full)/Nfull, sum(time_pose_full)/Nfull, Nfull))
+print('Scan of %i poses          : %.1fs in rigid mode, %.1fs estimated with full setups'%(Npose, sum(time_pose), Npose*sum(time_pose_full)/Nfull))
+
+error = abs(Esolv[:Nfull]-Esolv_full)/abs(Esolv_full)
+if max(error)<1e-3:
+    print('\nPassed rigid motion test! Max relative difference in Esolv with full setup: %.2e'%max(error))
+else:
+    print('\nFAILED rigid motion test: relative difference in Esolv with full setup '+str(error))
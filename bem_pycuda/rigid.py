@@ -0,0 +1,144 @@
+'''
+  Copyright (C) 2013 by Christopher Cooper, Lorena Barba
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy
+  of this software and associated documentation files (the "Software"), to deal
+  in the Software without restriction, including without limitation the rights
+  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+  copies of the Software, and to permit persons to whom the Software is
+  furnished to do so, subject to the following conditions:
+
+  The above copyright notice and this permission notice shall be included in
+  all copies or substantial portions of the Software.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+'''
+
+# Rigid-body motion of groups of surfaces (bodies), for scans over the relative
+# position of molecules (PMF, binding orientation). Under a rigid motion, the
+# trees, the interaction lists between surfaces of the same body, the diagonal
+# preconditioner, the singular integrals and the stored near field of a body
+# do not change, so they are computed once in the reference pose. A new pose
+# transforms the coordinates (tree cells move with their panels), and only the
+# lists and stored near field between surfaces of different bodies are redone
+
+from numpy import *
+import time
+import sys
+sys.path.append('tree')
+from FMMutils import generateList, blockMemory
+from gmres    import setLevel, list_fields
+
+class rigidBodies():
+    def __init__(self):
+        self.surf  = []     # Surfaces of each body
+        self.field = []     # Regions of each body (their charges move with it)
+        self.body  = []     # Body of each surface (-1: fixed)
+        self.ref   = []     # Coordinates of each surface in the reference pose
+        self.xq_ref = {}    # Charge positions in the reference pose, per region
+        self.R     = []     # Rotation of each body from the reference pose
+        self.d     = []     # Translation of each body from the reference pose
+
+def defineBodies(surf_array, field_array, bodies):
+    # bodies: list of lists of surface indices. Surfaces in no body are fixed.
+    # Regions enclosed by a surface of a body move with it. The current pose
+    # is the reference pose of every body
+
+    rb = rigidBodies()
+    rb.body = zeros(len(surf_array), dtype=int) - 1
+    for b in range(len(bodies)):
+        rb.surf.append(list(bodies[b]))
+        rb.body[bodies[b]] = b
+        rb.field.append([f for f in range(len(field_array)) if len(field_array[f].parent)>0 
+                            and field_array[f].parent[0] in bodies[b]])
+        rb.R.append(eye(3))
+        rb.d.append(zeros(3))
+        for f in rb.field[-1]:
+            if len(field_array[f].xq)>0:
+                rb.xq_ref[f] = field_array[f].xq.copy()
+
+    for s in surf_array:
+        rb.ref.append({'vertex': s.vertex.copy(), 'normal': s.normal.copy(),
+                       'xi': transpose([s.xi, s.yi, s.zi]), 'xj': transpose([s.xj, s.yj, s.zj]),
+                       'xc': transpose([s.tree.xc, s.tree.yc, s.tree.zc])})
+
+    return rb
+
+def keptPairs(rb):
+    # Pairs of surfaces whose relative position does not change (same body,
+    # or both fixed)
+
+    Nsurf = len(rb.body)
+    return set((t, s) for t in range(Nsurf) for s in range(Nsurf) if rb.body[t]==rb.body[s])
+
+def transformSurface(surf, ref, R, d):
+    # Coordinates of surf at x = R*x_ref + d. Sorted copies are taken again
+    # from the unsorted ones
+
+    surf.vertex = dot(ref['vertex'], R.T) + d
+    surf.normal = dot(ref['normal'], R.T)
+    xi = dot(ref['xi'], R.T) + d
+    xj = dot(ref['xj'], R.T) + d
+    xc = dot(ref['xc'], R.T) + d
+    surf.xi, surf.yi, surf.zi = xi[:,0].copy(), xi[:,1].copy(), xi[:,2].copy()
+    surf.xj, surf.yj, surf.zj = xj[:,0].copy(), xj[:,1].copy(), xj[:,2].copy()
+    surf.tree.xc, surf.tree.yc, surf.tree.zc = xc[:,0].copy(), xc[:,1].copy(), xc[:,2].copy()
+
+    surf.xiSort = surf.xi[surf.sortTarget]
+    surf.yiSort = surf.yi[surf.sortTarget]
+    surf.ziSort = surf.zi[surf.sortTarget]
+    surf.xjSort = surf.xj[surf.sortSource]
+    surf.yjSort = surf.yj[surf.sortSource]
+    surf.zjSort = surf.zj[surf.sortSource]
+
+def moveBody(rb, b, R, d, surf_array, field_array, param):
+    # Moves body b to x = R*x_ref + d (R: 3x3 rotation, d: translation) and
+    # updates what depends on the position of the body relative to the others
+
+    tic = time.time()
+    R = array(R, dtype=float64)
+    d = array(d, dtype=float64)
+    rb.R[b], rb.d[b] = R, d
+    for s in rb.surf[b]:
+        transformSurface(surf_array[s], rb.ref[s], R, d)
+    for f in rb.field[b]:
+        if f in rb.xq_ref:
+            field_array[f].xq = dot(rb.xq_ref[f], R.T) + d
+            field_array[f].tree = []            # charge tree is rebuilt on first use
+
+    dropBlocks(rb, surf_array, param)
+    generateList(surf_array, field_array, param, keep=keptPairs(rb))
+    toc = time.time()
+
+    return toc-tic
+
+def dropBlocks(rb, surf_array, param):
+    # Stored near field between surfaces of different bodies is out of date
+
+    for t in range(len(surf_array)):
+        surf = surf_array[t]
+        for key in list(surf.P2P_block.keys()):
+            if rb.body[key[0]]!=rb.body[t]:
+                block = surf.P2P_block.pop(key)
+                if block is not None:
+                    param.P2P_mem -= blockMemory(block)
+
+def moveLevels(relax, rb, surf_array, field_array, param):
+    # Relaxed accuracy levels (relaxLevels in gmres.py) after moveBody, which
+    # updated the lists in the surfaces (level 0). Every other level keeps its
+    # lists within bodies and redoes those between bodies, as level 0
+
+    keep = keptPairs(rb)
+    relax.lists[0] = [dict((name, getattr(surf, name)) for name in list_fields) for surf in surf_array]
+    for l in range(1, len(relax.lists)):
+        setLevel(surf_array, param, relax, l)
+        dropBlocks(rb, surf_array, param)
+        generateList(surf_array, field_array, param, keep=keep)
+        relax.lists[l] = [dict((name, getattr(surf, name)) for name in list_fields) for surf in surf_array]
+    setLevel(surf_array, param, relax, 0)
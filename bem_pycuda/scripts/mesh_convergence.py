@@ -28,33 +28,10 @@ import numpy
 #from matplotlib.backends.backend_pdf import PdfFile, PdfPages, FigureCanvasPdf
 import sys
 import math
-sys.path.append('../util')
+import time
+sys.path.append('.')
+from session import Session
 
-def scanOutput(file_name):
-    
-    flag = 0
-    with open(file_name) as filename
-    
-      for line in file(filename):
-          line = line.split()
-          if len(line)>0:
-              if line[0]=='Converged':
-                  iterations = int(line[2])
-              if line[0]=='Total' and line[1]=='elements':
-                  N = int(line[-1])
-              if line[0]=='Totals:':
-                  flag = 1
-              if line[0]=='Esolv' and flag==1:
-                  Esolv = float(line[2])
-              if line[0]=='Esurf' and flag==1:
-                  Esurf = float(line[2])
-              if line[0]=='Ecoul' and flag==1:
-                  Ecoul = float(line[2])
-              if line[0]=='Time' and flag==1:
-                  Time = float(line[2])
-
-    return N, iterations, Esolv, Esurf, Ecoul, Time
-          
 meshNumber = len(sys.argv) - 4
 meshRefine = float(sys.argv[1])
 paramFile = sys.argv[2]
@@ -64,9 +41,6 @@ mesh = []
 for i in range(meshNumber):
     mesh.append(sys.argv[4+i])
 
-comm = './main.py ' + paramFile + ' ' + inputFile 
-out = 'regression_tests/output_aux'
-
 print('Start runs')
 N = numpy.zeros(len(mesh))
 iterations = numpy.zeros(len(mesh))
@@ -74,13 +48,21 @@ Esolv = numpy.zeros(len(mesh))
 Esurf = numpy.zeros(len(mesh))
 Ecoul = numpy.zeros(len(mesh))
 Time = numpy.zeros(len(mesh))
+kernel = None
 for i in range(len(mesh)):
     print('Start run for mesh '+mesh[i])
-    cmd = comm + mesh[i] + '.config > ' + out
-    os.system(cmd)
-    print('Scan output file')
-    N[i],iterations[i],Esolv[i],Esurf[i],Ecoul[i],Time[i] = scanOutput(out)
-
+    tic = time.time()
+    run = Session(paramFile, inputFile + mesh[i] + '.config', kernel=kernel)
+    kernel = run.kernel                         # same param file, compile once
+    run.solve()
+    E = run.energies()
+    N[i] = run.param.N
+    iterations[i] = run.iterations
+    Esolv[i] = sum(E['Esolv'])
+    Esurf[i] = sum(E['Esurf'])
+    Ecoul[i] = sum(E['Ecoul'])
+    Time[i] = time.time()-tic
+    del run
 
 # Richardson extrapolation
 for i in range(meshNumber-2):
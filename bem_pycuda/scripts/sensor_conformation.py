@@ -4,32 +4,7 @@ import numpy
 import sys
 import os
 import glob
-
-def scanOutput(filename):
-    
-    flag = 0 
-    files = []
-    for line in file(filename):
-        line = line.split()
-        if len(line)>0:
-            if line[0]=='Converged':
-                iterations = int(line[2])
-            if line[0]=='Total' and line[1]=='elements':
-                N = int(line[-1])
-            if line[0]=='Totals:':
-                flag = 1 
-            if line[0]=='Esolv' and flag==1:
-                Esolv = float(line[2])
-            if line[0]=='Esurf' and flag==1:
-                Esurf = float(line[2])
-            if line[0]=='Ecoul' and flag==1:
-                Ecoul = float(line[2])
-            if line[0]=='Time' and flag==1:
-                Time = float(line[2])
-            if line[0]=='Reading':
-                files.append(line[-1])  
-
-    return N, iterations, Esolv, Esurf, Ecoul, Time, files
+import time
 
 param_file = sys.argv[1]
 config_file = sys.argv[2]
@@ -39,6 +14,11 @@ tilt_N = sys.argv[5]
 output_file = sys.argv[6]
 cuda_device = sys.argv[7]
 
+# Solver runs in this process, select the device before PyCUDA starts
+os.environ['CUDA_DEVICE'] = cuda_device
+sys.path.append('.')
+from session import Session
+
 fout = open(output_file, 'w')
 
 fout.write('\nParameter file:\n')
@@ -53,7 +33,7 @@ config_file_moved = config_file[:-7] + name + config_file[-7:]
 ## Create moved input file
 # Works for only 1 pqr file so far (not multiple molecules) and only 1 molecular surface.
 fm = open(config_file_moved, 'w')
-for line_full in file(config_file):
+for line_full in open(config_file):
     line = line_full.split()
     if line[0]=='FILE':
         if line[2]=='dielectric_interface':
@@ -118,17 +98,27 @@ for i in range(len(til_angles_aux)):
             til_angles.append(til_angles_aux[i])
             rot_angles.append(rot_angles_aux[j])
 
-
+kernel = None
 for i in range(len(til_angles)):
 
     cmd_move = './scripts/move_protein.py ' + prot_file + ' ' + pqr_file + ' ' + str(rot_angles[i]) + ' ' + str(til_angles[i]) + ' ' + name
     os.system(cmd_move)
 
-    cmd_run = 'CUDA_DEVICE=' + cuda_device + ' ./main.py ' + param_file + ' ' + config_file_moved +' > output_aux_' + output_file + name
-#    cmd_run = './main.py ' + param_file + ' ' + config_file_moved +' > output_aux_' + output_file  + name
-    os.system(cmd_run)
-    
-    N_run, iterations_run, Esolv_run, Esurf_run, Ecoul_run, Time_run, files = scanOutput('output_aux_' + output_file + name)
+#   New geometry for each conformation: setup again (without the on-disk cache,
+#   every conformation is used once), but compile the CUDA kernels only once
+    tic = time.time()
+    run = Session(param_file, config_file_moved, cache=False, kernel=kernel)
+    kernel = run.kernel
+    run.solve()
+    E = run.energies()
+
+    N_run          = run.param.N
+    iterations_run = run.iterations
+    Esolv_run      = sum(E['Esolv'])
+    Esurf_run      = sum(E['Esurf'])
+    Ecoul_run      = sum(E['Ecoul'])
+    Time_run       = time.time()-tic
+    del run
 
     fout = open(output_file,'a')
     fout.write('Angles: %2.2f tilt, %2.2f rotation; \tEtot: %f kcal/mol\n'%(til_angles[i], rot_angles[i], (Esolv_run+Esurf_run)))
@@ -148,7 +138,7 @@ for i in range(len(til_angles)):
 Etotal = numpy.array(Esolv) + numpy.array(Esurf) + numpy.array(Ecoul)
 EsurfEsolv = numpy.array(Esolv) + numpy.array(Esurf)
 
-os.system('rm output_aux_' + output_file + name + ' ' + config_file_moved + ' ' + prot_file_moved+'.vert ' + prot_file_moved+'.face' + ' ' + pqr_file_moved)
+os.system('rm ' + config_file_moved + ' ' + prot_file_moved+'.vert ' + prot_file_moved+'.face' + ' ' + pqr_file_moved)
 
 fout = open(output_file, 'a')
 
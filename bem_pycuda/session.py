@@ -0,0 +1,414 @@
+'''
+  Copyright (C) 2013 by Christopher Cooper, Lorena Barba
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy
+  of this software and associated documentation files (the "Software"), to deal
+  in the Software without restriction, including without limitation the rights
+  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+  copies of the Software, and to permit persons to whom the Software is
+  furnished to do so, subject to the following conditions:
+
+  The above copyright notice and this permission notice shall be included in
+  all copies or substantial portions of the Software.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+'''
+
+# Python interface to PyGBe. Session does the setup (surfaces, trees,
+# interaction lists, CUDA kernels, preconditioners) once, then solve() and
+# energies() can be called many times in the same process. main.py and
+# main_asymmetric.py do their setup with a Session too. Run from ./bem_pycuda,
+# like main.py:
+#
+#   from session import Session
+#   run = Session('input_files/lys.param', 'input_files/lys.config')
+#   run.solve()
+#   E = run.energies()
+#   run.solve(charges='state2.pqr', kappa=0.05)
+
+import time
+TIC_import = time.time()    # startup time of the first Session counts from here
+
+from numpy import *
+import copy
+import os
+import sys
+from gmres      import gmres_solver, block_gmres_solver, computeNearPrecond, relaxLevels
+from classes    import timings, parameters, index_constant, fillSurfaces, initializeSurf, initializeField, dataTransfer, fill_phi, readCharges, computePrecond, coarseToFine
+from output     import printSummary
+from cache      import setupKey, loadSetup, saveSetup, clearCache
+from matrixfree import generateRHS, generateRHS_gpu, calculateEsolv, coulombEnergy, calculateEsurf
+from rigid      import defineBodies, moveBody, moveLevels
+
+sys.path.append('../util')
+from readData   import readParameters
+
+sys.path.append('tree')
+from FMMutils       import *
+from backend        import loadKernels
+
+def countEquations(surf_array, param):
+    # Number of elements (param.N) and unknowns (param.Neq) of surf_array
+
+    param.N   = 0
+    param.Neq = 0
+    for s in surf_array:
+        N_aux = len(s.triangle)
+        param.N += N_aux
+        if s.surf_type == 'dirichlet_surface' or s.surf_type == 'neumann_surface' or s.surf_type == 'asc_surface':
+            param.Neq += N_aux
+        else:
+            param.Neq += 2*N_aux
+
+class Session():
+    first = True    # the first Session in the process includes import time in its startup
+
+    def __init__(self, param_file, config_file, cache=None, kernel=None, threads=None, 
+                 clear_cache=False, near=True, relax=True):
+        # cache      : read and write the on-disk setup cache (True or False, 
+        #              default the cache option of the param file)
+        # kernel     : compiled CUDA kernels of another Session with the same
+        #              param file, to skip compiling them again
+        # threads    : CPU threads for the treecode kernels, instead of the param file one
+        # clear_cache: empty the setup cache first (main.py --clear-cache)
+        # near       : compute the near-field preconditioner of precond near here.
+        #              main_asymmetric.py computes it in every Picard iteration instead
+        # relax      : build the accuracy levels of relax_levels. Only gmres_solver
+        #              (solve) relaxes, not block GMRES (solveCharges) or GCRO-DR
+
+        TIC = time.time()
+        self.TIC_start = TIC
+        if Session.first:
+            self.TIC_start = TIC_import
+            Session.first = False
+        self.startup_time = None    # import (or construction) to first solve
+        param = parameters()
+        precision = readParameters(param, param_file)
+        if threads is not None:
+            param.threads = threads
+        if cache is None:
+            cache = (param.cache==1)
+        param.Nm            = (param.P+1)*(param.P+2)*(param.P+3)//6    # Number of terms in Taylor expansion
+        param.BlocksPerTwig = int(ceil(param.NCRIT/float(param.BSZ)))   # CUDA blocks that fit per twig
+        if param.GPU==0:
+            setThreads(param.threads)                                   # OpenMP threads for treecode kernels
+
+        field_array = initializeField(config_file, param)
+        surf_array  = initializeSurf(field_array, config_file, param)
+
+#       Fill surfaces, or load them from the setup cache
+        cache_dir = os.path.expanduser(param.cache_dir)
+        if clear_cache:
+            clearCache(cache_dir)
+        cache_key = setupKey(surf_array, field_array, param)
+        cached = False
+        tic = time.time()
+        if cache:
+            cached = loadSetup(cache_dir, cache_key, surf_array, param)
+        if cached:
+            print('Setup loaded from cache %s'%cache_key)
+            self.time_sort = time.time()-tic
+        else:
+            self.time_sort = fillSurfaces(surf_array, param)
+
+        countEquations(surf_array, param)
+        print('\nTotal elements : %i'%param.N)
+        print('Total equations: %i'%param.Neq)
+        printSummary(surf_array, field_array, param)
+
+        ind0 = index_constant()
+        computeIndices(param.P, ind0)
+        precomputeTerms(param.P, ind0)
+
+        if kernel is None:
+            kernel = loadKernels(param, precision)                      # None on the CPU backend
+
+        print('Generate interaction list')
+        tic = time.time()
+        if not cached:
+            generateList(surf_array, field_array, param)
+        self.list_time = time.time()-tic
+        if not cached and cache:
+            saveSetup(cache_dir, cache_key, surf_array, param)
+
+        if param.P2P_cache==1 and param.GPU==0:
+            estimateP2Pcache(surf_array, field_array, param)
+
+#       Accuracy levels for relaxed matvecs in GMRES
+        levels = None
+        if param.relax_levels>0 and not relax:
+            print('relax_levels is ignored by this solver, solving with fixed accuracy')
+        elif param.relax_levels>0 and param.GPU==0:
+            tic = time.time()
+            levels = relaxLevels(surf_array, field_array, param, ind0)
+            self.list_time += time.time()-tic
+        elif param.relax_levels>0:
+            print('relax_levels is only used with GPU=0, solving with fixed accuracy')
+
+        tic = time.time()
+        if param.GPU==1:
+            print('Transfer data to GPU')
+            dataTransfer(surf_array, field_array, ind0, param, kernel)
+        self.transfer_time = time.time()-tic
+
+        tic = time.time()
+        if param.precond=='near' and near:
+            print('Near-field preconditioner')
+            computeNearPrecond(surf_array, param)
+        self.precond_time = time.time()-tic
+
+        self.param       = param
+        self.field_array = field_array
+        self.surf_array  = surf_array
+        self.ind0        = ind0
+        self.kernel      = kernel
+        self.relax       = levels
+        self.timing      = timings()
+        self.phi         = None     # Solution of the last solve, initial guess of the next one
+        self.F           = None     # Right-hand side of the last solve
+        self.bodies      = None     # Rigid bodies of setBodies
+        self.setup_time  = time.time()-TIC
+        print('List time          : %fs'%self.list_time)
+        print('Data transfer time : %fs'%self.transfer_time)
+        print('Precond setup time : %fs'%self.precond_time)
+        print('------------------------------')
+        print('Total setup time   : %fs\n'%self.setup_time)
+
+    def chargedRegion(self):
+        # Index of the only region with charges in the config file
+
+        charged = [f for f in range(len(self.field_array)) if len(self.field_array[f].q)>0]
+        if len(charged)!=1:
+            raise ValueError('charges needs exactly one region with charges in the config file, found %i'%len(charged))
+        return charged[0]
+
+    def setCharges(self, charges):
+        # Replaces the charges of the (only) charged region by a .pqr or .crd
+        # file name, or by a tuple (xq, q) of positions (Nq,3) and values (Nq)
+
+        i = self.chargedRegion()
+        field = self.field_array[i]
+        if isinstance(charges, str):
+            readCharges(field, i, charges, self.param)
+        else:
+            field.xq = array(charges[0], dtype=self.param.REAL)
+            field.q  = array(charges[1], dtype=self.param.REAL)
+            field.tree = []
+
+    def setKappa(self, kappa):
+        # Sets the inverse Debye length of every Yukawa region. The diagonal
+        # (and near-field) preconditioner and the singular integrals depend on
+        # it and are computed again. Trees and interaction lists do not change.
+        # Stored Yukawa near field (of every relaxed level too) is for the old
+        # kappa and is dropped, with its memory in P2P_mem
+
+        for f in self.field_array:
+            if f.LorY==2:
+                f.kappa = self.param.REAL(kappa)
+
+        for i in range(len(self.surf_array)):
+            s = self.surf_array[i]
+            for f in self.field_array:
+                if len(f.parent)>0 and f.parent[0]==i:
+                    s.kappa_in = f.kappa
+                if i in f.child:
+                    s.kappa_out = f.kappa
+            computePrecond(s)
+            s.sglInt_intSort = s.sglInt_int[s.sortSource//self.param.K]
+            s.sglInt_extSort = s.sglInt_ext[s.sortSource//self.param.K]
+
+        blocks = [s.P2P_block for s in self.surf_array]
+        if self.relax is not None:
+            blocks += [lists['P2P_block'] for level in self.relax.lists for lists in level]
+        dropped = {}        # Copies and levels share dicts and blocks: count each once
+        for P2P_block in blocks:
+            for key in list(P2P_block.keys()):
+                if key[1]==2:
+                    block = P2P_block.pop(key)
+                    if block is not None:
+                        dropped[id(block)] = block
+        for block in dropped.values():
+            self.param.P2P_mem -= blockMemory(block)
+
+        for s in self.surf_array:
+            self.param.P2P_mem -= s.P2P_nearMem
+            s.P2P_nearMem = 0
+            s.P2P_near = []
+
+        if self.param.precond=='near':
+            computeNearPrecond(self.surf_array, self.param)
+
+    def setBodies(self, bodies):
+        # Groups of surfaces (lists of surface indices) that move as rigid
+        # bodies with setPose, see rigid.py. Surfaces in no body are fixed.
+        # The current pose (and charges) is the reference pose of every body
+
+        self.bodies = defineBodies(self.surf_array, self.field_array, bodies)
+
+    def setPose(self, b, R=None, d=None):
+        # Moves body b to x = R*x_ref + d, from its reference pose (R: 3x3
+        # rotation, default identity, d: translation, default zero). Only the
+        # interaction lists and stored near field between different bodies
+        # are computed again. Returns the time it took
+
+        if self.bodies is None:
+            raise RuntimeError('setPose() needs setBodies() first')
+        if R is None:
+            R = eye(3)
+        if d is None:
+            d = zeros(3)
+
+        tic = time.time()
+        moveBody(self.bodies, b, R, d, self.surf_array, self.field_array, self.param)
+        if self.relax is not None:
+            moveLevels(self.relax, self.bodies, self.surf_array, self.field_array, self.param)
+        if self.param.GPU==1:
+            dataTransfer(self.surf_array, self.field_array, self.ind0, self.param, self.kernel)
+        toc = time.time()
+
+        return toc-tic
+
+    def rhs(self):
+        # Right-hand side for the current charges
+
+        if self.param.GPU==0:
+            F = generateRHS(self.field_array, self.surf_array, self.param, self.kernel, self.timing, self.ind0)
+        elif self.param.GPU==1:
+            F = generateRHS_gpu(self.field_array, self.surf_array, self.param, self.kernel, self.timing, self.ind0)
+        return F
+
+    def startup(self):
+        # Prints the startup time, before the first solve
+
+        if self.startup_time is None:
+            self.startup_time = time.time()-self.TIC_start
+            print('Startup time (import to solve, %s backend): %fs\n'%(['CPU','GPU'][self.param.GPU], self.startup_time))
+
+    def solve(self, charges=None, kappa=None, tol=None):
+        # Solves for the surface potential, returns the solution vector
+        # charges: new charges of the charged region (see setCharges)
+        # kappa  : new inverse Debye length of the Yukawa regions
+        # tol    : GMRES tolerance (default from the param file)
+        # The solution of the previous call (or of coarseGuess) is the initial guess
+
+        param = self.param
+        if charges is not None:
+            self.setCharges(charges)
+        if kappa is not None:
+            self.setKappa(kappa)
+        if param.GPU==1 and (charges is not None or kappa is not None):
+            dataTransfer(self.surf_array, self.field_array, self.ind0, param, self.kernel)
+
+        self.F = self.rhs()
+        self.startup()
+
+        if self.phi is None:
+            phi = zeros(param.Neq)
+        else:
+            phi = self.phi.copy()
+        phi = gmres_solver(self.surf_array, self.field_array, phi, self.F, param, self.ind0, self.timing, self.kernel, tol, self.relax)
+        fill_phi(phi, self.surf_array)
+        self.phi = phi
+        self.iterations = self.timing.iterations
+
+        return phi
+
+    def solveCharges(self, charges, tol=None):
+        # Solves for several charge sets of the charged region (list of files
+        # or (xq, q) tuples, see setCharges) together with block GMRES. Returns
+        # the solutions, one per row, and the energies of each set. The last
+        # set stays in the charged region
+
+        param = self.param
+        field = self.field_array[self.chargedRegion()]
+        charge_sets = []
+        F = zeros((len(charges), param.Neq))
+        for c in range(len(charges)):
+            self.setCharges(charges[c])
+            charge_sets.append((field.xq, field.q))
+            if param.GPU==1:
+                dataTransfer(self.surf_array, self.field_array, self.ind0, param, self.kernel)
+            F[c] = self.rhs()
+        self.F = F
+        self.startup()
+
+        phi = zeros(shape(F))
+        phi = block_gmres_solver(self.surf_array, self.field_array, phi, F, param, self.ind0, self.timing, self.kernel, tol)
+
+        E = []
+        for c in range(len(charges)):
+            self.setCharges(charge_sets[c])
+            if param.GPU==1:
+                dataTransfer(self.surf_array, self.field_array, self.ind0, param, self.kernel)
+            fill_phi(phi[c], self.surf_array)
+            self.phi = phi[c]
+            E.append(self.energies())
+
+        return phi, E
+
+    def coarseGuess(self, config_file, tol=1e-3):
+        # Initial guess of the next solve from a solve to tolerance tol on the
+        # coarser meshes of config_file (same surfaces and regions). Each panel
+        # takes the solution of the nearest coarse panel
+
+        param = self.param
+        print('Coarse solve on meshes of '+config_file)
+        tic = time.time()
+        surf_coarse = initializeSurf(self.field_array, config_file, param)
+        N_fine, Neq_fine, P2P_mem = param.N, param.Neq, param.P2P_mem
+        fillSurfaces(surf_coarse, param)
+        countEquations(surf_coarse, param)
+        generateList(surf_coarse, self.field_array, param)
+        timing_c = timings()
+        if param.GPU==0:
+            F_c = generateRHS(self.field_array, surf_coarse, param, self.kernel, timing_c, self.ind0)
+        elif param.GPU==1:
+            dataTransfer(surf_coarse, self.field_array, self.ind0, param, self.kernel)
+            F_c = generateRHS_gpu(self.field_array, surf_coarse, param, self.kernel, timing_c, self.ind0)
+        precond = param.precond
+        param.precond = 'diagonal'
+        phi_c = gmres_solver(surf_coarse, self.field_array, zeros(param.Neq), F_c, param, self.ind0, timing_c, self.kernel, tol)
+        param.precond = precond
+        self.phi = coarseToFine(phi_c, surf_coarse, self.surf_array)
+
+#       Fine problem sizes back, coarse near-field blocks out of the P2P budget
+        param.N, param.Neq, param.P2P_mem = N_fine, Neq_fine, P2P_mem
+        print('Coarse solve time : %fs\n'%(time.time()-tic))
+
+    def energies(self):
+        # Solvation, surface and Coulomb energies (kcal/mol) of the last solve,
+        # as a dictionary of lists with one entry per region, in the order
+        # main.py prints them
+
+        if self.phi is None:
+            raise RuntimeError('energies() needs a solve() first')
+
+#       calculateEsolv and calculateEsurf change the treecode parameters and
+#       quadrature of the surfaces to their own, keep those of the solver
+        quad = [(s.xk, s.wk) for s in self.surf_array]
+        E_solv = calculateEsolv(self.surf_array, self.field_array, copy.copy(self.param), self.kernel)
+        E_surf = calculateEsurf(self.surf_array, self.field_array, copy.copy(self.param), self.kernel)
+        for s, (xk, wk) in zip(self.surf_array, quad):
+            s.xk, s.wk = xk, wk
+
+        E_coul = []
+        for f in self.field_array:
+            if f.coulomb == 1:
+                E_coul.append(coulombEnergy(f, self.param))
+
+        return {'Esolv': E_solv, 'Esurf': E_surf, 'Ecoul': E_coul}
+
+    def surface_potential(self):
+        # Potential and normal derivative on each surface after the last solve,
+        # as a list of (phi, dphi) arrays, one per surface, in original panel order
+
+        if self.phi is None:
+            raise RuntimeError('surface_potential() needs a solve() first')
+
+        return [(s.phi.copy(), s.dphi.copy()) for s in self.surf_array]
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+'''
+  Copyright (C) 2013 by Christopher Cooper, Lorena Barba
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy
+  of this software and associated documentation files (the "Software"), to deal
+  in the Software without restriction, including without limitation the rights
+  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+  copies of the Software, and to permit persons to whom the Software is
+  furnished to do so, subject to the following conditions:
+
+  The above copyright notice and this permission notice shall be included in
+  all copies or substantial portions of the Software.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+'''
+
+# Parameter sweeps with Session. A sweep file lists the values of each swept
+# parameter (see README_input_format), every combination is a case, and cases
+# run in a pool of worker processes. The cases of one geometry (config file
+# and protein orientation) are split in chunks, one task each. A worker keeps
+# the Session of its last geometry, so only the charges and kappa change
+# between solves of a chunk, and of chunks of the same geometry. Each case
+# sends its row to the main process as soon as it is solved, and it goes to a
+# CSV table. Cases whose key is already in the table are skipped, so an
+# interrupted sweep resumes where it stopped.
+# To run, from ./bem_pycuda: ./sweep.py file.sweep
+
+import argparse
+import csv
+import hashlib
+import itertools
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+columns = ['key', 'config', 'tilt', 'rotation', 'charges', 'kappa',
+           'N', 'iterations', 'Esolv', 'Esurf', 'Ecoul', 'time']
+
+def readSweep(filename):
+    # Options of a sweep file, one 'name value [value ...]' line each.
+    # '-' for tilt, charges or kappa keeps the value of the config file
+
+    sweep = {'param': None, 'config': [], 'tilt': ['-'], 'rotation': ['0'], 
+             'charges': ['-'], 'kappa': ['-'], 'workers': 1, 'threads': 1,
+             'chunk': 0, 'output': 'sweep.csv'}
+    for line in open(filename):
+        line = line.split('#')[0].split()
+        if len(line)<2:
+            continue
+        if line[0] not in sweep:
+            raise ValueError('Unknown option %s in sweep file %s'%(line[0], filename))
+        if line[0]=='param' or line[0]=='output':
+            sweep[line[0]] = line[1]
+        elif line[0]=='workers' or line[0]=='threads' or line[0]=='chunk':
+            sweep[line[0]] = int(line[1])
+        else:
+            sweep[line[0]] = line[1:]
+
+    if sweep['param'] is None or len(sweep['config'])==0:
+        raise ValueError('Sweep file %s needs a param and a config line'%filename)
+
+    return sweep
+
+def paramId(param_file):
+    # Param file name and hash of its contents, so results of an edited param
+    # file are not taken for those of the current one
+
+    h = hashlib.sha1(open(param_file, 'rb').read()).hexdigest()
+    return '%s:%s'%(param_file, h[:12])
+
+def caseKey(param, config, tilt, rotation, charges, kappa):
+    return '|'.join([param, config, tilt, rotation, charges, kappa])
+
+def sweepGroups(sweep):
+    # Cases grouped by geometry, as a list of ((config, tilt, rotation), cases)
+    # with cases a list of (charges, kappa). Cases that keep the kappa of the 
+    # config file go first, before any other kappa is set on the Session
+
+    orientations = []
+    for tilt in sweep['tilt']:
+        if tilt=='-':
+            orientations.append(('-', '-'))
+        elif abs(float(tilt))<1e-10 or abs(float(tilt)-180)<1e-10:
+            orientations.append((tilt, '0'))        # rotation does not change the geometry
+        else:
+            for rotation in sweep['rotation']:
+                orientations.append((tilt, rotation))
+
+    kappa = sorted(sweep['kappa'], key=lambda k: k!='-')
+    groups = []
+    for config in sweep['config']:
+        for tilt, rotation in orientations:
+            cases = [(c, k) for k, c in itertools.product(kappa, sweep['charges'])]
+            groups.append(((config, tilt, rotation), cases))
+
+    return groups
+
+def readDone(output):
+    # Keys of the cases already in the results table
+
+    done = set()
+    if os.path.isfile(output):
+        for row in csv.DictReader(open(output)):
+            done.add(row['key'])
+    return done
+
+def moveProtein(config, tilt, rotation, name):
+    # Copy of config with the protein (dielectric_interface mesh and the pqr 
+    # of the charged region) rotated by scripts/move_protein.py, as in
+    # scripts/sensor_conformation.py. Returns the new config file and the
+    # files to remove once the Session has read them
+
+    config_moved = config[:-7] + name + config[-7:]
+    lines = []
+    mesh = []
+    pqr = []
+    for line_full in open(config):
+        line = line_full.split()
+        if len(line)>2 and line[0]=='FILE' and line[2]=='dielectric_interface':
+            mesh.append(line[1])
+            line[1] += name
+            line_full = '\t'.join(line) + '\n'
+        elif len(line)>7 and line[0]=='FIELD' and line[5]=='1':
+            pqr.append(line[7][:-4])
+            line[7] = pqr[-1] + name + '.pqr'
+            line_full = '\t'.join(line) + '\n'
+        lines.append(line_full)
+
+    if len(mesh)!=1 or len(pqr)!=1:
+        raise ValueError('tilt needs one dielectric_interface and one charged region in %s'%config)
+
+    f = open(config_moved, 'w')
+    f.writelines(lines)
+    f.close()
+
+    subprocess.check_call([sys.executable, 'scripts/move_protein.py', mesh[0], pqr[0], rotation, tilt, name])
+
+    return config_moved, [config_moved, mesh[0]+name+'.vert', mesh[0]+name+'.face', pqr[0]+name+'.pqr']
+
+def sweepTasks(groups, done, chunk, param):
+    # Cases to run with the param file of id param (paramId), in tasks of at
+    # most chunk cases of one geometry, as (config, tilt, rotation, cases). 
+    # Chunks keep the order of sweepGroups
+
+    tasks = []
+    for (config, tilt, rotation), cases in groups:
+        todo = [(c, k) for c, k in cases if caseKey(param, config, tilt, rotation, c, k) not in done]
+        for i in range(0, len(todo), chunk):
+            tasks.append((config, tilt, rotation, todo[i:i+chunk]))
+    return tasks
+
+worker = {}     # State of a worker process, see initWorker
+
+def initWorker(param_file, param_id, threads, output, queue):
+    # Each worker uses threads CPU threads (treecode kernels and BLAS), and
+    # writes the solver output to its own log next to the results table.
+    # Results of each case go to queue
+
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[var] = str(threads)
+    sys.stdout = open('%s.%i.log'%(output, os.getpid()), 'a', buffering=1)
+
+    worker['param']    = param_file
+    worker['param_id'] = param_id
+    worker['threads']  = threads
+    worker['queue']    = queue
+    worker['geometry'] = None   # (config, tilt, rotation) of the Session
+    worker['run']      = None
+
+def newSession(config, tilt, rotation):
+    # Session of a geometry, replacing the one of the worker. Moved meshes and
+    # charges are only needed while the Session reads them
+
+    from session import Session     # in the worker, after initWorker
+
+    worker['geometry'] = None
+    worker['run'] = None
+    remove = []
+    try:
+        config_run = config
+        if tilt!='-':
+            name = '_sweep_%s_%s_%i'%(tilt, rotation, os.getpid())
+            config_run, remove = moveProtein(config, tilt, rotation, name)
+        run = Session(worker['param'], config_run, cache=(None if tilt=='-' else False), threads=worker['threads'])
+    finally:
+        for f in remove:
+            if os.path.isfile(f):
+                os.remove(f)
+
+#   Charges of the config file, for '-' cases after other charges
+    charged = [f for f in run.field_array if len(f.q)>0]
+    worker['charges_config'] = None
+    if len(charged)==1:
+        worker['charges_config'] = (charged[0].xq.copy(), charged[0].q.copy())
+    worker['charges']  = '-'
+    worker['kappa']    = '-'
+    worker['geometry'] = (config, tilt, rotation)
+    worker['run']      = run
+
+def runCases(task):
+    # Runs the cases of one task on the Session of their geometry, and sends
+    # ('row', row) or ('error', message) to the main process for each case.
+    # Failed cases are not in the table, they run again next time
+
+    config, tilt, rotation, cases = task
+    queue = worker['queue']
+
+    if worker['geometry']!=(config, tilt, rotation):
+        try:
+            newSession(config, tilt, rotation)
+        except Exception as e:
+            for c, k in cases:
+                queue.put(('error', '%s: %r'%(caseKey(worker['param_id'], config, tilt, rotation, c, k), e)))
+            return
+
+    for charges, kappa in cases:
+        key = caseKey(worker['param_id'], config, tilt, rotation, charges, kappa)
+        tic = time.time()
+        try:
+#           The kappa of the config file is only on a Session where no other was set
+            if worker['geometry']!=(config, tilt, rotation) or (kappa=='-' and worker['kappa']!='-'):
+                newSession(config, tilt, rotation)
+            run = worker['run']
+
+#           Charges and kappa are only set on the Session when they change
+            q = None
+            if charges!=worker['charges']:
+                q = worker['charges_config'] if charges=='-' else charges
+            k = None
+            if kappa!=worker['kappa'] and kappa!='-':
+                k = float(kappa)
+            worker['charges'], worker['kappa'] = charges, kappa
+            run.solve(charges=q, kappa=k)
+            E = run.energies()
+        except Exception as e:
+            print('Case %s failed: %r'%(key, e))
+            queue.put(('error', '%s: %r'%(key, e)))
+            if worker['run'] is not None:
+                worker['charges'], worker['kappa'] = None, None
+                worker['run'].phi = None
+            continue
+        queue.put(('row', [key, config, tilt, rotation, charges, kappa, run.param.N, run.iterations,
+                           sum(E['Esolv']), sum(E['Esurf']), sum(E['Ecoul']), time.time()-tic]))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='To run: ./sweep.py sweep_file')
+    parser.add_argument('sweep_file', help='Sweep file, see README_input_format for format details')
+    args = parser.parse_args()
+
+    sweep = readSweep(args.sweep_file)
+    done = readDone(sweep['output'])
+    groups = sweepGroups(sweep)
+    param_id = paramId(sweep['param'])
+
+    Ncase = sum([len(cases) for geometry, cases in groups])
+    Ntodo = sum([len(t[3]) for t in sweepTasks(groups, done, Ncase+1, param_id)])
+    chunk = sweep['chunk']
+    if chunk<=0:    # about one task per worker, or one per geometry if there are more
+        chunk = max(1, (Ntodo+sweep['workers']-1)//sweep['workers'])
+    tasks = sweepTasks(groups, done, chunk, param_id)
+
+    print('Sweep %s: %i cases, %i in %s, %i to run in %i tasks of up to %i cases'%(args.sweep_file, Ncase, Ncase-Ntodo, sweep['output'], Ntodo, len(tasks), chunk))
+    print('%i workers with %i threads each, solver output in %s.<pid>.log'%(sweep['workers'], sweep['threads'], sweep['output']))
+
+    if not os.path.isfile(sweep['output']):
+        f = open(sweep['output'], 'w')
+        csv.writer(f).writerow(columns)
+        f.close()
+
+    TIC = time.time()
+    Nrun = 0
+    Nfail = 0
+    queue = multiprocessing.Queue()
+    pool = multiprocessing.Pool(sweep['workers'], initWorker, (sweep['param'], param_id, sweep['threads'], sweep['output'], queue))
+    result = pool.map_async(runCases, tasks, chunksize=1)
+    while Nrun+Nfail<Ntodo:
+        try:
+            kind, item = queue.get(timeout=1.)
+        except Empty:
+            if result.ready():
+                result.get()        # raises the error of a worker that died
+                break
+            continue
+#       Each row is written as soon as its case is solved, so it survives an interruption
+        if kind=='row':
+            f = open(sweep['output'], 'a')
+            csv.writer(f).writerow(item)
+            f.close()
+            print('%s: Esolv = %f, Esurf = %f, Ecoul = %f kcal/mol (%.1fs)'%(item[0], item[8], item[9], item[10], item[11]))
+            Nrun += 1
+        else:
+            print('FAILED '+item)
+            Nfail += 1
+    pool.close()
+    pool.join()
+
+    print('\n%i cases run, %i failed, in %f s'%(Nrun, Nfail, time.time()-TIC))
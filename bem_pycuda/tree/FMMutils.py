@@ -24,217 +24,170 @@ from numpy              import *
 from numpy              import sum as npsum
 from scipy.special      import factorial
 from scipy.special      import comb
+from scipy.sparse       import csr_matrix
 
 # Wrapped code
-from multipole          import multipole_c, setIndex, getIndex_arr, multipole_sort, multipoleKt_sort
-from direct             import direct_c, direct_sort, directKt_sort
-from calculateMultipoles import P2M, M2M
+from multipole          import multipole_c, setIndex, getIndex_arr, multipole_sort, multipole_sort_block, multipoleKt_sort
+from direct             import direct_c, direct_sort, direct_sort_block, directKt_sort, direct_assemble, setThreads, getThreads
+from calculateMultipoles import P2M, P2M_tree, P2M_tree_block, M2M, M2M_level, M2M_level_block
 
-# CUDA libraries
-import pycuda.driver as cuda
+# CUDA libraries, loaded on first use by the GPU backend
+from backend import cuda
 
 import time
 
 
-class Cell():
-    def __init__ (self, NCRIT, Nm):
-        Nm = int(Nm)
-        self.nsource   = 0       # Number of source particles
-        self.ntarget = 0       # Number of target particles
-        self.nchild  = 0      # Number of child boxes in binary
-                              # This will be a 8bit value and if certain 
-                              # child exists, that bit will be 1.
-
-        self.source = array([], dtype=int32)        # Pointer to source particles
-        self.target = array([], dtype=int32)        # Pointer to target particles
-        self.xc = 0.                                # x position of cell
-        self.yc = 0.                                # y position of cell
-        self.zc = 0.                                # z position of cell
-        self.r  = 0.                                # cell radius
-
-        self.parent = 0                             # Pointer to parent cell
-        self.child  = zeros(8, dtype=int32)         # Pointer to child cell
-
-        self.M = zeros(Nm)                          # Array with multipoles
-        self.Md = zeros(Nm)                         # Array with multipoles for grad(G).n
-
-        self.P2P_list = array([], dtype=int32)       # Pointer to cells that interact with P2P
-        self.M2P_list = []                           # Pointer to cells that interact with M2P
-        self.M2P_size = []                           # Size of the M2P interaction list
-        self.list_ready = 0                          # Flag to know if P2P list is already generated
-        self.twig_array = []                         # Position in the twig array
-
-def add_child(octant, Cells, i, NCRIT, Nm, Ncell):
-    # add_child adds child cell to Cells array
-    # octant: octant of the child cell
-    # Cells : arrays with cells
-    # i     : index of parent cell in Cells array
-
-    CN    = Cell(NCRIT, Nm) # CN: child cell
-    CN.r  = Cells[i].r/2
-    CN.xc = Cells[i].xc + CN.r*((octant&1)*2-1) # octant&X returns X if true
-    CN.yc = Cells[i].yc + CN.r*((octant&2)-1)   # Want to make ((octant&X)*Y - Z)=1
-    CN.zc = Cells[i].zc + CN.r*((octant&4)/2-1)
-    CN.parent = i
-    Cells[i].child[octant] = Ncell 
-    Cells[i].nchild|=(1<<octant)
-    Cells[Ncell] = CN
-    Ncell += 1
-
-    return Ncell
-
-def split_cell(x, y, z, Cells, C, NCRIT, Nm, Ncell):
-    # split_cell splits cell with more than NCRIT particles
-    # x,y,z: positions of particles
-    # Cells: array of cells
-    # C    : index of cell to be split in Cells array
-
-    for l in Cells[C].target:
-        octant = int(x[l]>Cells[C].xc) + int(y[l]>Cells[C].yc)*2 + int(z[l]>Cells[C].zc)*4
-        if (not(Cells[C].nchild & (1<<octant))): # Ask if octant exists already
-            Ncell = add_child(octant, Cells, C, NCRIT, Nm, Ncell)
-
-        CC = Cells[C].child[octant] # Pointer to child cell
-        Cells[CC].target = append(Cells[CC].target, l)
-        Cells[CC].ntarget += 1
-
-        if (Cells[CC].ntarget >= NCRIT):
-            Ncell = split_cell(x, y, z, Cells, CC, NCRIT, Nm, Ncell)
-
-    return Ncell
+class Octree():
+    def __init__ (self):
+        self.Ncell     = 0      # Number of cells
+        self.xc        = []     # x position of cells
+        self.yc        = []     # y position of cells
+        self.zc        = []     # z position of cells
+        self.r         = []     # cell radius
+        self.level     = []     # level of cell in tree (root is 0)
+        self.parent    = []     # Pointer to parent cell (-1 for root)
+        self.child     = []     # Pointer to child cells, (Ncell,8) array (-1 if child doesn't exist)
+        self.nchild    = []     # Existing child boxes in binary
+                                # This will be a 8bit value and if certain 
+                                # child exists, that bit will be 1.
+        self.octant    = []     # Octant of cell inside its parent
+        self.ntarget   = []     # Number of target particles in cell
+        self.offTarget = []     # Pointer to first target of cell in target array
+        self.target    = []     # Target particles, sorted so that targets of every cell are contiguous
+        self.twig      = []     # Pointer to twig cells, in depth-first order
+        self.twig_array= []     # Position in the twig array (-1 if cell is not a twig)
+        self.source    = []     # Source particles, sorted so that sources of every twig are contiguous
+        self.offSource = []     # Pointer to first source of twig in source array
+        self.M         = []     # Multipoles, (Ncell,Nm) array
+        self.Md        = []     # Multipoles for grad(G).n, (Ncell,Nm) array
+
+def cellRanges(start, size):
+    # Positions of all elements in the contiguous ranges [start,start+size)
+    ptr = zeros(len(size)+1, dtype=int64)
+    ptr[1:] = cumsum(size)
+    return repeat(start-ptr[:-1], size) + arange(ptr[-1])
 
 def generateTree(xi, yi, zi, NCRIT, Nm, N, radius, x_center):
-    # Target-based tree
-
-    C0 = Cell(NCRIT, Nm)
-    C0.xc = x_center[0]
-    C0.yc = x_center[1]
-    C0.zc = x_center[2]
-    C0.r  = radius
-
-    Cells = [Cell(NCRIT,Nm)]*N
-    Cells[0] = C0
-    Ncell = 1
-    for i in range(N):
-
-        C = 0 
-        while (Cells[C].ntarget>=NCRIT):
-            Cells[C].ntarget+=1
-
-            octant = int(xi[i]>Cells[C].xc) + int(yi[i]>Cells[C].yc)*2 + int(zi[i]>Cells[C].zc)*4
-            if (not(Cells[C].nchild & (1<<octant))):
-                Ncell = add_child(octant, Cells, C, NCRIT, Nm, Ncell)
-        
-            C = Cells[C].child[octant]
-
-        Cells[C].target = append(Cells[C].target, i) 
-        Cells[C].ntarget += 1
-
-        if (Cells[C].ntarget>=NCRIT):
-            Ncell = split_cell(xi,yi,zi,Cells,C, NCRIT, Nm, Ncell)
-
-    Cells = Cells[:Ncell]
-    return Cells
-
-def findTwigs(Cells, C, twig, NCRIT):
-    # Cells     : array of cells
-    # C         : index of cell in Cells array 
-    # twig      : array with indices of twigs in Cells array
-
-    if (Cells[C].ntarget>=NCRIT):
-        for c in range(8):
-            if (Cells[C].nchild & (1<<c)):
-                twig = findTwigs(Cells, Cells[C].child[c], twig, NCRIT)
-    else:
-        twig.append(C)
-        Cells[C].twig_array = int32(len(twig)-1)
+    # Target-based tree, built one level at a time
+    # At each level, the targets of cells with NCRIT or more targets are sorted
+    # by their octant (the next digit of their Morton key), so the targets of 
+    # every cell are a contiguous range of tree.target
+
+    tree = Octree()
+    tree.target = arange(N, dtype=int32)
+
+    xc        = [array([x_center[0]])]
+    yc        = [array([x_center[1]])]
+    zc        = [array([x_center[2]])]
+    r         = [array([radius])]
+    level     = [zeros(1, dtype=int32)]
+    parent    = [array([-1], dtype=int32)]
+    octant    = [array([-1], dtype=int32)]
+    offTarget = [zeros(1, dtype=int64)]
+    ntarget   = [array([N], dtype=int64)]
+
+    first = 0   # Pointer to first cell in current level
+    lev   = 0
+    while True:
+        split = where(ntarget[-1]>=NCRIT)[0]    # Cells in level to be split
+        if len(split)==0:
+            break
+
+        size = ntarget[-1][split]
+        pos  = cellRanges(offTarget[-1][split], size)
+        cell = repeat(arange(len(split)), size)
+        t    = tree.target[pos]
+
+        oct_t = int32(xi[t]>xc[-1][split][cell]) + int32(yi[t]>yc[-1][split][cell])*2 + int32(zi[t]>zc[-1][split][cell])*4
+        key   = 8*cell + oct_t
+        order = argsort(key, kind='stable')
+        tree.target[pos] = t[order]
+
+        key, ifirst, count = unique(key[order], return_index=True, return_counts=True)
+        P_aux = split[key//8]       # Parent in level list
+        O_aux = int32(key%8)
+        r_aux = r[-1][P_aux]/2
+
+        xc.append(xc[-1][P_aux] + r_aux*((O_aux&1)*2-1)) # octant&X returns X if true
+        yc.append(yc[-1][P_aux] + r_aux*((O_aux&2)-1))   # Want to make ((octant&X)*Y - Z)=1
+        zc.append(zc[-1][P_aux] + r_aux*((O_aux&4)//2-1))
+        r.append(r_aux)
+        level.append(zeros(len(key), dtype=int32)+lev+1)
+        parent.append(int32(first+P_aux))
+        octant.append(O_aux)
+        offTarget.append(pos[ifirst])
+        ntarget.append(count)
+
+        first += len(ntarget[-2])
+        lev   += 1
+
+    tree.xc        = concatenate(xc)
+    tree.yc        = concatenate(yc)
+    tree.zc        = concatenate(zc)
+    tree.r         = concatenate(r)
+    tree.level     = concatenate(level)
+    tree.parent    = concatenate(parent)
+    tree.octant    = concatenate(octant)
+    tree.offTarget = concatenate(offTarget)
+    tree.ntarget   = concatenate(ntarget)
+    tree.Ncell     = len(tree.xc)
+
+    tree.child  = zeros((tree.Ncell,8), dtype=int32) - 1
+    tree.nchild = zeros(tree.Ncell, dtype=int32)
+    tree.child[tree.parent[1:],tree.octant[1:]] = arange(1,tree.Ncell)
+    bitwise_or.at(tree.nchild, tree.parent[1:], 1<<tree.octant[1:])
+
+    tree.M  = zeros((tree.Ncell,int(Nm)))
+    tree.Md = zeros((tree.Ncell,int(Nm)))
+
+    return tree
+
+def findTwigs(tree, NCRIT):
+    # Twigs are cells with less than NCRIT targets. Targets are sorted
+    # depth-first, so ordering twigs by their first target gives
+    # the depth-first order
+
+    twig = where(tree.ntarget<NCRIT)[0]
+    twig = int32(twig[argsort(tree.offTarget[twig], kind='stable')])
+
+    tree.twig = twig
+    tree.twig_array = zeros(tree.Ncell, dtype=int32) - 1
+    tree.twig_array[twig] = arange(len(twig))
 
     return twig
 
-
-def addSources2(x,y,z,j,Cells,C,NCRIT):
-    # x,y,z: location of sources
-    # j    : index of source
-    # Cells: array with cells
-    # C    : index of cell in Cells array
-    # NCRIT: max number of target particles per cell
-
-    if (Cells[C].ntarget>=NCRIT):
-        octant = (x[j]>Cells[C].xc) + ((y[j]>Cells[C].yc) << 1) + ((z[j]>Cells[C].zc) << 2)
-        if (Cells[C].nchild & (1<<octant)): # If child cell exists, use
-            O = octant
-        else:                               # If child cell doesn't exist add to closest existing child
-            r = []
-            child = []
-            for c in range(8):
-                if (Cells[C].nchild & (1<<c)):
-                    dx = x[j]-Cells[Cells[C].child[c]].xc
-                    dy = y[j]-Cells[Cells[C].child[c]].yc
-                    dz = z[j]-Cells[Cells[C].child[c]].zc
-                    r.append(sqrt(dx*dx+dy*dy+dz*dz))
-                    child.append(c)
-            close_child = r.index(min(r))   # Find index of closest child
-            O = child[close_child]              
-        addSources2(x,y,z,j,Cells, Cells[C].child[O],NCRIT)
-        
-    else:
-        Cells[C].nsource += 1
-        Cells[C].source = append(Cells[C].source, j)
-
-def addSources(x,y,z,Cells,twig):
-    # x,y,z: location of sources
-    # Cells: array with cells
-    # twig : array with pointers to twigs of cells array
-
-    dx = zeros((len(twig),len(x)))
-    dy = zeros((len(twig),len(x)))
-    dz = zeros((len(twig),len(x)))
-    j = 0
-    for t in twig:
-        dx[j] = x - Cells[t].xc
-        dy[j] = y - Cells[t].yc
-        dz[j] = z - Cells[t].zc
-        j+=1
-    r = sqrt(dx*dx+dy*dy+dz*dz)
-
-    close_twig = argmin(r,axis=0)
-
-    for j in range(len(close_twig)):
-        Cells[twig[close_twig[j]]].nsource += 1
-        Cells[twig[close_twig[j]]].source = append(Cells[twig[close_twig[j]]].source, j)
-
-def addSources3(Cells, twig, K):
+def addSources3(tree, twig, K):
     # This version of addSources puts the sources in the same cell
     # as the collocation point of the same panel
+    # Inside a twig, sources are ordered by Gauss point, then by target
     
-    for C in twig:
-        Cells[C].nsource = K*Cells[C].ntarget
-        for j in range(K):
-            Cells[C].source = append(Cells[C].source, K*Cells[C].target + j) 
+    size   = tree.ntarget[twig]
+    target = tree.target[cellRanges(tree.offTarget[twig], size)]
+    twig_t = repeat(arange(len(twig)), size)
+
+    source = (K*target + arange(K)[:,newaxis]).ravel()
+    order  = argsort(tile(twig_t,K), kind='stable')
+    tree.source = int32(source[order])
+
+    tree.offSource = zeros(len(twig)+1, dtype=int32)
+    tree.offSource[1:] = cumsum(K*size)
      
 
-def sortPoints(surface, Cells, twig, param):
+def sortPoints(surface, tree, twig, param):
 
     Nround = len(twig)*param.NCRIT
+    size = tree.ntarget[twig]
+    ptr  = cellRanges(arange(len(twig))*param.NCRIT, size)  # Position in sorted array
+    tar  = tree.target[cellRanges(tree.offTarget[twig], size)]
 
     surface.sortTarget   = zeros(Nround, dtype=int32)
     surface.unsort       = zeros(len(surface.xi), dtype=int32)
-    surface.sortSource   = zeros(len(surface.xj), dtype=int32)
-    surface.offsetSource = zeros(len(twig)+1, dtype=int32)
-    surface.offsetTarget = zeros(len(twig), dtype=int32)
-    surface.sizeTarget   = zeros(len(twig), dtype=int32)
-    offTar = 0
-    offSrc = 0
-    i = 0
-    for C in twig:
-        surface.sortTarget[param.NCRIT*i:param.NCRIT*i+Cells[C].ntarget] = Cells[C].target
-        surface.unsort[Cells[C].target] = range(param.NCRIT*i,param.NCRIT*i+Cells[C].ntarget)
-        surface.sortSource[offSrc:offSrc+Cells[C].nsource]   = Cells[C].source
-        offSrc += Cells[C].nsource
-        surface.offsetSource[i+1] = offSrc
-        surface.offsetTarget[i]   = i*param.NCRIT
-        surface.sizeTarget[i]     = Cells[C].ntarget
-        i += 1
+    surface.sortTarget[ptr] = tar
+    surface.unsort[tar]     = ptr
+    surface.sortSource   = tree.source.copy()
+    surface.offsetSource = tree.offSource.copy()
+    surface.offsetTarget = int32(arange(len(twig))*param.NCRIT)
+    surface.sizeTarget   = int32(size)
 
     surface.xiSort = surface.xi[surface.sortTarget]
     surface.yiSort = surface.yi[surface.sortTarget]
@@ -247,6 +200,7 @@ def sortPoints(surface, Cells, twig, param):
     surface.sglInt_extSort = surface.sglInt_ext[surface.sortSource//param.K]
     surface.triangleSort = surface.triangle[surface.sortSource//param.K]
 
+
 def computeIndices(P, ind0):
     II = []
     JJ = []
@@ -293,53 +247,108 @@ def precomputeTerms(P, ind0):
         ind0.JJmjj = append(ind0.JJmjj, ind0.JJ[i]-jj)
         ind0.KKmkk = append(ind0.KKmkk, ind0.KK[i]-kk)
 
-def interactionList(surfSrc,surfTar,CJ,CI,theta,NCRIT,offTwg,offMlt,s_src):
-    # Cells     : array of Cells
-    # CJ        : index of source cell
-    # CI        : index of target cell
+def dualTreeList(src, tar, theta, NCRIT):
+    # Dual-tree traversal: builds P2P and M2P lists of all target twigs at once
+    # src       : source tree
+    # tar       : target tree (lists are generated for tar.twig)
     # theta     : MAC criteron 
     # NCRIT     : max number of particles per cell
+    # The frontier holds (target twig, source cell) pairs that fail the MAC
+    # and it is expanded one source level per pass. Lists come out in the same
+    # depth-first order as a recursive descent from the source root.
+
+    # Depth-first (preorder) rank of source cells: targets are sorted
+    # depth-first, and parents come before children with the same first target
+    rank = zeros(src.Ncell, dtype=int64)
+    rank[lexsort((src.level,src.offTarget))] = arange(src.Ncell)
+
+    Ntwig = len(tar.twig)
+    CI = arange(Ntwig)                  # Position in target twig array
+    CJ = zeros(Ntwig, dtype=int32)      # Source cell
+    P2P_I, P2P_J, M2P_I, M2P_J = [], [], [], []
+    while len(CI)>0:
+        twig = src.ntarget[CJ]<NCRIT
+        P2P_I.append(CI[twig])
+        P2P_J.append(CJ[twig])
+        CI = CI[~twig]
+        CJ = CJ[~twig]
+
+        child = src.child[CJ]
+        exist = child>=0
+        CI = (zeros((len(CI),8), dtype=int64)+CI[:,newaxis])[exist]
+        CC = child[exist]               # Points at child cell
+        CT = tar.twig[CI]
+
+        dxi = src.xc[CC] - tar.xc[CT]
+        dyi = src.yc[CC] - tar.yc[CT]
+        dzi = src.zc[CC] - tar.zc[CT]
+        r   = sqrt(dxi*dxi+dyi*dyi+dzi*dzi)
+        near = tar.r[CT]+src.r[CC] > theta*r # Max distance between particles
+
+        M2P_I.append(CI[~near])
+        M2P_J.append(CC[~near])
+        CI = CI[near]
+        CJ = CC[near]
+
+    P2P_I = concatenate(P2P_I)
+    P2P_J = concatenate(P2P_J)
+    M2P_I = concatenate(M2P_I)
+    M2P_J = concatenate(M2P_J)
+
+    order = lexsort((rank[P2P_J],P2P_I))
+    P2P_list = int32(src.twig_array[P2P_J[order]])
+    offTwg   = zeros(Ntwig+1, dtype=int32)
+    offTwg[1:] = cumsum(bincount(P2P_I, minlength=Ntwig))
+
+    order = lexsort((rank[M2P_J],M2P_I))
+    M2P_list = int32(M2P_J[order])
+    offMlt   = zeros(Ntwig+1, dtype=int32)
+    offMlt[1:] = cumsum(bincount(M2P_I, minlength=Ntwig))
+
+    return P2P_list, offTwg, M2P_list, offMlt
+
+def interactionList(surfSrc, surfTar, s_src, theta, NCRIT):
+    # Interaction lists of surfSrc on all twigs of surfTar 
+    # Offsets are relative to the start of the lists of this pair of surfaces
+
+    P2P_list, offTwg, M2P_list, offMlt = dualTreeList(surfSrc.tree, surfTar.tree, theta, NCRIT)
+
+    surfTar.offsetTwigs[s_src] = offTwg
+    surfTar.offsetMlt[s_src]   = offMlt
+
+    return P2P_list, M2P_list
+
+def getList(surf, s_src, list_name):
+    # Interaction list of source surface s_src on surf, out of the compact storage
+    # list_name: 'P2P' or 'M2P'
+
+    if list_name=='P2P':
+        return surf.P2P_list[surf.P2P_ptr[s_src]:surf.P2P_ptr[s_src+1]]
+    else:
+        return surf.M2P_list[surf.M2P_ptr[s_src]:surf.M2P_ptr[s_src+1]]
 
-    if (surfSrc.tree[CJ].ntarget>=NCRIT):
-        for c in range(8):
-            if (surfSrc.tree[CJ].nchild & (1<<c)):
-                CC = surfSrc.tree[CJ].child[c]  # Points at child cell
-                dxi = surfSrc.tree[CC].xc - surfTar.tree[CI].xc
-                dyi = surfSrc.tree[CC].yc - surfTar.tree[CI].yc
-                dzi = surfSrc.tree[CC].zc - surfTar.tree[CI].zc
-                r   = sqrt(dxi*dxi+dyi*dyi+dzi*dzi)
-                if surfTar.tree[CI].r+surfSrc.tree[CC].r > theta*r: # Max distance between particles
-                    offTwg, offMlt = interactionList(surfSrc,surfTar,CC,CI,theta,NCRIT,offTwg,offMlt,s_src)
-                else:
-                    I = surfTar.tree[CI].M2P_size[s_src]
-                    surfTar.M2P_list[s_src,offMlt] = CC
-                    offMlt += 1 
-    else: 
-        twig_cell = surfSrc.tree[CJ].twig_array
-        surfTar.P2P_list[s_src,offTwg] = twig_cell
-        offTwg += 1
-
-    return offTwg, offMlt
-
-def generateList(surf_array, field_array, param):
+def generateList(surf_array, field_array, param, keep=None):
+    # keep: (target, source) surface pairs whose current lists are still valid
+    #       (surfaces that moved together as a rigid body, see rigid.py). They
+    #       are taken from the current lists, the other pairs are generated
     
     Nsurf  = len(surf_array)
     Nfield = len(field_array) 
+    if keep is None:
+        keep = set()
 
     # Allocate data
-    maxTwigSize = 0 
+    # Lists of all source surfaces are stored one after the other, P2P_ptr and 
+    # M2P_ptr point to the first element of each source surface
+    P2P = []
+    M2P = []
     for i in range(Nsurf):
-        maxTwigSize = max(len(surf_array[i].twig),maxTwigSize)
-        maxTwigSize = max(len(surf_array[i].tree),maxTwigSize)
-
-    for i in range(Nsurf):
-        surf_array[i].P2P_list    = zeros((Nsurf,maxTwigSize*maxTwigSize), dtype=int32)
-        surf_array[i].offsetTwigs = zeros((Nsurf,maxTwigSize+1), dtype=int32)
-        surf_array[i].M2P_list    = zeros((Nsurf,maxTwigSize*maxTwigSize), dtype=int32)
-        surf_array[i].offsetMlt   = zeros((Nsurf,maxTwigSize+1), dtype=int32) 
-        for CI in surf_array[i].twig:
-            surf_array[i].tree[CI].M2P_list = zeros((Nsurf,maxTwigSize), dtype=int32)
-            surf_array[i].tree[CI].M2P_size = zeros(Nsurf, dtype=int32)
+        Ntwig = len(surf_array[i].twig)
+        if len(keep)==0:
+            surf_array[i].offsetTwigs = zeros((Nsurf,Ntwig+1), dtype=int32)
+            surf_array[i].offsetMlt   = zeros((Nsurf,Ntwig+1), dtype=int32) 
+        P2P.append([zeros(0, dtype=int32)]*Nsurf)
+        M2P.append([zeros(0, dtype=int32)]*Nsurf)
 
     # Generate list
     # Non-self interaction
@@ -351,105 +360,144 @@ def generateList(surf_array, field_array, param):
 
         for s_tar in S:                             # Loop over surfaces
             for s_src in S:
-                offTwg = 0 
-                offMlt = 0 
-                ii = 0 
-                for CI in surf_array[s_tar].twig:
-                    if s_src!=s_tar:                # Non-self interaction
-                        CJ = 0 
-                        offTwg, offMlt = interactionList(surf_array[s_src],surf_array[s_tar],CJ,CI,param.theta,param.NCRIT,offTwg,offMlt,s_src)
-                        surf_array[s_tar].offsetTwigs[s_src,ii+1] = offTwg
-                        surf_array[s_tar].offsetMlt[s_src,ii+1] = offMlt
-                        ii += 1
+                if s_src!=s_tar and (s_tar,s_src) in keep:
+                    P2P[s_tar][s_src] = getList(surf_array[s_tar], s_src, 'P2P')
+                    M2P[s_tar][s_src] = getList(surf_array[s_tar], s_src, 'M2P')
+                elif s_src!=s_tar:                  # Non-self interaction
+                    P2P[s_tar][s_src], M2P[s_tar][s_src] = interactionList(surf_array[s_src],surf_array[s_tar],
+                                                                            s_src,param.theta,param.NCRIT)
 
     # Self interaction
     for s in range(Nsurf):
-        offTwg = 0 
-        offMlt = 0 
-        ii = 0 
-        for CI in surf_array[s].twig:
-            CJ = 0 
-            offTwg, offMlt = interactionList(surf_array[s],surf_array[s],CJ,CI,param.theta,param.NCRIT,offTwg,offMlt,s)
-            surf_array[s].offsetTwigs[s,ii+1] = offTwg
-            surf_array[s].offsetMlt[s,ii+1]   = offMlt
-            ii += 1
+        if (s,s) in keep:
+            P2P[s][s], M2P[s][s] = getList(surf_array[s], s, 'P2P'), getList(surf_array[s], s, 'M2P')
+        elif surf_array[s].copy_of is not None:
+            # Rigid copy of an earlier surface (shareSurface in classes.py): same
+            # tree, so it takes the self lists of the original. Lists from the
+            # moved cell centers could differ at MAC ties and would not match
+            # the near-field self block it shares (copyBlock)
+            s_orig, orig = surf_array[s].copy_of
+            P2P[s][s], M2P[s][s] = P2P[s_orig][s_orig], M2P[s_orig][s_orig]
+            surf_array[s].offsetTwigs[s] = orig.offsetTwigs[s_orig]
+            surf_array[s].offsetMlt[s]   = orig.offsetMlt[s_orig]
+        else:
+            P2P[s][s], M2P[s][s] = interactionList(surf_array[s],surf_array[s],s,param.theta,param.NCRIT)
 
 
     for s_tar in range(Nsurf):
-        surf_array[s_tar].xcSort = zeros((Nsurf, maxTwigSize*maxTwigSize))
-        surf_array[s_tar].ycSort = zeros((Nsurf, maxTwigSize*maxTwigSize))
-        surf_array[s_tar].zcSort = zeros((Nsurf, maxTwigSize*maxTwigSize))
+        surf = surf_array[s_tar]
+        surf.P2P_ptr = zeros(Nsurf+1, dtype=int32)
+        surf.M2P_ptr = zeros(Nsurf+1, dtype=int32)
+        surf.P2P_ptr[1:] = cumsum([len(l) for l in P2P[s_tar]])
+        surf.M2P_ptr[1:] = cumsum([len(l) for l in M2P[s_tar]])
+        surf.P2P_list = int32(concatenate(P2P[s_tar]))
+        surf.M2P_list = int32(concatenate(M2P[s_tar]))
+
+        surf.xcSort = zeros(len(surf.M2P_list))
+        surf.ycSort = zeros(len(surf.M2P_list))
+        surf.zcSort = zeros(len(surf.M2P_list))
         for s_src in range(Nsurf):
-            M2P_size = surf_array[s_tar].offsetMlt[s_src,len(surf_array[s_tar].twig)]
-            i = -1
-            for C in surf_array[s_tar].M2P_list[s_src,0:M2P_size]:
-                i+=1
-                surf_array[s_tar].xcSort[s_src,i] = surf_array[s_src].tree[C].xc
-                surf_array[s_tar].ycSort[s_src,i] = surf_array[s_src].tree[C].yc
-                surf_array[s_tar].zcSort[s_src,i] = surf_array[s_src].tree[C].zc
+            ptr = slice(surf.M2P_ptr[s_src],surf.M2P_ptr[s_src+1])
+            C = surf.M2P_list[ptr]
+            surf.xcSort[ptr] = surf_array[s_src].tree.xc[C]
+            surf.ycSort[ptr] = surf_array[s_src].tree.yc[C]
+            surf.zcSort[ptr] = surf_array[s_src].tree.zc[C]
+
+    # Memory report: compact lists against (Nsurf, maxTwigSize**2) arrays
+    maxTwigSize = 0 
+    for i in range(Nsurf):
+        maxTwigSize = max(len(surf_array[i].twig),maxTwigSize)
+        maxTwigSize = max(surf_array[i].tree.Ncell,maxTwigSize)
+    mem = 0.
+    for surf in surf_array:
+        mem += surf.P2P_list.nbytes + surf.M2P_list.nbytes + surf.offsetTwigs.nbytes + surf.offsetMlt.nbytes \
+             + surf.xcSort.nbytes + surf.ycSort.nbytes + surf.zcSort.nbytes
+    mem_dense = Nsurf*Nsurf*(maxTwigSize*maxTwigSize*(2*4+3*8) + 2*(maxTwigSize+1)*4)
+    print('Interaction lists: %.2f MB (%.2f MB with dense storage)'%(mem/1e6, mem_dense/1e6))
 
         
 
 
-def getMultipole(Cells, C, x, y, z, mV, mKx, mKy, mKz, ind0, P, NCRIT):
-    # Cells     : array of cells
-    # C         : index of cell in Cells array 
+def getMultipole(tree, x, y, z, mV, mKx, mKy, mKz, ind0, P, NCRIT):
+    # tree      : octree
     # x,y,z     : position of particles
     # m         : weight of particles
     # P         : order of Taylor expansion
     # NCRIT     : max number of target particles per cell
     # II,JJ,KK  : x,y,z powers of multipole expansion
     # index     : 1D mapping of II,JJ,KK (index of multipoles)
+    # Weights with one right-hand side per row, (Nrhs,N), give (Nrhs,Ncell,Nm) multipoles
 
-    if (Cells[C].ntarget>=NCRIT):
-
-        Cells[C].M[:] = 0.0 # Initialize multipoles
-        Cells[C].Md[:] = 0.0
-
-        for c in range(8):
-            if (Cells[C].nchild & (1<<c)):
-                getMultipole(Cells, Cells[C].child[c], x, y, z, mV, mKx, mKy, mKz, ind0, P, NCRIT)
+    Nm = len(ind0.II)
+    Mshape = shape(mV)[:-1]+(tree.Ncell,Nm)
+    if shape(tree.M)!=Mshape:  # Order of expansion or number of right-hand sides changed
+        tree.M  = zeros(Mshape)
+        tree.Md = zeros(Mshape)
     else:
+        tree.M[:]  = 0.0 # Initialize multipoles
+        tree.Md[:] = 0.0
 
-        Cells[C].M[:] = 0.0 # Initialize multipoles
-        Cells[C].Md[:] = 0.0
-
-        l = Cells[C].source
-        P2M(Cells[C].M, Cells[C].Md, x[l], y[l], z[l], mV[l], mKx[l], mKy[l], mKz[l], Cells[C].xc, Cells[C].yc, Cells[C].zc, ind0.II, ind0.JJ, ind0.KK)
+    # P2M of all twigs in one call, writing into the rows of tree.M and tree.Md
+    if ndim(mV)==2:
+        P2M_tree_block(tree.M.ravel(), tree.Md.ravel(), x, y, z, ravel(mV), ravel(mKx), ravel(mKy), ravel(mKz), 
+                tree.xc, tree.yc, tree.zc, tree.twig, tree.source, tree.offSource, ind0.II, ind0.JJ, ind0.KK, len(mV))
+    else:
+        P2M_tree(tree.M.ravel(), tree.Md.ravel(), x, y, z, mV, mKx, mKy, mKz, tree.xc, tree.yc, tree.zc,
+                tree.twig, tree.source, tree.offSource, ind0.II, ind0.JJ, ind0.KK)
 
    
-def upwardSweep(Cells, CC, PC, P, II, JJ, KK, index, combII, combJJ, combKK, IImii, JJmjj, KKmkk, index_small, index_ptr):
-    # Cells     : array of cells
-    # CC        : index of child cell in Cells array
-    # PC        : index of parent cell in Cells array
+def upwardSweep(tree, CC, PC, P, II, JJ, KK, index, combII, combJJ, combKK, IImii, JJmjj, KKmkk, index_small, index_ptr):
+    # tree      : octree
+    # CC        : index of child cell in tree
+    # PC        : index of parent cell in tree
     # P         : order of Taylor expansion
     # II,JJ,KK  : x,y,z powers of multipole expansion
     # index     : 1D mapping of II,JJ,KK (index of multipoles)
 
-    dx = Cells[PC].xc - Cells[CC].xc
-    dy = Cells[PC].yc - Cells[CC].yc
-    dz = Cells[PC].zc - Cells[CC].zc
-
-    M2M(Cells[PC].M, Cells[CC].M, dx, dy, dz, II, JJ, KK, combII, combJJ, combKK, IImii, JJmjj, KKmkk, index_small, index_ptr)
-    M2M(Cells[PC].Md, Cells[CC].Md, dx, dy, dz, II, JJ, KK, combII, combJJ, combKK, IImii, JJmjj, KKmkk, index_small, index_ptr)
+    dx = tree.xc[PC] - tree.xc[CC]
+    dy = tree.yc[PC] - tree.yc[CC]
+    dz = tree.zc[PC] - tree.zc[CC]
+
+    M2M(tree.M[PC], tree.M[CC], dx, dy, dz, II, JJ, KK, combII, combJJ, combKK, IImii, JJmjj, KKmkk, index_small, index_ptr)
+    M2M(tree.Md[PC], tree.Md[CC], dx, dy, dz, II, JJ, KK, combII, combJJ, combKK, IImii, JJmjj, KKmkk, index_small, index_ptr)
+
+def upwardSweepTree(tree, ind0):
+    # M2M of the whole tree, one call per level from the deepest to the root
+    # tree      : octree
+    # ind0      : index_constant with the M2M tables from precomputeTerms
+
+    child = tree.child.ravel()
+    for l in reversed(range(max(tree.level))):
+        cells = int32(where((tree.level==l) & (tree.nchild>0))[0])  # Parent cells of level l
+        if ndim(tree.M)==3:     # One set of multipoles per right-hand side
+            M2M_level_block(tree.M.ravel(), tree.Md.ravel(), cells, child, tree.xc, tree.yc, tree.zc,
+                      ind0.II, ind0.JJ, ind0.KK, ind0.combII, ind0.combJJ, ind0.combKK,
+                      ind0.IImii, ind0.JJmjj, ind0.KKmkk, ind0.index_small, ind0.index_ptr, len(tree.M))
+        else:
+            M2M_level(tree.M.ravel(), tree.Md.ravel(), cells, child, tree.xc, tree.yc, tree.zc,
+                      ind0.II, ind0.JJ, ind0.KK, ind0.combII, ind0.combJJ, ind0.combKK,
+                      ind0.IImii, ind0.JJmjj, ind0.KKmkk, ind0.index_small, ind0.index_ptr)
 
 def M2P_sort(surfSrc, surfTar, K_aux, V_aux, surf, index, param, LorY, timing):
 
     tic = time.time()
-    M2P_size = surfTar.offsetMlt[surf,len(surfTar.twig)]
-    MSort  = zeros(param.Nm*M2P_size)
-    MdSort = zeros(param.Nm*M2P_size)
-
-    i = -1
-    for C in surfTar.M2P_list[surf,0:M2P_size]:
-        i+=1
-        MSort[i*param.Nm:i*param.Nm+param.Nm] = surfSrc.tree[C].M
-        MdSort[i*param.Nm:i*param.Nm+param.Nm] = surfSrc.tree[C].Md
-
-    multipole_sort(K_aux, V_aux, surfTar.offsetTarget, surfTar.sizeTarget, surfTar.offsetMlt[surf], 
-                    MSort, MdSort, surfTar.xiSort, surfTar.yiSort, surfTar.ziSort, 
-                    surfTar.xcSort[surf], surfTar.ycSort[surf], surfTar.zcSort[surf], index, 
-                    param.P, param.kappa, int(param.Nm), int(LorY) )
+    # The kernel reads multipoles and centers of the listed cells from the source tree
+    ptr = slice(surfTar.M2P_ptr[surf],surfTar.M2P_ptr[surf+1])
+    tree = surfSrc.tree
+
+    if ndim(K_aux)==2:
+        # Several right-hand sides (rows of K_aux and V_aux, multipoles (Nrhs,Ncell,Nm))
+        multipole_sort_block(K_aux.reshape(-1), V_aux.reshape(-1), surfTar.offsetTarget, surfTar.sizeTarget, 
+                        surfTar.offsetMlt[surf], surfTar.M2P_list[ptr], tree.M.ravel(), tree.Md.ravel(), 
+                        surfTar.xiSort, surfTar.yiSort, surfTar.ziSort, 
+                        tree.xc, tree.yc, tree.zc, index, 
+                        param.P, param.kappa, int(param.Nm), int(LorY), len(K_aux) )
+    else:
+        multipole_sort(K_aux, V_aux, surfTar.offsetTarget, surfTar.sizeTarget, surfTar.offsetMlt[surf], 
+                        surfTar.M2P_list[ptr], tree.M.ravel(), tree.Md.ravel(), 
+                        surfTar.xiSort, surfTar.yiSort, surfTar.ziSort, 
+                        tree.xc, tree.yc, tree.zc, index, 
+                        param.P, param.kappa, int(param.Nm), int(LorY) )
 
     toc = time.time()
     timing.time_M2P += toc-tic
@@ -459,18 +507,12 @@ def M2P_sort(surfSrc, surfTar, K_aux, V_aux, surf, index, param, LorY, timing):
 def M2PKt_sort(surfSrc, surfTar, Ktx_aux, Kty_aux, Ktz_aux, surf, index, param, LorY, timing):
 
     tic = time.time()
-    M2P_size = surfTar.offsetMlt[surf,len(surfTar.twig)]
-    MSort  = zeros(param.Nm*M2P_size)
-    MdSort = zeros(param.Nm*M2P_size)
-
-    i = -1
-    for C in surfTar.M2P_list[surf,0:M2P_size]:
-        i+=1
-        MSort[i*param.Nm:i*param.Nm+param.Nm] = surfSrc.tree[C].M
+    ptr = slice(surfTar.M2P_ptr[surf],surfTar.M2P_ptr[surf+1])
+    tree = surfSrc.tree
 
     multipoleKt_sort(Ktx_aux, Kty_aux, Ktz_aux, surfTar.offsetTarget, surfTar.sizeTarget, surfTar.offsetMlt[surf], 
-                    MSort, surfTar.xiSort, surfTar.yiSort, surfTar.ziSort, 
-                    surfTar.xcSort[surf], surfTar.ycSort[surf], surfTar.zcSort[surf], index, 
+                    surfTar.M2P_list[ptr], tree.M.ravel(), surfTar.xiSort, surfTar.yiSort, surfTar.ziSort, 
+                    tree.xc, tree.yc, tree.zc, index, 
                     param.P, param.kappa, int(param.Nm), int(LorY) )
 
     toc = time.time()
@@ -486,15 +528,9 @@ def M2P_gpu(surfSrc, surfTar, K_gpu, V_gpu, surf, ind0, param, LorY, timing, ker
     REAL = param.REAL
 
     tic.record()
-    M2P_size = surfTar.offsetMlt[surf,len(surfTar.twig)]
-    MSort  = zeros(param.Nm*M2P_size)
-    MdSort = zeros(param.Nm*M2P_size)
-
-    i = -1
-    for C in surfTar.M2P_list[surf,0:M2P_size]:
-        i+=1
-        MSort[i*param.Nm:i*param.Nm+param.Nm] = surfSrc.tree[C].M
-        MdSort[i*param.Nm:i*param.Nm+param.Nm] = surfSrc.tree[C].Md
+    C = getList(surfTar, surf, 'M2P')
+    MSort  = surfSrc.tree.M[C].ravel()
+    MdSort = surfSrc.tree.Md[C].ravel()
 
 #    (free, total) = cuda.mem_get_info()
 #    print 'Global memory occupancy: %f%% free'%(free*100/total)
@@ -504,8 +540,8 @@ def M2P_gpu(surfSrc, surfTar, K_gpu, V_gpu, surf, ind0, param, LorY, timing, ker
 #    print 'Global memory occupancy: %f%% free'%(free*100/total)
 
     # GPU arrays are flattened, need to point to first element 
-    ptr_offset  = surf*len(surfTar.offsetTwigs[surf])  # Pointer to first element of offset arrays 
-    ptr_list    = surf*len(surfTar.P2P_list[surf])     # Pointer to first element in lists arrays
+    ptr_offset  = surf*len(surfTar.offsetMlt[surf])    # Pointer to first element of offset arrays 
+    ptr_list    = surfTar.M2P_ptr[surf]                # Pointer to first element in lists arrays
 
     GSZ = int(ceil(float(param.Nround)/param.NCRIT)) # CUDA grid size
     multipole_gpu = kernel.get_function("M2P")
@@ -531,13 +567,8 @@ def M2PKt_gpu(surfSrc, surfTar, Ktx_gpu, Kty_gpu, Ktz_gpu, surf, ind0, param, Lo
     REAL = param.REAL
 
     tic.record()
-    M2P_size = surfTar.offsetMlt[surf,len(surfTar.twig)]
-    MSort  = zeros(param.Nm*M2P_size)
-
-    i = -1
-    for C in surfTar.M2P_list[surf,0:M2P_size]:
-        i+=1
-        MSort[i*param.Nm:i*param.Nm+param.Nm] = surfSrc.tree[C].M
+    C = getList(surfTar, surf, 'M2P')
+    MSort  = surfSrc.tree.M[C].ravel()
 
 #    (free, total) = cuda.mem_get_info()
 #    print 'Global memory occupancy: %f%% free'%(free*100/total)
@@ -546,8 +577,8 @@ def M2PKt_gpu(surfSrc, surfTar, Ktx_gpu, Kty_gpu, Ktz_gpu, surf, ind0, param, Lo
 #    print 'Global memory occupancy: %f%% free'%(free*100/total)
 
     # GPU arrays are flattened, need to point to first element 
-    ptr_offset  = surf*len(surfTar.offsetTwigs[surf])  # Pointer to first element of offset arrays 
-    ptr_list    = surf*len(surfTar.P2P_list[surf])     # Pointer to first element in lists arrays
+    ptr_offset  = surf*len(surfTar.offsetMlt[surf])    # Pointer to first element of offset arrays 
+    ptr_list    = surfTar.M2P_ptr[surf]                # Pointer to first element in lists arrays
 
     GSZ = int(ceil(float(param.Nround)/param.NCRIT)) # CUDA grid size
     multipoleKt_gpu = kernel.get_function("M2PKt")
@@ -567,11 +598,139 @@ def M2PKt_gpu(surfSrc, surfTar, Ktx_gpu, Kty_gpu, Ktz_gpu, surf, ind0, param, Lo
 
 
 
+def P2P_rowSize(surfSrc, surfTar, surf, param):
+    # Number of source panels each sorted target interacts with in P2P
+    Ntwig  = len(surfTar.twig)
+    panels = (surfSrc.offsetSource[1:]-surfSrc.offsetSource[:-1])//param.K
+    offTwg = surfTar.offsetTwigs[surf]
+    count  = panels[getList(surfTar, surf, 'P2P')]
+    count  = concatenate(([0],cumsum(count)))
+
+    rowSize = zeros(Ntwig*param.NCRIT, dtype=int64)
+    for t in range(Ntwig):
+        CI_start = surfTar.offsetTarget[t]
+        CI_end   = CI_start + surfTar.sizeTarget[t]
+        rowSize[CI_start:CI_end] = count[offTwg[t+1]] - count[offTwg[t]]
+
+    return rowSize
+
+def estimateP2Pcache(surf_array, field_array, param):
+    # Memory needed to store the near-field operator of every interacting 
+    # pair of surfaces (one kernel per pair)
+
+    pairs = []
+    for f in field_array:
+        S = f.child[:]
+        if len(f.parent)>0:
+            S.append(f.parent[0])
+        for s_tar in S:
+            for s_src in S:
+                if (s_tar,s_src) not in pairs:
+                    pairs.append((s_tar,s_src))
+
+    total = 0.
+    for s_tar, s_src in pairs:
+        nnz = npsum(P2P_rowSize(surf_array[s_src], surf_array[s_tar], s_src, param))
+        Nrow = len(surf_array[s_tar].twig)*param.NCRIT
+        total += (nnz*(2*8+4) + (Nrow+1)*4)/1e6     # K and V values, columns, row pointer
+
+    print('Near-field operator storage: %.1f MB per kernel (budget %.1f MB)'%(total, param.P2P_budget))
+    if total>param.P2P_budget:
+        print('Over budget: blocks that do not fit will be computed on the fly')
+
+    return total
+
+def P2P_assemble(surfSrc, surfTar, surf, LorY, K_diag, IorE, w, param):
+    # Sparse near-field operator of surfSrc on the sorted targets of surfTar
+    # Columns are sorted sources, only the first Gauss point of each panel 
+    # is used, so the blocks act directly on mKc and mVc of P2P_sort
+
+    K   = param.K
+    tri = surfSrc.sortSource//K # Triangle
+    k   = surfSrc.sortSource%K  # Gauss point
+
+    first = zeros(len(surfSrc.triangle), dtype=int32)
+    first[tri[k==0]] = where(k==0)[0]
+    colSrc = int32(first[tri])
+
+    rowSize = P2P_rowSize(surfSrc, surfTar, surf, param)
+    rowPtr  = zeros(len(rowSize)+1, dtype=int64)
+    rowPtr[1:] = cumsum(rowSize)
+    nnz = rowPtr[-1]
+
+    mem = (nnz*(2*8+4) + len(rowPtr)*4)/1e6
+    if param.P2P_mem+mem>param.P2P_budget:
+        return None, 0
+
+    K_val = zeros(nnz)
+    V_val = zeros(nnz)
+    col   = zeros(nnz, dtype=int32)
+
+    mV  = w[k]*surfSrc.AreaSort
+    mKx = mV*surfSrc.normal[tri,0]
+    mKy = mV*surfSrc.normal[tri,1]
+    mKz = mV*surfSrc.normal[tri,2]
+
+    aux = zeros(2)
+    direct_assemble(K_val, V_val, col, int32(rowPtr), int(LorY), K_diag, int(IorE), 
+            ravel(surfSrc.vertex[surfSrc.triangleSort[:]]), int32(k), colSrc, 
+            surfSrc.xjSort, surfSrc.yjSort, surfSrc.zjSort, surfTar.xiSort, surfTar.yiSort, surfTar.ziSort, 
+            mV, mKx, mKy, mKz, getList(surfTar, surf, 'P2P'), surfTar.offsetTarget, surfTar.sizeTarget, 
+            surfSrc.offsetSource, surfTar.offsetTwigs[surf], surfSrc.AreaSort, surfSrc.sglInt_intSort, 
+            surfSrc.sglInt_extSort, surfSrc.Xsk, surfSrc.Wsk, param.kappa, param.threshold, param.eps, aux)
+
+    Nrow = len(rowSize)
+    Ncol = len(surfSrc.sortSource)
+    K_mat = csr_matrix((K_val, col, rowPtr), shape=(Nrow,Ncol))
+    V_mat = csr_matrix((V_val, col, rowPtr), shape=(Nrow,Ncol))
+
+    param.P2P_mem += mem
+
+    return (K_mat, V_mat, int(aux[0])), aux[1]
+
+def blockMemory(block):
+    # Size in MB of a stored near-field block, as counted in P2P_assemble
+
+    K_mat = block[0]
+    return (K_mat.nnz*(2*8+4) + (K_mat.shape[0]+1)*4)/1e6
+
+def copyBlock(surfTar, surfSrc, key):
+    # Stored near-field self block of a rigid copy (surfTar.copy_of, see
+    # shareSurface in classes.py) is the one of its original. Returns it, also 
+    # stored in surfTar, or None if it is not a copy or the original has none
+
+    if surfSrc is not surfTar or surfTar.copy_of is None:
+        return None
+    s_orig, orig = surfTar.copy_of
+    block = orig.P2P_block.get((s_orig,)+key[1:])
+    if block is not None:
+        surfTar.P2P_block[key] = block
+
+    return block
+
 def P2P_sort(surfSrc, surfTar, m, mx, my, mz, mKc, mVc, K_aux, V_aux, 
             surf, LorY, K_diag, V_diag, IorE, L, w, param, timing):
 
     tic = time.time()
 
+    if param.P2P_cache==1:
+        key = (surf, LorY, param.kappa, IorE, K_diag)
+        if key not in surfTar.P2P_block and copyBlock(surfTar, surfSrc, key) is None:
+            surfTar.P2P_block[key], time_an = P2P_assemble(surfSrc, surfTar, surf, LorY, K_diag, IorE, w, param)
+            timing.time_an += time_an
+
+        block = surfTar.P2P_block[key]
+        if block is not None:
+            K_mat, V_mat, AI_int = block
+            K_aux += K_mat.dot(mKc.T).T
+            V_aux += V_mat.dot(mVc.T).T
+            timing.AI_int += AI_int
+
+            toc = time.time()
+            timing.time_P2P += toc-tic
+
+            return K_aux, V_aux
+
     s_xj = surfSrc.xjSort
     s_yj = surfSrc.yjSort
     s_zj = surfSrc.zjSort
@@ -585,12 +744,21 @@ def P2P_sort(surfSrc, surfTar, m, mx, my, mz, mKc, mVc, K_aux, V_aux,
 
     aux = zeros(2)
 
-    direct_sort(K_aux, V_aux, int(LorY), K_diag, V_diag, int(IorE), ravel(surfSrc.vertex[surfSrc.triangleSort[:]]), 
-            int32(tri), int32(k), surfTar.xi, surfTar.yi, surfTar.zi, 
-            s_xj, s_yj, s_zj, xt, yt, zt, m, mx, my, mz, mKc, mVc, 
-            surfTar.P2P_list[surf], surfTar.offsetTarget, surfTar.sizeTarget, surfSrc.offsetSource, 
-            surfTar.offsetTwigs[surf],int32(surfTar.tree[0].target), surfSrc.AreaSort, surfSrc.sglInt_intSort, surfSrc.sglInt_extSort,
-            surfSrc.xk, surfSrc.wk, surfSrc.Xsk, surfSrc.Wsk, param.kappa, param.threshold, param.eps, w[0], aux)
+    if ndim(m)==2:
+        # Several right-hand sides (rows of m), flattened for the kernel
+        direct_sort_block(K_aux.reshape(-1), V_aux.reshape(-1), int(LorY), K_diag, V_diag, int(IorE), ravel(surfSrc.vertex[surfSrc.triangleSort[:]]), 
+                int32(tri), int32(k), surfTar.xi, surfTar.yi, surfTar.zi, 
+                s_xj, s_yj, s_zj, xt, yt, zt, ravel(m), ravel(mx), ravel(my), ravel(mz), ravel(mKc), ravel(mVc), 
+                getList(surfTar, surf, 'P2P'), surfTar.offsetTarget, surfTar.sizeTarget, surfSrc.offsetSource, 
+                surfTar.offsetTwigs[surf],surfTar.tree.target, surfSrc.AreaSort, surfSrc.sglInt_intSort, surfSrc.sglInt_extSort,
+                surfSrc.xk, surfSrc.wk, surfSrc.Xsk, surfSrc.Wsk, param.kappa, param.threshold, param.eps, w[0], aux, len(m))
+    else:
+        direct_sort(K_aux, V_aux, int(LorY), K_diag, V_diag, int(IorE), ravel(surfSrc.vertex[surfSrc.triangleSort[:]]), 
+                int32(tri), int32(k), surfTar.xi, surfTar.yi, surfTar.zi, 
+                s_xj, s_yj, s_zj, xt, yt, zt, m, mx, my, mz, mKc, mVc, 
+                getList(surfTar, surf, 'P2P'), surfTar.offsetTarget, surfTar.sizeTarget, surfSrc.offsetSource, 
+                surfTar.offsetTwigs[surf],surfTar.tree.target, surfSrc.AreaSort, surfSrc.sglInt_intSort, surfSrc.sglInt_extSort,
+                surfSrc.xk, surfSrc.wk, surfSrc.Xsk, surfSrc.Wsk, param.kappa, param.threshold, param.eps, w[0], aux)
 
     timing.AI_int += int(aux[0])
     timing.time_an += aux[1]
@@ -620,7 +788,7 @@ def P2PKt_sort(surfSrc, surfTar, m, mKc, Ktx_aux, Kty_aux, Ktz_aux,
 
     directKt_sort(Ktx_aux, Kty_aux, Ktz_aux, int(LorY), ravel(surfSrc.vertex[surfSrc.triangleSort[:]]), 
             int32(k), s_xj, s_yj, s_zj, xt, yt, zt, m, mKc,
-            surfTar.P2P_list[surf], surfTar.offsetTarget, surfTar.sizeTarget, surfSrc.offsetSource, 
+            getList(surfTar, surf, 'P2P'), surfTar.offsetTarget, surfTar.sizeTarget, surfSrc.offsetSource, 
             surfTar.offsetTwigs[surf], surfSrc.AreaSort,
             surfSrc.Xsk, surfSrc.Wsk, param.kappa, param.threshold, param.eps, aux)
     
@@ -659,7 +827,7 @@ def P2P_gpu(surfSrc, surfTar, m, mx, my, mz, mKc, mVc, K_gpu, V_gpu,
 
     # GPU arrays are flattened, need to point to first element 
     ptr_offset  = surf*len(surfTar.offsetTwigs[surf])  # Pointer to first element of offset arrays 
-    ptr_list    = surf*len(surfTar.P2P_list[surf])     # Pointer to first element in lists arrays
+    ptr_list    = surfTar.P2P_ptr[surf]                # Pointer to first element in lists arrays
 
     # Check if internal or external to send correct singular integral
     if IorE==1:
@@ -713,7 +881,7 @@ def P2PKt_gpu(surfSrc, surfTar, m, mKtc, Ktx_gpu, Kty_gpu, Ktz_gpu,
 
     # GPU arrays are flattened, need to point to first element 
     ptr_offset  = surf*len(surfTar.offsetTwigs[surf])  # Pointer to first element of offset arrays 
-    ptr_list    = surf*len(surfTar.P2P_list[surf])     # Pointer to first element in lists arrays
+    ptr_list    = surfTar.P2P_ptr[surf]                # Pointer to first element in lists arrays
 
 
     directKt_gpu(Ktx_gpu, Kty_gpu, Ktz_gpu, 
@@ -740,8 +908,8 @@ def P2PKt_gpu(surfSrc, surfTar, m, mKtc, Ktx_gpu, Kty_gpu, Ktz_gpu,
 
     return Ktx_gpu, Kty_gpu, Ktz_gpu
 
-def M2P_nonvec(Cells, CJ, xq, Kval, Vval, index, par_reac, source, time_M2P):
-    # Cells     : array of Cells
+def M2P_nonvec(tree, CJ, xq, Kval, Vval, index, par_reac, source, time_M2P):
+    # tree      : octree
     # CJ        : index of source cell
     # p         : accumulator 
     # theta     : MAC criteron 
@@ -749,22 +917,22 @@ def M2P_nonvec(Cells, CJ, xq, Kval, Vval, index, par_reac, source, time_M2P):
     # P         : order of Taylor expansion
     # NCRIT     : max number of particles per cell
 
-    if (Cells[CJ].ntarget>=par_reac.NCRIT): # if not a twig
+    if (tree.ntarget[CJ]>=par_reac.NCRIT): # if not a twig
         for c in range(8):
-            if (Cells[CJ].nchild & (1<<c)):
-                CC = Cells[CJ].child[c]  # Points at child cell
-                dxi = Cells[CC].xc - xq[0] 
-                dyi = Cells[CC].yc - xq[1] 
-                dzi = Cells[CC].zc - xq[2] 
+            if (tree.nchild[CJ] & (1<<c)):
+                CC = tree.child[CJ,c]  # Points at child cell
+                dxi = tree.xc[CC] - xq[0] 
+                dyi = tree.yc[CC] - xq[1] 
+                dzi = tree.zc[CC] - xq[2] 
                 r   = sqrt(dxi*dxi+dyi*dyi+dzi*dzi)
-                if Cells[CC].r > par_reac.theta*r: # Max distance between particles
-                    Kval, Vval, source, time_M2P = M2P_nonvec(Cells, CC, xq, Kval, Vval,
+                if tree.r[CC] > par_reac.theta*r: # Max distance between particles
+                    Kval, Vval, source, time_M2P = M2P_nonvec(tree, CC, xq, Kval, Vval,
                                                             index, par_reac, source, time_M2P)
                 else:
                     tic = time.time()
-                    dxi = xq[0] - Cells[CC].xc
-                    dyi = xq[1] - Cells[CC].yc
-                    dzi = xq[2] - Cells[CC].zc
+                    dxi = xq[0] - tree.xc[CC]
+                    dyi = xq[1] - tree.yc[CC]
+                    dzi = xq[2] - tree.zc[CC]
 
                     K_aux = zeros(1)
                     V_aux = zeros(1)
@@ -772,7 +940,7 @@ def M2P_nonvec(Cells, CJ, xq, Kval, Vval, index, par_reac, source, time_M2P):
                     dyi = array([dyi])
                     dzi = array([dzi])
                     LorY = 1
-                    multipole_c(K_aux, V_aux, Cells[CC].M, Cells[CC].Md, dxi, dyi, dzi, index, par_reac.P, par_reac.kappa, int(par_reac.Nm), int(LorY))
+                    multipole_c(K_aux, V_aux, tree.M[CC], tree.Md[CC], dxi, dyi, dzi, index, par_reac.P, par_reac.kappa, int(par_reac.Nm), int(LorY))
 
                     Kval += K_aux
                     Vval += V_aux
@@ -780,11 +948,12 @@ def M2P_nonvec(Cells, CJ, xq, Kval, Vval, index, par_reac, source, time_M2P):
                     time_M2P += toc - tic
 
     else: # Else on a twig cell
-        source.extend(Cells[CJ].source)
+        tw = tree.twig_array[CJ]
+        source.extend(tree.source[tree.offSource[tw]:tree.offSource[tw+1]])
 
     return Kval, Vval, source, time_M2P
 
-def P2P_nonvec(Cells, surface, m, mx, my, mz, mKc, mVc,
+def P2P_nonvec(tree, surface, m, mx, my, mz, mKc, mVc,
                 xq, Kval, Vval, IorE, par_reac, w, source, AI_int, time_P2P):
 
     tic = time.time()
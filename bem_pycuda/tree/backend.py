@@ -0,0 +1,75 @@
+'''
+  Copyright (C) 2013 by Christopher Cooper, Lorena Barba
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy
+  of this software and associated documentation files (the "Software"), to deal
+  in the Software without restriction, including without limitation the rights
+  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+  copies of the Software, and to permit persons to whom the Software is
+  furnished to do so, subject to the following conditions:
+
+  The above copyright notice and this permission notice shall be included in
+  all copies or substantial portions of the Software.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+'''
+
+
+# Loads PyCUDA only when the GPU backend is used. Modules import cuda and 
+# gpuarray from here instead of from pycuda: they are placeholders that import
+# pycuda (and create the CUDA context with pycuda.autoinit) on first use, so
+# runs with GPU=0 start without a CUDA stack. Timers with the interface of
+# cuda.Event come from Event(GPU), wall-clock ones on the CPU backend
+
+import importlib
+import time
+
+class lazyModule():
+    def __init__(self, name):
+        self.name   = name  # module imported on first attribute access
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            importlib.import_module('pycuda.autoinit')
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+cuda     = lazyModule('pycuda.driver')
+gpuarray = lazyModule('pycuda.gpuarray')
+
+class wallEvent():
+    # Wall-clock stand-in for cuda.Event
+    def __init__(self):
+        self.t = 0.
+
+    def record(self):
+        self.t = time.time()
+
+    def synchronize(self):
+        pass
+
+    def time_till(self, other):
+        return (other.t-self.t)*1e3     # ms, like cuda.Event
+
+def Event(GPU):
+    # Timer event for the backend selected by GPU (param.GPU)
+    if GPU==1:
+        return cuda.Event()
+    else:
+        return wallEvent()
+
+def loadKernels(param, precision):
+    # Compiled CUDA kernels for the GPU backend, None on the CPU backend
+
+    if param.GPU==0:
+        return None
+    importlib.import_module('pycuda.autoinit')     # context for the compiler
+    from cuda_kernels import kernels
+    return kernels(param.BSZ, param.Nm, param.K_fine, param.P, precision)
@@ -62,6 +62,63 @@ void P2M(REAL *M, int Msize, REAL *Md, int Mdsize,
     }
 }
 
+void P2M_tree_block(REAL *M, int Msize, REAL *Md, int Mdsize,
+        REAL *x, int xSize, REAL *y, int ySize, REAL *z, int zSize, 
+        REAL *m, int mSize, REAL *mx, int mxSize, REAL *my, int mySize, REAL *mz, int mzSize,
+        REAL *xc, int xcSize, REAL *yc, int ycSize, REAL *zc, int zcSize,
+        int *twig, int twigSize, int *source, int sourceSize, int *offSource, int offSourceSize,
+        int *I, int Isize, int *J, int Jsize, int *K, int Ksize, int Nrhs)
+{
+    // P2M for all twigs of a tree and Nrhs sets of weights, so the powers of
+    // each source are computed only once. Weights are (Nrhs,Nsource) arrays and
+    // M and Md are (Nrhs,Ncell,Nm), stored by rows. Sources of twig tw are 
+    // source[offSource[tw]:offSource[tw+1]]
+    int Ns = mSize/Nrhs, NM = Msize/Nrhs;
+    REAL dx, dy, dz, dxI, dyJ, dzK, constant;
+    int C, l, ptr;
+
+    #pragma omp parallel for schedule(dynamic) private(dx, dy, dz, dxI, dyJ, dzK, constant, C, l, ptr)
+    for (int tw=0; tw<twigSize; tw++)
+    {
+        C = twig[tw];
+        for (int i=0; i<Isize; i++)
+        {
+            ptr = C*Isize + i;
+            for (int j=offSource[tw]; j<offSource[tw+1]; j++)
+            {
+                l = source[j];
+                dx = xc[C] - x[l];
+                dy = yc[C] - y[l];
+                dz = zc[C] - z[l];
+                dxI   = power(dx,I[i]);
+                dyJ   = power(dy,J[i]);
+                dzK   = power(dz,K[i]);
+                constant = dxI*dyJ*dzK;
+                for (int c=0; c<Nrhs; c++)
+                {
+                    M[c*NM+ptr] += m[c*Ns+l] * constant;
+                    Md[c*NM+ptr] -= mx[c*Ns+l] * I[i]*constant/dx;
+                    Md[c*NM+ptr] -= my[c*Ns+l] * J[i]*constant/dy;
+                    Md[c*NM+ptr] -= mz[c*Ns+l] * K[i]*constant/dz;
+                }
+            }
+        }
+    }
+}
+
+void P2M_tree(REAL *M, int Msize, REAL *Md, int Mdsize,
+        REAL *x, int xSize, REAL *y, int ySize, REAL *z, int zSize, 
+        REAL *m, int mSize, REAL *mx, int mxSize, REAL *my, int mySize, REAL *mz, int mzSize,
+        REAL *xc, int xcSize, REAL *yc, int ycSize, REAL *zc, int zcSize,
+        int *twig, int twigSize, int *source, int sourceSize, int *offSource, int offSourceSize,
+        int *I, int Isize, int *J, int Jsize, int *K, int Ksize)
+{
+    // P2M for all twigs of a tree. M and Md are (Ncell,Nm) arrays stored by rows
+    P2M_tree_block(M, Msize, Md, Mdsize, x, xSize, y, ySize, z, zSize, 
+        m, mSize, mx, mxSize, my, mySize, mz, mzSize, xc, xcSize, yc, ycSize, zc, zcSize,
+        twig, twigSize, source, sourceSize, offSource, offSourceSize, I, Isize, J, Jsize, K, Ksize, 1);
+}
+
 void M2M(REAL *MP, int MPsize, REAL *MC, int MCsize, REAL dx, REAL dy, REAL dz, 
          int *I, int Isize, int *J, int Jsize, int *K, int Ksize,  
          REAL *cI, int cIsize, REAL *cJ, int cJsize, REAL *cK, int cKsize,  
@@ -81,3 +138,73 @@ void M2M(REAL *MP, int MPsize, REAL *MC, int MCsize, REAL dx, REAL dy, REAL dz,
         }
     }
 }
+
+void M2M_level_block(REAL *M, int Msize, REAL *Md, int Mdsize,
+        int *cells, int cellsSize, int *child, int childSize,
+        REAL *xc, int xcSize, REAL *yc, int ycSize, REAL *zc, int zcSize,
+        int *I, int Isize, int *J, int Jsize, int *K, int Ksize,  
+        REAL *cI, int cIsize, REAL *cJ, int cJsize, REAL *cK, int cKsize,  
+        int *Imi, int Imisize, int *Jmj, int Jmjsize, int *Kmk, int Kmksize,
+        int *index, int indexSize, int *ptr, int ptrSize, int Nrhs)
+{
+    // M2M into all parent cells of one level, for Nrhs sets of multipoles at
+    // once so the shift powers are computed only once. M and Md are 
+    // (Nrhs,Ncell,Nm) arrays and child the (Ncell,8) child table, stored by rows.
+    // Children are added from the last octant to the first, as a reversed loop
+    // over cells does
+    int NM = Msize/Nrhs;
+    REAL dx, dy, dz, px, py, pz;
+    int PC, CC, size, ptr_start, Mptr, MP, MC;
+
+    #pragma omp parallel for schedule(dynamic) private(dx, dy, dz, px, py, pz, PC, CC, size, ptr_start, Mptr, MP, MC)
+    for (int c=0; c<cellsSize; c++)
+    {
+        PC = cells[c];
+        for (int o=7; o>=0; o--)
+        {
+            CC = child[8*PC+o];
+            if (CC<0)
+                continue;
+
+            dx = xc[PC] - xc[CC];
+            dy = yc[PC] - yc[CC];
+            dz = zc[PC] - zc[CC];
+
+            for (int i=0; i<Isize; i++)
+            {
+                MP = PC*Isize + i;
+                ptr_start = ptr[i];
+                size      = ptr[i+1] - ptr_start;
+
+                for (int j=0; j<size; j++)
+                {
+                    Mptr = ptr_start + j;
+                    MC   = CC*Isize + index[Mptr];
+                    px   = power(dx,Imi[Mptr]);
+                    py   = power(dy,Jmj[Mptr]);
+                    pz   = power(dz,Kmk[Mptr]);
+                    for (int c=0; c<Nrhs; c++)
+                    {
+                        M[c*NM+MP]  += M[c*NM+MC]*cI[Mptr]*cJ[Mptr]*cK[Mptr]*px*py*pz;
+                        Md[c*NM+MP] += Md[c*NM+MC]*cI[Mptr]*cJ[Mptr]*cK[Mptr]*px*py*pz;
+                    }
+                }
+            }
+        }
+    }
+}
+
+void M2M_level(REAL *M, int Msize, REAL *Md, int Mdsize,
+        int *cells, int cellsSize, int *child, int childSize,
+        REAL *xc, int xcSize, REAL *yc, int ycSize, REAL *zc, int zcSize,
+        int *I, int Isize, int *J, int Jsize, int *K, int Ksize,  
+        REAL *cI, int cIsize, REAL *cJ, int cJsize, REAL *cK, int cKsize,  
+        int *Imi, int Imisize, int *Jmj, int Jmjsize, int *Kmk, int Kmksize,
+        int *index, int indexSize, int *ptr, int ptrSize)
+{
+    // M2M into all parent cells of one level. M and Md are (Ncell,Nm) arrays
+    M2M_level_block(M, Msize, Md, Mdsize, cells, cellsSize, child, childSize,
+        xc, xcSize, yc, ycSize, zc, zcSize, I, Isize, J, Jsize, K, Ksize,
+        cI, cIsize, cJ, cJsize, cK, cKsize, Imi, Imisize, Jmj, Jmjsize, Kmk, Kmksize,
+        index, indexSize, ptr, ptrSize, 1);
+}
@@ -16,6 +16,44 @@ extern void P2M(double *M, int Msize,
                 int *J, int Jsize,
                 int *K, int Ksize);
 
+extern void P2M_tree(double *M, int Msize,
+                double *Md, int Mdsize,
+                double *x, int xSize, 
+                double *y, int ySize, 
+                double *z, int zSize, 
+                double *m, int mSize, 
+                double *mx, int mxSize, 
+                double *my, int mySize, 
+                double *mz, int mzSize, 
+                double *xc, int xcSize,
+                double *yc, int ycSize,
+                double *zc, int zcSize,
+                int *twig, int twigSize,
+                int *source, int sourceSize,
+                int *offSource, int offSourceSize,
+                int *I, int Isize,
+                int *J, int Jsize,
+                int *K, int Ksize);
+
+extern void P2M_tree_block(double *M, int Msize,
+                double *Md, int Mdsize,
+                double *x, int xSize, 
+                double *y, int ySize, 
+                double *z, int zSize, 
+                double *m, int mSize, 
+                double *mx, int mxSize, 
+                double *my, int mySize, 
+                double *mz, int mzSize, 
+                double *xc, int xcSize,
+                double *yc, int ycSize,
+                double *zc, int zcSize,
+                int *twig, int twigSize,
+                int *source, int sourceSize,
+                int *offSource, int offSourceSize,
+                int *I, int Isize,
+                int *J, int Jsize,
+                int *K, int Ksize, int Nrhs);
+
 extern void M2M(double *MP, int MPsize,
                 double *MC, int MCsize,
                 double dx, double dy, double dz,
@@ -23,6 +61,30 @@ extern void M2M(double *MP, int MPsize,
                 double *cI, int cIsize, double *cJ, int cJsize, double *cK, int cKsize,
                 int *Imi, int Imisize, int *Jmj, int Jmjsize, int *Kmk, int Kmksize,
                 int *index, int indexSize, int *ptr, int ptrSize);
+
+extern void M2M_level(double *M, int Msize,
+                double *Md, int Mdsize,
+                int *cells, int cellsSize,
+                int *child, int childSize,
+                double *xc, int xcSize,
+                double *yc, int ycSize,
+                double *zc, int zcSize,
+                int *I, int Isize, int *J, int Jsize, int *K, int Ksize,
+                double *cI, int cIsize, double *cJ, int cJsize, double *cK, int cKsize,
+                int *Imi, int Imisize, int *Jmj, int Jmjsize, int *Kmk, int Kmksize,
+                int *index, int indexSize, int *ptr, int ptrSize);
+
+extern void M2M_level_block(double *M, int Msize,
+                double *Md, int Mdsize,
+                int *cells, int cellsSize,
+                int *child, int childSize,
+                double *xc, int xcSize,
+                double *yc, int ycSize,
+                double *zc, int zcSize,
+                int *I, int Isize, int *J, int Jsize, int *K, int Ksize,
+                double *cI, int cIsize, double *cJ, int cJsize, double *cK, int cKsize,
+                int *Imi, int Imisize, int *Jmj, int Jmjsize, int *Kmk, int Kmksize,
+                int *index, int indexSize, int *ptr, int ptrSize, int Nrhs);
 %}
 
 %include "numpy.i"
@@ -41,6 +103,14 @@ import_array();
 %apply (double* IN_ARRAY1, int DIM1){(double *mx, int mxSize)};
 %apply (double* IN_ARRAY1, int DIM1){(double *my, int mySize)};
 %apply (double* IN_ARRAY1, int DIM1){(double *mz, int mzSize)};
+%apply (double* IN_ARRAY1, int DIM1){(double *xc, int xcSize)};
+%apply (double* IN_ARRAY1, int DIM1){(double *yc, int ycSize)};
+%apply (double* IN_ARRAY1, int DIM1){(double *zc, int zcSize)};
+%apply (int* IN_ARRAY1, int DIM1){(int *twig, int twigSize)};
+%apply (int* IN_ARRAY1, int DIM1){(int *cells, int cellsSize)};
+%apply (int* IN_ARRAY1, int DIM1){(int *child, int childSize)};
+%apply (int* IN_ARRAY1, int DIM1){(int *source, int sourceSize)};
+%apply (int* IN_ARRAY1, int DIM1){(int *offSource, int offSourceSize)};
 %apply (int* IN_ARRAY1, int DIM1){(int *I, int Isize)};
 %apply (int* IN_ARRAY1, int DIM1){(int *J, int Jsize)};
 %apply (int* IN_ARRAY1, int DIM1){(int *K, int Ksize)};
@@ -66,6 +136,44 @@ extern void P2M(double *M, int Msize,
                 int *J, int Jsize,
                 int *K, int Ksize);
 
+extern void P2M_tree(double *M, int Msize,
+                double *Md, int Mdsize,
+                double *x, int xSize, 
+                double *y, int ySize, 
+                double *z, int zSize, 
+                double *m, int mSize, 
+                double *mx, int mxSize, 
+                double *my, int mySize, 
+                double *mz, int mzSize, 
+                double *xc, int xcSize,
+                double *yc, int ycSize,
+                double *zc, int zcSize,
+                int *twig, int twigSize,
+                int *source, int sourceSize,
+                int *offSource, int offSourceSize,
+                int *I, int Isize,
+                int *J, int Jsize,
+                int *K, int Ksize);
+
+extern void P2M_tree_block(double *M, int Msize,
+                double *Md, int Mdsize,
+                double *x, int xSize, 
+                double *y, int ySize, 
+                double *z, int zSize, 
+                double *m, int mSize, 
+                double *mx, int mxSize, 
+                double *my, int mySize, 
+                double *mz, int mzSize, 
+                double *xc, int xcSize,
+                double *yc, int ycSize,
+                double *zc, int zcSize,
+                int *twig, int twigSize,
+                int *source, int sourceSize,
+                int *offSource, int offSourceSize,
+                int *I, int Isize,
+                int *J, int Jsize,
+                int *K, int Ksize, int Nrhs);
+
 extern void M2M(double *MP, int MPsize,
                 double *MC, int MCsize,
                 double dx, double dy, double dz,
@@ -74,6 +182,30 @@ extern void M2M(double *MP, int MPsize,
                 int *Imi, int Imisize, int *Jmj, int Jmjsize, int *Kmk, int Kmksize,
                 int *index, int indexSize, int *ptr, int ptrSize);
 
+extern void M2M_level(double *M, int Msize,
+                double *Md, int Mdsize,
+                int *cells, int cellsSize,
+                int *child, int childSize,
+                double *xc, int xcSize,
+                double *yc, int ycSize,
+                double *zc, int zcSize,
+                int *I, int Isize, int *J, int Jsize, int *K, int Ksize,
+                double *cI, int cIsize, double *cJ, int cJsize, double *cK, int cKsize,
+                int *Imi, int Imisize, int *Jmj, int Jmjsize, int *Kmk, int Kmksize,
+                int *index, int indexSize, int *ptr, int ptrSize);
+
+extern void M2M_level_block(double *M, int Msize,
+                double *Md, int Mdsize,
+                int *cells, int cellsSize,
+                int *child, int childSize,
+                double *xc, int xcSize,
+                double *yc, int ycSize,
+                double *zc, int zcSize,
+                int *I, int Isize, int *J, int Jsize, int *K, int Ksize,
+                double *cI, int cIsize, double *cJ, int cJsize, double *cK, int cKsize,
+                int *Imi, int Imisize, int *Jmj, int Jmjsize, int *Kmk, int Kmksize,
+                int *index, int indexSize, int *ptr, int ptrSize, int Nrhs);
+
 %clear (double *M, int Msize);
 %clear (double *Md, int Mdsize);
 %clear (double *MP, int MPsize);
@@ -85,6 +217,14 @@ extern void M2M(double *MP, int MPsize,
 %clear (double *mx, int mxSize);
 %clear (double *my, int mySize);
 %clear (double *mz, int mzSize);
+%clear (double *xc, int xcSize);
+%clear (double *yc, int ycSize);
+%clear (double *zc, int zcSize);
+%clear (int *twig, int twigSize);
+%clear (int *cells, int cellsSize);
+%clear (int *child, int childSize);
+%clear (int *source, int sourceSize);
+%clear (int *offSource, int offSourceSize);
 %clear (int *I, int Isize);
 %clear (int *J, int Jsize);
 %clear (int *K, int Ksize);
@@ -23,7 +23,9 @@
 #include <cmath>
 #include <stdio.h>
 #include <iostream>
+#include <vector>
 #include <sys/time.h>
+#include <omp.h>
 #define REAL double
 
 double get_time (void)
@@ -33,6 +35,19 @@ double get_time (void)
     return (double)(tv.tv_sec+1e-6*tv.tv_usec);
 }
 
+void setThreads(int nthreads)
+{
+    // Number of OpenMP threads for the loops over target twigs (<=0: all cores)
+    if (nthreads<=0)
+        nthreads = omp_get_num_procs();
+    omp_set_num_threads(nthreads);
+}
+
+int getThreads(void)
+{
+    return omp_get_max_threads();
+}
+
 REAL norm(REAL *x)
 {
     return sqrt(x[0]*x[0] + x[1]*x[1] + x[2]*x[2]);
@@ -478,6 +493,141 @@ void direct_c(REAL *K_aux, int K_auxSize, REAL *V_aux, int V_auxSize, int LorY,
 
 }
 
+void direct_sort_block(REAL *K_aux, int K_auxSize, REAL *V_aux, int V_auxSize, int LorY, REAL K_diag, REAL V_diag, int IorE, REAL *triangle, int triangleSize,
+        int *tri, int triSize, int *k, int kSize, REAL *xi, int xiSize, REAL *yi, int yiSize, 
+        REAL *zi, int ziSize, REAL *s_xj, int s_xjSize, REAL *s_yj, int s_yjSize, 
+        REAL *s_zj, int s_zjSize, REAL *xt, int xtSize, REAL *yt, int ytSize, REAL *zt, int ztSize,
+        REAL *m, int mSize, REAL *mx, int mxSize, REAL *my, int mySize, REAL *mz, int mzSize, REAL *mKclean, int mKcleanSize, REAL *mVclean, int mVcleanSize,
+        int *interList, int interListSize, int *offTar, int offTarSize, int *sizeTar, int sizeTarSize, int *offSrc, int offSrcSize, int *offTwg, int offTwgSize,  
+        int *target, int targetSize,REAL *Area, int AreaSize, REAL *sglInt_int, int sglInt_intSize, REAL *sglInt_ext, int sglInt_extSize, 
+        REAL *xk, int xkSize, REAL *wk, int wkSize, REAL *Xsk, int XskSize, REAL *Wsk, int WskSize,
+        REAL kappa, REAL threshold, REAL eps, REAL w0, REAL *aux, int auxSize, int Nrhs)
+{
+    // Near-field (P2P) interactions for Nrhs sets of weights at once, so the
+    // geometry and the analytical integrals of every panel-target pair are 
+    // computed only once. Weights are (Nrhs,Nsource) arrays and K_aux, V_aux 
+    // are (Nrhs,Ntarget), flattened
+    int Ns = mSize/Nrhs, Nt = K_auxSize/Nrhs;
+    double N_an = 0., time_an = 0.;
+
+    #pragma omp parallel
+    {
+    std::vector<REAL> sum_K(Nrhs), sum_V(Nrhs);     // one buffer per thread
+
+    // Target twigs write to separate ranges of K_aux and V_aux, and every target
+    // adds its interactions in the same order for any number of threads
+    #pragma omp for schedule(dynamic) reduction(+:N_an,time_an)
+    for (int tarTwg=0; tarTwg<offTarSize; tarTwg++)
+    {
+        int CI_start = offTar[tarTwg];
+        int CI_end   = offTar[tarTwg] + sizeTar[tarTwg];
+        int list_start = offTwg[tarTwg];
+        int list_end   = offTwg[tarTwg+1];
+
+        for(int i=CI_start; i<CI_end; i++)
+        {  
+            for (int c=0; c<Nrhs; c++)
+            {
+                sum_K[c] = 0.;
+                sum_V[c] = 0.;
+            }
+
+            for (int lst=list_start; lst<list_end; lst++)
+            {
+                int CJ = interList[lst];
+                int CJ_start = offSrc[CJ];
+                int CJ_end = offSrc[CJ+1];
+
+                for(int j=CJ_start; j<CJ_end; j++)
+                {   
+                    // Check if panels are far enough for Gauss quadrature
+                    int ptr = 9*j;
+                    REAL panel[9]  = {triangle[ptr], triangle[ptr+1], triangle[ptr+2],
+                                    triangle[ptr+3], triangle[ptr+4], triangle[ptr+5],
+                                    triangle[ptr+6], triangle[ptr+7], triangle[ptr+8]};
+
+                    REAL dx_tri = xt[i] - (panel[0]+panel[3]+panel[6])/3;
+                    REAL dy_tri = yt[i] - (panel[1]+panel[4]+panel[7])/3;
+                    REAL dz_tri = zt[i] - (panel[2]+panel[5]+panel[8])/3;
+                    REAL R_tri  = sqrt(dx_tri*dx_tri + dy_tri*dy_tri + dz_tri*dz_tri);
+                    
+                    bool L_d  = (sqrt(2*Area[j])/(R_tri+eps)>=threshold);
+                    bool same = (R_tri<1e-12);
+                    bool condition_an = ((L_d) && (k[j]==0));
+                    bool condition_gq = (!L_d);
+
+                    if(condition_gq)
+                    {
+                        REAL dx = xt[i] - s_xj[j];
+                        REAL dy = yt[i] - s_yj[j];
+                        REAL dz = zt[i] - s_zj[j];
+                        REAL R  = sqrt(dx*dx + dy*dy + dz*dz + eps*eps);
+                        REAL R2 = R*R;
+                        REAL R3 = R2*R;
+                        if (LorY==2)
+                        {
+                            REAL expKr = exp(-kappa*R);
+                            REAL G_K   = expKr/R2*(kappa+1/R);
+                            for (int c=0; c<Nrhs; c++)
+                            {
+                                int jc = c*Ns + j;
+                                sum_V[c] += m[jc]*expKr/R;
+                                sum_K[c] += G_K * (dx*mx[jc] + dy*my[jc] + dz*mz[jc]);
+                            }
+                        }
+                        if (LorY==1)
+                        {
+                            for (int c=0; c<Nrhs; c++)
+                            {
+                                int jc = c*Ns + j;
+                                sum_V[c] += m[jc]/R;
+                                sum_K[c] += 1/R3*(dx*mx[jc] + dy*my[jc] + dz*mz[jc]);
+                            }
+                        }
+                    }
+                    
+                    if(condition_an)
+                    {
+                        double start = get_time();
+                        N_an += 1;
+                        REAL PHI_K = 0., PHI_V = 0.;
+                        
+                        if (same==1)
+                        {
+                            PHI_K = K_diag;
+                            if (IorE==1)
+                                PHI_V = sglInt_int[j];
+                            else
+                                PHI_V = sglInt_ext[j];
+                        }
+                        else
+                        {
+                            GQ_fine(PHI_K, PHI_V, panel, xt[i], yt[i], zt[i], kappa, Xsk, Wsk, WskSize, Area[j], LorY); 
+                        }
+
+                        for (int c=0; c<Nrhs; c++)
+                        {
+                            sum_V[c] += PHI_V * mVclean[c*Ns+j];
+                            sum_K[c] += PHI_K * mKclean[c*Ns+j]; 
+                        }
+                        time_an += get_time() - start;
+                    }
+                }
+            }
+
+            for (int c=0; c<Nrhs; c++)
+            {
+                V_aux[c*Nt+i] += sum_V[c];
+                K_aux[c*Nt+i] += sum_K[c];
+            }
+        }
+    }
+    }
+
+    aux[0] += N_an;
+    aux[1] += time_an;
+}
+
 void direct_sort(REAL *K_aux, int K_auxSize, REAL *V_aux, int V_auxSize, int LorY, REAL K_diag, REAL V_diag, int IorE, REAL *triangle, int triangleSize,
         int *tri, int triSize, int *k, int kSize, REAL *xi, int xiSize, REAL *yi, int yiSize, 
         REAL *zi, int ziSize, REAL *s_xj, int s_xjSize, REAL *s_yj, int s_yjSize, 
@@ -488,13 +638,59 @@ void direct_sort(REAL *K_aux, int K_auxSize, REAL *V_aux, int V_auxSize, int Lor
         REAL *xk, int xkSize, REAL *wk, int wkSize, REAL *Xsk, int XskSize, REAL *Wsk, int WskSize,
         REAL kappa, REAL threshold, REAL eps, REAL w0, REAL *aux, int auxSize)
 {
+    // Near-field (P2P) interactions for one set of weights
+    direct_sort_block(K_aux, K_auxSize, V_aux, V_auxSize, LorY, K_diag, V_diag, IorE, triangle, triangleSize,
+        tri, triSize, k, kSize, xi, xiSize, yi, yiSize, zi, ziSize, s_xj, s_xjSize, s_yj, s_yjSize,
+        s_zj, s_zjSize, xt, xtSize, yt, ytSize, zt, ztSize, m, mSize, mx, mxSize, my, mySize, mz, mzSize,
+        mKclean, mKcleanSize, mVclean, mVcleanSize, interList, interListSize, offTar, offTarSize, 
+        sizeTar, sizeTarSize, offSrc, offSrcSize, offTwg, offTwgSize, target, targetSize, Area, AreaSize,
+        sglInt_int, sglInt_intSize, sglInt_ext, sglInt_extSize, xk, xkSize, wk, wkSize, Xsk, XskSize, 
+        Wsk, WskSize, kappa, threshold, eps, w0, aux, auxSize, 1);
+}
+
+
+void direct_assemble(REAL *K_val, int K_valSize, REAL *V_val, int V_valSize, int *col, int colSize, int *rowPtr, int rowPtrSize,
+        int LorY, REAL K_diag, int IorE, REAL *triangle, int triangleSize,
+        int *k, int kSize, int *colSrc, int colSrcSize, REAL *s_xj, int s_xjSize, REAL *s_yj, int s_yjSize, REAL *s_zj, int s_zjSize,
+        REAL *xt, int xtSize, REAL *yt, int ytSize, REAL *zt, int ztSize,
+        REAL *mV, int mVSize, REAL *mKx, int mKxSize, REAL *mKy, int mKySize, REAL *mKz, int mKzSize,
+        int *interList, int interListSize, int *offTar, int offTarSize, int *sizeTar, int sizeTarSize, int *offSrc, int offSrcSize, int *offTwg, int offTwgSize,
+        REAL *Area, int AreaSize, REAL *sglInt_int, int sglInt_intSize, REAL *sglInt_ext, int sglInt_extSize,
+        REAL *Xsk, int XskSize, REAL *Wsk, int WskSize, REAL kappa, REAL threshold, REAL eps, REAL *aux, int auxSize)
+{
+    // Same loops and branches as direct_sort, but stores the coefficient each source 
+    // panel multiplies (sorted position colSrc of its first Gauss point) in CSR format,
+    // so later products only need K_val*mKclean and V_val*mVclean.
+    // mV, mKx, mKy, mKz are the weights of direct_sort without the unknowns (w*Area, w*Area*normal)
     double start,stop;
-    int CI_start, CI_end, CJ_start, CJ_end, list_start, list_end, CJ;
-    REAL dx, dy, dz, dx_tri, dy_tri, dz_tri, R, R2, R3, R_tri, expKr, sum_K, sum_V;
+    int CI_start, CI_end, CJ_start, CJ_end, list_start, list_end, CJ, c, ptr_row;
+    REAL dx, dy, dz, dx_tri, dy_tri, dz_tri, R, R2, R3, R_tri, expKr;
     bool L_d, same, condition_an, condition_gq;
+    double N_an = 0., time_an = 0.;
+
+    // One set of scratch arrays per thread
+    int Nthreads = omp_get_max_threads();
+    REAL *acc_K_all = new REAL[Nthreads*s_xjSize];
+    REAL *acc_V_all = new REAL[Nthreads*s_xjSize];
+    int *mark_all   = new int[Nthreads*s_xjSize];
+    for (int j=0; j<Nthreads*s_xjSize; j++)
+    {
+        acc_K_all[j] = 0.;
+        acc_V_all[j] = 0.;
+        mark_all[j]  = -1;
+    }
 
+    // Rows of different target twigs are separate ranges of K_val, V_val and col
+    #pragma omp parallel for schedule(dynamic) reduction(+:N_an,time_an) \
+        private(start, stop, CI_start, CI_end, CJ_start, CJ_end, list_start, list_end, CJ, c, ptr_row, \
+                dx, dy, dz, dx_tri, dy_tri, dz_tri, R, R2, R3, R_tri, expKr, \
+                L_d, same, condition_an, condition_gq)
     for (int tarTwg=0; tarTwg<offTarSize; tarTwg++)
     {
+        REAL *acc_K = acc_K_all + omp_get_thread_num()*s_xjSize;
+        REAL *acc_V = acc_V_all + omp_get_thread_num()*s_xjSize;
+        int *mark   = mark_all  + omp_get_thread_num()*s_xjSize;
+
         CI_start = offTar[tarTwg];
         CI_end   = offTar[tarTwg] + sizeTar[tarTwg];
         list_start = offTwg[tarTwg];
@@ -502,8 +698,7 @@ void direct_sort(REAL *K_aux, int K_auxSize, REAL *V_aux, int V_auxSize, int Lor
 
         for(int i=CI_start; i<CI_end; i++)
         {  
-            sum_K = 0.;
-            sum_V = 0.;
+            ptr_row = rowPtr[i];
 
             for (int lst=list_start; lst<list_end; lst++)
             {
@@ -513,8 +708,6 @@ void direct_sort(REAL *K_aux, int K_auxSize, REAL *V_aux, int V_auxSize, int Lor
 
                 for(int j=CJ_start; j<CJ_end; j++)
                 {   
-                    // Check if panels are far enough for Gauss quadrature
-                    //start = get_time();
                     int ptr = 9*j;
                     REAL panel[9]  = {triangle[ptr], triangle[ptr+1], triangle[ptr+2],
                                     triangle[ptr+3], triangle[ptr+4], triangle[ptr+5],
@@ -529,12 +722,17 @@ void direct_sort(REAL *K_aux, int K_auxSize, REAL *V_aux, int V_auxSize, int Lor
                     same = (R_tri<1e-12);
                     condition_an = ((L_d) && (k[j]==0));
                     condition_gq = (!L_d);
-                    //stop = get_time();
-                    //aux[1] += stop - start;
+
+                    c = colSrc[j];
+                    if (mark[c]!=i)
+                    {
+                        mark[c] = i;
+                        col[ptr_row] = c;
+                        ptr_row += 1;
+                    }
 
                     if(condition_gq)
                     {
-                        //start = get_time();
                         dx = xt[i] - s_xj[j];
                         dy = yt[i] - s_yj[j];
                         dz = zt[i] - s_zj[j];
@@ -544,23 +742,20 @@ void direct_sort(REAL *K_aux, int K_auxSize, REAL *V_aux, int V_auxSize, int Lor
                         if (LorY==2)
                         {
                             expKr = exp(-kappa*R);
-                            sum_V += m[j]*expKr/R;
-                            sum_K += expKr/R2*(kappa+1/R) * (dx*mx[j] + dy*my[j] + dz*mz[j]);
+                            acc_V[c] += mV[j]*expKr/R;
+                            acc_K[c] += expKr/R2*(kappa+1/R) * (dx*mKx[j] + dy*mKy[j] + dz*mKz[j]);
                         }
                         if (LorY==1)
                         {
-                            sum_V += m[j]/R;
-                            sum_K += 1/R3*(dx*mx[j] + dy*my[j] + dz*mz[j]);
+                            acc_V[c] += mV[j]/R;
+                            acc_K[c] += 1/R3*(dx*mKx[j] + dy*mKy[j] + dz*mKz[j]);
                         }
-                        //stop = get_time();
-                        //aux[1] += stop - start;
                     }
                     
                     if(condition_an)
                     {
                         start = get_time();
-                        aux[0] += 1;
-                        REAL center[3] = {xt[i], yt[i], zt[i]};
+                        N_an += 1;
                         REAL PHI_K = 0., PHI_V = 0.;
                         
                         if (same==1)
@@ -576,23 +771,32 @@ void direct_sort(REAL *K_aux, int K_auxSize, REAL *V_aux, int V_auxSize, int Lor
                             GQ_fine(PHI_K, PHI_V, panel, xt[i], yt[i], zt[i], kappa, Xsk, Wsk, WskSize, Area[j], LorY); 
                         }
 
-        //                printf("%f \t %f\n",PHI_V,mVclean[j]);
-
-                        sum_V += PHI_V * mVclean[j];
-                        sum_K += PHI_K * mKclean[j]; 
+                        acc_V[c] += PHI_V;
+                        acc_K[c] += PHI_K; 
                         stop = get_time();
-                        aux[1] += stop - start;
-
+                        time_an += stop - start;
                     }
                 }
             }
 
-            V_aux[i] += sum_V;
-            K_aux[i] += sum_K;
+            for (int p=rowPtr[i]; p<ptr_row; p++)
+            {
+                c = col[p];
+                V_val[p] = acc_V[c];
+                K_val[p] = acc_K[c];
+                acc_V[c] = 0.;
+                acc_K[c] = 0.;
+            }
         }
     }
-}
 
+    aux[0] += N_an;
+    aux[1] += time_an;
+
+    delete[] acc_K_all;
+    delete[] acc_V_all;
+    delete[] mark_all;
+}
 
 void directKt_sort(REAL *Ktx_aux, int Ktx_auxSize, REAL *Kty_aux, int Kty_auxSize, REAL *Ktz_aux, int Ktz_auxSize, 
         int LorY, REAL *triangle, int triangleSize,
@@ -607,7 +811,12 @@ void directKt_sort(REAL *Ktx_aux, int Ktx_auxSize, REAL *Kty_aux, int Kty_auxSiz
     int CI_start, CI_end, CJ_start, CJ_end, list_start, list_end, CJ;
     REAL dx, dy, dz, dx_tri, dy_tri, dz_tri, R, R2, R3, R_tri, expKr, sum_Ktx, sum_Kty, sum_Ktz;
     bool L_d, same, condition_an, condition_gq;
+    double N_an = 0., time_an = 0.;
 
+    #pragma omp parallel for schedule(dynamic) reduction(+:N_an,time_an) \
+        private(start, stop, CI_start, CI_end, CJ_start, CJ_end, list_start, list_end, CJ, \
+                dx, dy, dz, dx_tri, dy_tri, dz_tri, R, R2, R3, R_tri, expKr, sum_Ktx, sum_Kty, sum_Ktz, \
+                L_d, same, condition_an, condition_gq)
     for (int tarTwg=0; tarTwg<offTarSize; tarTwg++)
     {
         CI_start = offTar[tarTwg];
@@ -678,7 +887,7 @@ void directKt_sort(REAL *Ktx_aux, int Ktx_auxSize, REAL *Kty_aux, int Kty_auxSiz
                     if(condition_an)
                     {
                         start = get_time();
-                        aux[0] += 1;
+                        N_an += 1;
                         REAL PHI_Ktx = 0.;
                         REAL PHI_Kty = 0.;
                         REAL PHI_Ktz = 0.;
@@ -700,7 +909,7 @@ void directKt_sort(REAL *Ktx_aux, int Ktx_auxSize, REAL *Kty_aux, int Kty_auxSiz
                         sum_Kty += PHI_Kty * mKclean[j]; 
                         sum_Ktz += PHI_Ktz * mKclean[j]; 
                         stop = get_time();
-                        aux[1] += stop - start;
+                        time_an += stop - start;
 
                     }
                 }
@@ -711,12 +920,16 @@ void directKt_sort(REAL *Ktx_aux, int Ktx_auxSize, REAL *Kty_aux, int Kty_auxSiz
             Ktz_aux[i] += sum_Ktz;
         }
     }
+
+    aux[0] += N_an;
+    aux[1] += time_an;
 }
 
 void coulomb_direct(REAL *xt, int xtSize, REAL *yt, int ytSize, REAL *zt, int ztSize, 
                     REAL *m, int mSize, REAL *K_aux, int K_auxSize)
 {
     REAL sum, dx, dy, dz, r;
+    #pragma omp parallel for schedule(dynamic,64) private(sum, dx, dy, dz, r)
     for(int i=0; i<xtSize; i++)
     {
         sum = 0.;
@@ -734,3 +947,65 @@ void coulomb_direct(REAL *xt, int xtSize, REAL *yt, int ytSize, REAL *zt, int zt
         K_aux[i] = m[i]*sum;
     }
 }
+
+void coulomb_sort(REAL *phi, int phiSize, REAL *dphix, int dphixSize, REAL *dphiy, int dphiySize, REAL *dphiz, int dphizSize,
+        REAL *xt, int xtSize, REAL *yt, int ytSize, REAL *zt, int ztSize,
+        REAL *xq, int xqSize, REAL *yq, int yqSize, REAL *zq, int zqSize, REAL *q, int qSize,
+        int *interList, int interListSize, int *offTar, int offTarSize, int *sizeTar, int sizeTarSize, 
+        int *offSrc, int offSrcSize, int *offTwg, int offTwgSize, int grad)
+{
+    // Near field of point charges: potential q/r and, if grad==1, its gradient
+    // at the sorted targets. Sources at distance 0 (the target itself) are skipped
+    int CI_start, CI_end, CJ, list_start, list_end;
+    REAL dx, dy, dz, R, invR, invR3, sum_phi, sum_x, sum_y, sum_z;
+
+    #pragma omp parallel for schedule(dynamic) \
+        private(CI_start, CI_end, CJ, list_start, list_end, dx, dy, dz, R, invR, invR3, sum_phi, sum_x, sum_y, sum_z)
+    for (int tarTwg=0; tarTwg<offTarSize; tarTwg++)
+    {
+        CI_start = offTar[tarTwg];
+        CI_end   = offTar[tarTwg] + sizeTar[tarTwg];
+        list_start = offTwg[tarTwg];
+        list_end   = offTwg[tarTwg+1];
+
+        for(int i=CI_start; i<CI_end; i++)
+        {
+            sum_phi = 0.;
+            sum_x = 0.;
+            sum_y = 0.;
+            sum_z = 0.;
+
+            for (int lst=list_start; lst<list_end; lst++)
+            {
+                CJ = interList[lst];
+                for(int j=offSrc[CJ]; j<offSrc[CJ+1]; j++)
+                {
+                    dx = xt[i] - xq[j];
+                    dy = yt[i] - yq[j];
+                    dz = zt[i] - zq[j];
+                    R  = sqrt(dx*dx + dy*dy + dz*dz);
+                    if (R<1e-12)
+                        continue;
+
+                    invR = 1/R;
+                    sum_phi += q[j]*invR;
+                    if (grad==1)
+                    {
+                        invR3 = q[j]*invR*invR*invR;
+                        sum_x -= invR3*dx;
+                        sum_y -= invR3*dy;
+                        sum_z -= invR3*dz;
+                    }
+                }
+            }
+
+            phi[i] += sum_phi;
+            if (grad==1)
+            {
+                dphix[i] += sum_x;
+                dphiy[i] += sum_y;
+                dphiz[i] += sum_z;
+            }
+        }
+    }
+}
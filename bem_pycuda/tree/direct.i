@@ -17,6 +17,25 @@ extern void direct_sort(double *K_aux, int K_auxSize, double *V_aux, int V_auxSi
         double *xk, int xkSize, double *wk, int wkSize, double *Xsk, int XskSize, double *Wsk, int WskSize,
         double kappa, double threshold, double eps, double w0, double *aux, int auxSize);
 
+extern void direct_sort_block(double *K_aux, int K_auxSize, double *V_aux, int V_auxSize, int LorY, double K_diag, double V_diag, int IorE, double *triangle, int triangleSize, 
+        int *tri, int triSize, int *k, int kSize, double *xi, int xiSize, double *yi, int yiSize, 
+        double *zi, int ziSize, double *s_xj, int s_xjSize, double *s_yj, int s_yjSize, 
+        double *s_zj, int s_zjSize,double *xt, int xtSize, double *yt, int ytSize, double *zt, int ztSize,
+        double *m, int mSize, double *mx, int mxSize, double *my, int mySize, double *mz, int mzSize, double *mKc, int mKcSize, double *mVc, int mVcSize,
+        int *interList, int interListSize, int *offTar, int offTarSize, int *sizeTar, int sizeTarSize, int *offSrc, int offSrcSize, int *offTwg, int offTwgSize,
+        int *targets, int targetsSize, double *Area, int AreaSize, double *sglInt_int, int sglInt_intSize, double *sglInt_ext, int sglInt_extSize,
+        double *xk, int xkSize, double *wk, int wkSize, double *Xsk, int XskSize, double *Wsk, int WskSize,
+        double kappa, double threshold, double eps, double w0, double *aux, int auxSize, int Nrhs);
+
+extern void direct_assemble(double *K_val, int K_valSize, double *V_val, int V_valSize, int *col, int colSize, int *rowPtr, int rowPtrSize,
+        int LorY, double K_diag, int IorE, double *triangle, int triangleSize,
+        int *k, int kSize, int *colSrc, int colSrcSize, double *s_xj, int s_xjSize, double *s_yj, int s_yjSize, double *s_zj, int s_zjSize,
+        double *xt, int xtSize, double *yt, int ytSize, double *zt, int ztSize,
+        double *mV, int mVSize, double *mKx, int mKxSize, double *mKy, int mKySize, double *mKz, int mKzSize,
+        int *interList, int interListSize, int *offTar, int offTarSize, int *sizeTar, int sizeTarSize, int *offSrc, int offSrcSize, int *offTwg, int offTwgSize,
+        double *Area, int AreaSize, double *sglInt_int, int sglInt_intSize, double *sglInt_ext, int sglInt_extSize,
+        double *Xsk, int XskSize, double *Wsk, int WskSize, double kappa, double threshold, double eps, double *aux, int auxSize);
+
 extern void directKt_sort(double *Ktx_aux, int Ktx_auxSize, double *Kty_aux, int Kty_auxSize, double *Ktz_aux, int Ktz_auxSize,
         int LorY, double *triangle, int triangleSize,
         int *k, int kSize, double *s_xj, int s_xjSize, double *s_yj, int s_yjSize, double *s_zj, int s_zjSize,
@@ -37,6 +56,16 @@ extern void direct_c(double *K_aux, int K_auxSize, double *V_aux, int V_auxSize,
 
 extern void coulomb_direct(double *xt, int xtSize, double *yt, int ytSize, double *zt, int ztSize, 
                             double *m, int mSize, double *K_aux, int K_auxSize);
+
+extern void coulomb_sort(double *phi, int phiSize, double *dphix, int dphixSize, double *dphiy, int dphiySize, double *dphiz, int dphizSize,
+        double *xt, int xtSize, double *yt, int ytSize, double *zt, int ztSize,
+        double *xq, int xqSize, double *yq, int yqSize, double *zq, int zqSize, double *q, int qSize,
+        int *interList, int interListSize, int *offTar, int offTarSize, int *sizeTar, int sizeTarSize,
+        int *offSrc, int offSrcSize, int *offTwg, int offTwgSize, int grad);
+
+extern void setThreads(int nthreads);
+
+extern int getThreads(void);
 %}
 
 %include "numpy.i"
@@ -49,6 +78,15 @@ import_array();
 %apply (double* INPLACE_ARRAY1, int DIM1){(double *Kty_aux, int Kty_auxSize)};
 %apply (double* INPLACE_ARRAY1, int DIM1){(double *Ktz_aux, int Ktz_auxSize)};
 %apply (double* INPLACE_ARRAY1, int DIM1){(double *V_aux, int V_auxSize)};
+%apply (double* INPLACE_ARRAY1, int DIM1){(double *K_val, int K_valSize)};
+%apply (double* INPLACE_ARRAY1, int DIM1){(double *V_val, int V_valSize)};
+%apply (int* INPLACE_ARRAY1, int DIM1){(int *col, int colSize)};
+%apply (int* IN_ARRAY1, int DIM1){(int *rowPtr, int rowPtrSize)};
+%apply (int* IN_ARRAY1, int DIM1){(int *colSrc, int colSrcSize)};
+%apply (double* IN_ARRAY1, int DIM1){(double *mV, int mVSize)};
+%apply (double* IN_ARRAY1, int DIM1){(double *mKx, int mKxSize)};
+%apply (double* IN_ARRAY1, int DIM1){(double *mKy, int mKySize)};
+%apply (double* IN_ARRAY1, int DIM1){(double *mKz, int mKzSize)};
 %apply (double* INPLACE_ARRAY1, int DIM1){(double *KL, int KLSize)};
 %apply (double* INPLACE_ARRAY1, int DIM1){(double *VL, int VLSize)};
 %apply (double* INPLACE_ARRAY1, int DIM1){(double *KY, int KYSize)};
@@ -86,6 +124,14 @@ import_array();
 %apply (double* IN_ARRAY1, int DIM1){(double *Xsk, int XskSize)};
 %apply (double* IN_ARRAY1, int DIM1){(double *Wsk, int WskSize)};
 %apply (double* IN_ARRAY1, int DIM1){(double *aux, int auxSize)};
+%apply (double* INPLACE_ARRAY1, int DIM1){(double *phi, int phiSize)};
+%apply (double* INPLACE_ARRAY1, int DIM1){(double *dphix, int dphixSize)};
+%apply (double* INPLACE_ARRAY1, int DIM1){(double *dphiy, int dphiySize)};
+%apply (double* INPLACE_ARRAY1, int DIM1){(double *dphiz, int dphizSize)};
+%apply (double* IN_ARRAY1, int DIM1){(double *xq, int xqSize)};
+%apply (double* IN_ARRAY1, int DIM1){(double *yq, int yqSize)};
+%apply (double* IN_ARRAY1, int DIM1){(double *zq, int zqSize)};
+%apply (double* IN_ARRAY1, int DIM1){(double *q, int qSize)};
 
 extern void computeDiagonal(double *VL, int VLSize, double *KL, int KLSize, double *VY, int VYSize, double *KY, int KYSize, 
                     double *triangle, int triangleSize, double *centers, int centersSize, double kappa,
@@ -101,6 +147,25 @@ extern void direct_sort(double *K_aux, int K_auxSize, double *V_aux, int V_auxSi
         double *xk, int xkSize, double *wk, int wkSize, double *Xsk, int XskSize, double *Wsk, int WskSize,
         double kappa, double threshold, double eps, double w0, double *aux, int auxSize);
 
+extern void direct_sort_block(double *K_aux, int K_auxSize, double *V_aux, int V_auxSize, int LorY, double K_diag, double V_diag, int IorE, double *triangle, int triangleSize, 
+        int *tri, int triSize, int *k, int kSize, double *xi, int xiSize, double *yi, int yiSize, 
+        double *zi, int ziSize, double *s_xj, int s_xjSize, double *s_yj, int s_yjSize, 
+        double *s_zj, int s_zjSize,double *xt, int xtSize, double *yt, int ytSize, double *zt, int ztSize,
+        double *m, int mSize, double *mx, int mxSize, double *my, int mySize, double *mz, int mzSize, double *mKc, int mKcSize, double *mVc, int mVcSize,
+        int *interList, int interListSize, int *offTar, int offTarSize, int *sizeTar, int sizeTarSize, int *offSrc, int offSrcSize, int *offTwg, int offTwgSize,
+        int *targets, int targetsSize, double *Area, int AreaSize, double *sglInt_int, int sglInt_intSize, double *sglInt_ext, int sglInt_extSize,
+        double *xk, int xkSize, double *wk, int wkSize, double *Xsk, int XskSize, double *Wsk, int WskSize,
+        double kappa, double threshold, double eps, double w0, double *aux, int auxSize, int Nrhs);
+
+extern void direct_assemble(double *K_val, int K_valSize, double *V_val, int V_valSize, int *col, int colSize, int *rowPtr, int rowPtrSize,
+        int LorY, double K_diag, int IorE, double *triangle, int triangleSize,
+        int *k, int kSize, int *colSrc, int colSrcSize, double *s_xj, int s_xjSize, double *s_yj, int s_yjSize, double *s_zj, int s_zjSize,
+        double *xt, int xtSize, double *yt, int ytSize, double *zt, int ztSize,
+        double *mV, int mVSize, double *mKx, int mKxSize, double *mKy, int mKySize, double *mKz, int mKzSize,
+        int *interList, int interListSize, int *offTar, int offTarSize, int *sizeTar, int sizeTarSize, int *offSrc, int offSrcSize, int *offTwg, int offTwgSize,
+        double *Area, int AreaSize, double *sglInt_int, int sglInt_intSize, double *sglInt_ext, int sglInt_extSize,
+        double *Xsk, int XskSize, double *Wsk, int WskSize, double kappa, double threshold, double eps, double *aux, int auxSize);
+
 extern void directKt_sort(double *Ktx_aux, int Ktx_auxSize, double *Kty_aux, int Kty_auxSize, double *Ktz_aux, int Ktz_auxSize,
         int LorY, double *triangle, int triangleSize,
         int *k, int kSize, double *s_xj, int s_xjSize, double *s_yj, int s_yjSize, double *s_zj, int s_zjSize,
@@ -122,11 +187,30 @@ extern void direct_c(double *K_aux, int K_auxSize, double *V_aux, int V_auxSize,
 extern void coulomb_direct(double *xt, int xtSize, double *yt, int ytSize, double *zt, int ztSize, 
                             double *m, int mSize, double *K_aux, int K_auxSize);
 
+extern void coulomb_sort(double *phi, int phiSize, double *dphix, int dphixSize, double *dphiy, int dphiySize, double *dphiz, int dphizSize,
+        double *xt, int xtSize, double *yt, int ytSize, double *zt, int ztSize,
+        double *xq, int xqSize, double *yq, int yqSize, double *zq, int zqSize, double *q, int qSize,
+        int *interList, int interListSize, int *offTar, int offTarSize, int *sizeTar, int sizeTarSize,
+        int *offSrc, int offSrcSize, int *offTwg, int offTwgSize, int grad);
+
+extern void setThreads(int nthreads);
+
+extern int getThreads(void);
+
 %clear (double *K_aux, int K_auxSize); 
 %clear (double *Ktx_aux, int Ktx_auxSize); 
 %clear (double *Kty_aux, int Kty_auxSize); 
 %clear (double *Ktz_aux, int Ktz_auxSize); 
 %clear (double *V_aux, int V_auxSize); 
+%clear (double *K_val, int K_valSize); 
+%clear (double *V_val, int V_valSize); 
+%clear (int *col, int colSize); 
+%clear (int *rowPtr, int rowPtrSize); 
+%clear (int *colSrc, int colSrcSize); 
+%clear (double *mV, int mVSize); 
+%clear (double *mKx, int mKxSize); 
+%clear (double *mKy, int mKySize); 
+%clear (double *mKz, int mKzSize); 
 %clear (double *KL, int KLSize); 
 %clear (double *VL, int VLSize); 
 %clear (double *KY, int KYSize); 
@@ -164,3 +248,11 @@ extern void coulomb_direct(double *xt, int xtSize, double *yt, int ytSize, doubl
 %clear (double *Xsk, int XskSize); 
 %clear (double *Wsk, int WskSize); 
 %clear (double *aux, int auxSize); 
+%clear (double *phi, int phiSize); 
+%clear (double *dphix, int dphixSize); 
+%clear (double *dphiy, int dphiySize); 
+%clear (double *dphiz, int dphizSize); 
+%clear (double *xq, int xqSize); 
+%clear (double *yq, int yqSize); 
+%clear (double *zq, int zqSize); 
+%clear (double *q, int qSize); 
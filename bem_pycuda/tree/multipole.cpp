@@ -1084,11 +1084,12 @@ void multipole_c(REAL *K_aux , int K_auxSize,
     }   
 }
 
-void multipole_sort(REAL *K_aux , int K_auxSize, 
+void multipole_sort_block(REAL *K_aux , int K_auxSize, 
                     REAL *V_aux , int V_auxSize,
                     int *offTar, int offTarSize,
                     int *sizeTar, int sizeTarSize,
                     int *offMlt, int offMltSize,
+                    int *M2P_list, int M2P_listSize,
                     REAL *M , int MSize, 
                     REAL *Md, int MdSize, 
                     REAL *xi, int xiSize, 
@@ -1098,13 +1099,20 @@ void multipole_sort(REAL *K_aux , int K_auxSize,
                     REAL *yc, int ycSize, 
                     REAL *zc, int zcSize,
                     int *index, int indexSize,
-                    int P, REAL kappa, int Nm, int LorY)
+                    int P, REAL kappa, int Nm, int LorY, int Nrhs)
 {
-    REAL a[Nm], dx, dy, dz;
-    int CI_begin, CI_end, CJ_begin, CJ_end;
-
+    // M2P for Nrhs sets of multipoles at once, so the coefficients of each
+    // target and cell are computed only once. M and Md are (Nrhs,Ncell,Nm) 
+    // arrays and K_aux, V_aux are (Nrhs,Ntarget), flattened
+    int Nt = K_auxSize/Nrhs, NM = MSize/Nrhs;
+    REAL dx, dy, dz;
+    int CI_begin, CI_end, CJ_begin, CJ_end, C;
+
+    // Target twigs write to separate ranges of K_aux and V_aux
+    #pragma omp parallel for schedule(dynamic) private(dx, dy, dz, CI_begin, CI_end, CJ_begin, CJ_end, C)
     for(int CI=0; CI<offTarSize; CI++)
     {
+        REAL a[Nm];
         CI_begin = offTar[CI];
         CI_end   = offTar[CI] + sizeTar[CI];
         CJ_begin = offMlt[CI];
@@ -1112,6 +1120,7 @@ void multipole_sort(REAL *K_aux , int K_auxSize,
 
         for(int CJ=CJ_begin; CJ<CJ_end; CJ++)
         {
+            C = M2P_list[CJ];   // Cells index M, Md, xc, yc, zc of the source tree directly
             for (int i=CI_begin; i<CI_end; i++)
             {   
                 for (int ii=0; ii<Nm; ii++)
@@ -1119,29 +1128,57 @@ void multipole_sort(REAL *K_aux , int K_auxSize,
                     a[ii] = 0.; 
                 }   
 
-                dx = xi[i] - xc[CJ];
-                dy = yi[i] - yc[CJ];
-                dz = zi[i] - zc[CJ];
+                dx = xi[i] - xc[C];
+                dy = yi[i] - yc[C];
+                dz = zi[i] - zc[C];
 
                 getCoeff(a, dx, dy, dz, index,  
                         Nm, P, kappa, LorY);
 
-                for (int j=0; j<Nm; j++)
-                {   
-                    V_aux[i] += a[j]*M[CJ*Nm+j];
-                    K_aux[i] += a[j]*Md[CJ*Nm+j];
-                } 
+                for (int c=0; c<Nrhs; c++)
+                {
+                    for (int j=0; j<Nm; j++)
+                    {   
+                        V_aux[c*Nt+i] += a[j]*M[c*NM+C*Nm+j];
+                        K_aux[c*Nt+i] += a[j]*Md[c*NM+C*Nm+j];
+                    } 
+                }
             }   
         }
     }
 }
 
+void multipole_sort(REAL *K_aux , int K_auxSize, 
+                    REAL *V_aux , int V_auxSize,
+                    int *offTar, int offTarSize,
+                    int *sizeTar, int sizeTarSize,
+                    int *offMlt, int offMltSize,
+                    int *M2P_list, int M2P_listSize,
+                    REAL *M , int MSize, 
+                    REAL *Md, int MdSize, 
+                    REAL *xi, int xiSize, 
+                    REAL *yi, int yiSize, 
+                    REAL *zi, int ziSize,
+                    REAL *xc, int xcSize, 
+                    REAL *yc, int ycSize, 
+                    REAL *zc, int zcSize,
+                    int *index, int indexSize,
+                    int P, REAL kappa, int Nm, int LorY)
+{
+    multipole_sort_block(K_aux, K_auxSize, V_aux, V_auxSize, offTar, offTarSize, 
+                    sizeTar, sizeTarSize, offMlt, offMltSize, M2P_list, M2P_listSize,
+                    M, MSize, Md, MdSize, xi, xiSize, yi, yiSize, zi, ziSize,
+                    xc, xcSize, yc, ycSize, zc, zcSize, index, indexSize, 
+                    P, kappa, Nm, LorY, 1);
+}
+
 void multipoleKt_sort(REAL *Ktx_aux , int Ktx_auxSize, 
                     REAL *Kty_aux , int Kty_auxSize,
                     REAL *Ktz_aux , int Ktz_auxSize,
                     int *offTar, int offTarSize,
                     int *sizeTar, int sizeTarSize,
                     int *offMlt, int offMltSize,
+                    int *M2P_list, int M2P_listSize,
                     REAL *M , int MSize, 
                     REAL *xi, int xiSize, 
                     REAL *yi, int yiSize, 
@@ -1152,11 +1189,13 @@ void multipoleKt_sort(REAL *Ktx_aux , int Ktx_auxSize,
                     int *index, int indexSize,
                     int P, REAL kappa, int Nm, int LorY)
 {
-    REAL ax[Nm], ay[Nm], az[Nm], dx, dy, dz;
-    int CI_begin, CI_end, CJ_begin, CJ_end;
+    REAL dx, dy, dz;
+    int CI_begin, CI_end, CJ_begin, CJ_end, C;
 
+    #pragma omp parallel for schedule(dynamic) private(dx, dy, dz, CI_begin, CI_end, CJ_begin, CJ_end, C)
     for(int CI=0; CI<offTarSize; CI++)
     {
+        REAL ax[Nm], ay[Nm], az[Nm];
         CI_begin = offTar[CI];
         CI_end   = offTar[CI] + sizeTar[CI];
         CJ_begin = offMlt[CI];
@@ -1164,6 +1203,7 @@ void multipoleKt_sort(REAL *Ktx_aux , int Ktx_auxSize,
 
         for(int CJ=CJ_begin; CJ<CJ_end; CJ++)
         {
+            C = M2P_list[CJ];
             for (int i=CI_begin; i<CI_end; i++)
             {   
                 for (int ii=0; ii<Nm; ii++)
@@ -1173,18 +1213,18 @@ void multipoleKt_sort(REAL *Ktx_aux , int Ktx_auxSize,
                     az[ii] = 0.; 
                 }   
 
-                dx = xi[i] - xc[CJ];
-                dy = yi[i] - yc[CJ];
-                dz = zi[i] - zc[CJ];
+                dx = xi[i] - xc[C];
+                dy = yi[i] - yc[C];
+                dz = zi[i] - zc[C];
 
                 getCoeff_shift(ax, ay, az, dx, dy, dz, index,  
                         Nm, P, kappa, LorY);
 
                 for (int j=0; j<Nm; j++)
                 {   
-                    Ktx_aux[i] += ax[j]*M[CJ*Nm+j];
-                    Kty_aux[i] += ay[j]*M[CJ*Nm+j];
-                    Ktz_aux[i] += az[j]*M[CJ*Nm+j];
+                    Ktx_aux[i] += ax[j]*M[C*Nm+j];
+                    Kty_aux[i] += ay[j]*M[C*Nm+j];
+                    Ktz_aux[i] += az[j]*M[C*Nm+j];
                 } 
             }   
         }
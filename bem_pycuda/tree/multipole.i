@@ -16,6 +16,7 @@ extern void multipole_sort( double *K, int KSize,
                             int *offTar, int offTarSize,
                             int *sizeTar, int sizeTarSize,
                             int *offMlt, int offMltSize,
+                            int *M2P_list, int M2P_listSize,
                             double *M, int MSize,
                             double *Md, int MdSize,
                             double *xi, int xiSize,
@@ -26,12 +27,29 @@ extern void multipole_sort( double *K, int KSize,
                             double *zc, int zcSize,
                             int *index, int indexSize, 
                             int P, double kappa, int Nm, int LorY);
+extern void multipole_sort_block( double *K, int KSize,
+                                  double *V, int VSize,
+                                  int *offTar, int offTarSize,
+                                  int *sizeTar, int sizeTarSize,
+                                  int *offMlt, int offMltSize,
+                                  int *M2P_list, int M2P_listSize,
+                                  double *M, int MSize,
+                                  double *Md, int MdSize,
+                                  double *xi, int xiSize,
+                                  double *yi, int yiSize,
+                                  double *zi, int ziSize,
+                                  double *xc, int xcSize,
+                                  double *yc, int ycSize,
+                                  double *zc, int zcSize,
+                                  int *index, int indexSize, 
+                                  int P, double kappa, int Nm, int LorY, int Nrhs);
 extern void multipoleKt_sort(double *Ktx, int KtxSize, 
                     double *Kty, int KtySize,
                     double *Ktz, int KtzSize,
                     int *offTar, int offTarSize,
                     int *sizeTar, int sizeTarSize,
                     int *offMlt, int offMltSize,
+                    int *M2P_list, int M2P_listSize,
                     double *M , int MSize, 
                     double *xi, int xiSize, 
                     double *yi, int yiSize, 
@@ -63,6 +81,7 @@ import_array();
 %apply (int* IN_ARRAY1, int DIM1){(int *offTar, int offTarSize)};
 %apply (int* IN_ARRAY1, int DIM1){(int *sizeTar, int sizeTarSize)};
 %apply (int* IN_ARRAY1, int DIM1){(int *offMlt, int offMltSize)};
+%apply (int* IN_ARRAY1, int DIM1){(int *M2P_list, int M2P_listSize)};
 %apply (int* IN_ARRAY1, int DIM1){(int *ii, int iiSize)};
 %apply (int* IN_ARRAY1, int DIM1){(int *jj, int jjSize)};
 %apply (int* IN_ARRAY1, int DIM1){(int *kk, int kkSize)};
@@ -92,6 +111,7 @@ extern void multipole_sort( double *K, int KSize,
                             int *offTar, int offTarSize,
                             int *sizeTar, int sizeTarSize,
                             int *offMlt, int offMltSize,
+                            int *M2P_list, int M2P_listSize,
                             double *M, int MSize,
                             double *Md, int MdSize,
                             double *xi, int xiSize,
@@ -102,12 +122,29 @@ extern void multipole_sort( double *K, int KSize,
                             double *zc, int zcSize,
                             int *index, int indexSize, 
                             int P, double kappa, int Nm, int LorY);
+extern void multipole_sort_block( double *K, int KSize,
+                                  double *V, int VSize,
+                                  int *offTar, int offTarSize,
+                                  int *sizeTar, int sizeTarSize,
+                                  int *offMlt, int offMltSize,
+                                  int *M2P_list, int M2P_listSize,
+                                  double *M, int MSize,
+                                  double *Md, int MdSize,
+                                  double *xi, int xiSize,
+                                  double *yi, int yiSize,
+                                  double *zi, int ziSize,
+                                  double *xc, int xcSize,
+                                  double *yc, int ycSize,
+                                  double *zc, int zcSize,
+                                  int *index, int indexSize, 
+                                  int P, double kappa, int Nm, int LorY, int Nrhs);
 extern void multipoleKt_sort(double *Ktx, int KtxSize, 
                     double *Kty, int KtySize,
                     double *Ktz, int KtzSize,
                     int *offTar, int offTarSize,
                     int *sizeTar, int sizeTarSize,
                     int *offMlt, int offMltSize,
+                    int *M2P_list, int M2P_listSize,
                     double *M , int MSize, 
                     double *xi, int xiSize, 
                     double *yi, int yiSize, 
@@ -143,6 +180,7 @@ extern int setIndex(int P, int i, int j, int k);
 %clear (int *offTar, int offTarSize);
 %clear (int *sizeTar, int sizeTarSize);
 %clear (int *offMlt, int offMltSize);
+%clear (int *M2P_list, int M2P_listSize);
 %clear (int *ii, int iiSize);
 %clear (int *jj, int jjSize);
 %clear (int *kk, int kkSize);
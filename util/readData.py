@@ -21,6 +21,8 @@
 '''
 
 from numpy import *
+import os
+import re
 
 def readVertex2(filename, REAL):
     x = []
@@ -84,99 +86,104 @@ def readTriangle(filename, surf_type):
 
     return triangle
 
-def readCheck(aux, REAL):
-    # check if it is not reading more than one term
-    cut = [0]
-    i = 0
-    for c in aux[1:]:
-        i += 1
-        if c=='-':
-            cut.append(i)
-    cut.append(len(aux))
-    X = zeros(len(cut)-1)
-    for i in range(len(cut)-1):
-        X[i] = REAL(aux[cut[i]:cut[i+1]])
+fused = re.compile(r'(?<=[0-9.])-')    # minus sign of a number glued to the previous one
 
-    return X
+def chargeCache(filename):
+    # Sidecar file of the charges read from filename
 
+    return filename + '.npz'
 
-def readpqr(filename, REAL):
+def loadCharges(filename):
+    # Positions and charges stored for filename, or None if there is no
+    # sidecar or it was written for another version of the file (mtime, size)
 
-    pos = []
-    q   = []
-    
-    f = open(filename,"r")
+    try:
+        stat = os.stat(filename)
+        data = load(chargeCache(filename))
+        if data['stamp'][0]!=stat.st_mtime or data['stamp'][1]!=stat.st_size:
+            return None
+        return data['xq'], data['q']
+    except (IOError, OSError, KeyError, ValueError):
+        return None
 
-    for line in f.readlines():
-        line = array(line.split())
-        line_aux = []
-        if line[0]=='ATOM':
-            if len(line)>10:
-                line = delete(line,4)
-
-            for l in range(len(line)-6):
-                aux = line[5+len(line_aux)]
-                if len(aux)>14:
-                    X = readCheck(aux,REAL)
-                    for i in range(len(X)):
-                        line_aux.append(X[i])
-#                       line_test.append(str(X[i]))
-                else:
-#                    line_test.append(line[5+len(line_aux)])
-                    line_aux.append(REAL(line[5+len(line_aux)]))
-
-#            line_test.append(line[len(line)-1])
-            x = line_aux[0]
-            y = line_aux[1]
-            z = line_aux[2]
-            q.append(line_aux[3])
-            pos.append([x,y,z])
-
-#           for i in range(10):
-#                f.write("%s\t"%line_test[i])
-#            f.write("\n")
-
-#    f.close()
-#    quit()
-    pos = array(pos)
-    q   = array(q)
+def saveCharges(filename, xq, q):
+
+    stat = os.stat(filename)
+    try:
+        savez(chargeCache(filename), xq=xq, q=q, stamp=array([stat.st_mtime, stat.st_size]))
+    except (IOError, OSError) as e:
+        print('Charge cache: could not write %s (%s)'%(chargeCache(filename), e))
+
+def splitFused(lines):
+    # Fields of every line. Numbers glued together without a space
+    # (-12.345-67.890) are split, with one regular expression on all lines
+
+    if len(lines)==0:
+        return []
+    return [line.split() for line in fused.sub(' -', '\n'.join(lines)).split('\n')]
+
+def readColumns(rows, cols, REAL):
+    # Columns cols (x, y, z, charge) of the split lines rows as an (N,4) array
+
+    if len(rows)==0:
+        return zeros((0,4), dtype=REAL)
+    X = array([[aux[c] for c in cols] for aux in rows], dtype=float64)
+
+    return X.astype(REAL)
+
+def readpqr(filename, REAL, cache=False):
+    # ATOM/HETATM records end with x y z charge radius, with or without chain
+    # ID before them. Files without records are read as plain columns
+    # x y z charge [radius]. cache: use and write the sidecar of chargeCache
+
+    if cache:
+        stored = loadCharges(filename)
+        if stored is not None:
+            return stored[0].astype(REAL), stored[1].astype(REAL), len(stored[1])
+
+    lines = open(filename,"r").read().splitlines()
+    atoms = [line for line in lines if line[:4]=='ATOM' or line[:6]=='HETATM']
+    if len(atoms)>0:
+        X = readColumns(splitFused(atoms), [-5,-4,-3,-2], REAL)
+    else:
+        rows = [aux for aux in splitFused(lines) if len(aux)>=4 and aux[0][0]!='#']
+        X = readColumns(rows, [0,1,2,3], REAL)
+
+    pos = X[:,0:3].copy()
+    q   = X[:,3].copy()
     Nq  = len(q)
+    if cache:
+        saveCharges(filename, pos, q)
     return pos, q, Nq
 
 
-def readcrd(filename, REAL):
+def readcrd(filename, REAL, cache=False):
+    # CHARMM coordinate file: title lines (*), number of atoms, then records
+    # with x y z in columns 4-6 and the charge in column 9 (weighting)
 
-    pos = []
-    q   = []
+    if cache:
+        stored = loadCharges(filename)
+        if stored is not None:
+            return stored[0].astype(REAL), stored[1].astype(REAL), len(stored[1])
 
-    start = 0
-    f = open(filename,"r")
-    for line in f.readlines():
-        line = array(line.split())
-   
-        if len(line)>8 and line[0]!='*':# and start==2:
-            x = line[4]
-            y = line[5]
-            z = line[6]
-            q.append(REAL(line[9]))
-            pos.append([REAL(x),REAL(y),REAL(z)])
-    
-        '''
-        if len(line)==1:
-            start += 1
-            if start==2:
-                Nq = int(line[0])
-        '''
-    pos = array(pos)
-    q   = array(q)
+    lines = open(filename,"r").read().splitlines()
+    rows = [aux for aux in splitFused(lines) if len(aux)>8 and aux[0]!='*']
+    X = readColumns(rows, [4,5,6,9], REAL)
+
+    pos = X[:,0:3].copy()
+    q   = X[:,3].copy()
     Nq  = len(q)
+    if cache:
+        saveCharges(filename, pos, q)
     return pos, q, Nq
 
 def readParameters(param, filename):
 
+    name = []
     val  = []
     for line in open(filename):
         line = line.split()
+        name.append(line[0])
         val.append(line[1])
 
     dataType = val[0]      # Data type
@@ -203,6 +210,47 @@ def readParameters(param, filename):
     param.theta     = REAL(val[12])     # MAC criterion for treecode
     param.GPU       = int (val[13])     # =1: use GPU, =0 no GPU
 
+    # Optional parameters, given by name after the ones above
+    opt = dict(zip(name[14:],val[14:]))
+    if 'P2P_cache' in opt:
+        param.P2P_cache  = int (opt['P2P_cache'])  # =1: store near-field operator
+    if 'P2P_budget' in opt:
+        param.P2P_budget = REAL(opt['P2P_budget']) # Memory budget (MB) for stored near-field operator
+    if 'cache' in opt:
+        param.cache      = int (opt['cache'])      # =1: use on-disk setup cache
+    if 'cache_dir' in opt:
+        param.cache_dir  = opt['cache_dir']        # Directory of on-disk setup cache
+    if 'cache_size' in opt:
+        param.cache_size = REAL(opt['cache_size']) # Max size (MB) of on-disk setup cache
+    if 'threads' in opt:
+        param.threads    = int (opt['threads'])    # CPU threads for treecode kernels (0: all cores)
+    if 'charge_direct' in opt:
+        param.charge_direct = float(opt['charge_direct']) # Max charge-point pairs summed directly
+    if 'charge_P' in opt:
+        param.charge_P      = int (opt['charge_P'])       # Order of expansion for charge treecode
+    if 'charge_theta' in opt:
+        param.charge_theta  = REAL(opt['charge_theta'])   # MAC criterion for charge treecode
+    if 'precond' in opt:
+        param.precond       = opt['precond']              # 'diagonal' or 'near' (near-field ILU)
+    if 'precond_drop' in opt:
+        param.precond_drop  = float(opt['precond_drop'])  # Drop tolerance of near-field ILU
+    if 'precond_fill' in opt:
+        param.precond_fill  = float(opt['precond_fill'])  # Fill factor of near-field ILU
+    if 'relax_levels' in opt:
+        param.relax_levels  = int (opt['relax_levels'])   # Relaxed accuracy levels in GMRES
+    if 'relax_dtheta' in opt:
+        param.relax_dtheta  = float(opt['relax_dtheta'])  # Increase of theta per level
+    if 'relax_safety' in opt:
+        param.relax_safety  = float(opt['relax_safety'])  # Safety factor of inexact matvec bound
+    if 'gmres_dump' in opt:
+        param.gmres_dump    = int (opt['gmres_dump'])     # =1: save first GMRES vectors (debugging)
+    if 'gmres_basis' in opt:
+        param.gmres_basis   = opt['gmres_basis']          # 'double', 'single' or 'mmap'
+    if 'share_tol' in opt:
+        param.share_tol     = float(opt['share_tol'])     # Max vertex deviation of rigid copies that share setup
+    if 'charge_cache' in opt:
+        param.charge_cache  = int (opt['charge_cache'])   # =1: keep parsed charges in a sidecar .npz
+
     return dataType
 
 